@@ -0,0 +1,1089 @@
+"""
+Benchmarks for OCRimageflow hot paths
+Uso: python benchmarks.py [nombre ...]   (sin argumentos corre todos)
+"""
+
+import asyncio
+import hashlib
+import json
+import os
+import random
+import re
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+from pathlib import Path
+
+import boto3
+import pandas as pd
+import psycopg2
+import requests
+from botocore.config import Config as BotoConfig
+from openpyxl import load_workbook
+from openpyxl.drawing.image import Image as XLImage
+from openpyxl.styles import Font, PatternFill, Alignment
+from openpyxl.utils import get_column_letter
+from google.cloud import vision
+from PIL import Image
+
+import main as app
+from main import (
+    DataNormalizer, StreamingExcelWriter, THUMBNAIL_TARGETS, OCR_PREPROCESS_PROFILES, image_service,
+    gemini_ocr, google_vision_ocr, google_vision_batch_ocr, GeminiClient,
+    FIELD_NORMALIZATION, UNIT_CORRECTIONS,
+)
+
+def timed(fn, *args, **kwargs):
+    """Run fn once and return (seconds, result)"""
+    start = time.perf_counter()
+    result = fn(*args, **kwargs)
+    return time.perf_counter() - start, result
+
+def report(label, seconds, baseline=None):
+    speedup = f"  ({baseline / seconds:.1f}x)" if baseline else ""
+    print(f"   {label:<40} {seconds * 1000:>10.1f} ms{speedup}")
+
+# ===========================================
+# FIELD NAMES
+# ===========================================
+
+def synthetic_field_names(n: int, unique_ratio: float = 0.5, seed: int = 42) -> list:
+    """OCR-like field names: dictionary keys with noise, casing, separators and unknown labels"""
+    rng = random.Random(seed)
+    keys = list(FIELD_NORMALIZATION.keys())
+    noise = ["", ":", " ", "_", " (cm)", " usd", " neto", " total", " #", " ref"]
+    unknown = ["observaciones", "proveedor", "lote", "origen", "fecha", "notas", "empaque"]
+
+    names = []
+    for i in range(n):
+        if names and rng.random() > unique_ratio:
+            names.append(rng.choice(names))
+            continue
+        base = rng.choice(keys) if rng.random() < 0.8 else rng.choice(unknown)
+        if rng.random() < 0.3:
+            base = base.upper()
+        names.append(f"{rng.choice(noise)}{base}{rng.choice(noise)}{i if rng.random() < 0.2 else ''}")
+    return names
+
+def legacy_normalize_field_name(raw_name):
+    """DataNormalizer.normalize_field_name before the compiled index (linear scan)"""
+    clean = raw_name.lower().strip().replace("$", "").replace(":", "").replace("_", " ").strip()
+    for key, normalized in FIELD_NORMALIZATION.items():
+        if key in clean or clean in key:
+            return normalized
+    return clean.replace(" ", "_")
+
+def bench_fields(n: int = 100_000):
+    print(f"\n🔤 normalize_field_name on {n:,} synthetic field names")
+    names = synthetic_field_names(n)
+
+    legacy_time, legacy = timed(lambda: [legacy_normalize_field_name(name) for name in names])
+    report("legacy linear scan", legacy_time)
+
+    build_time, normalizer = timed(DataNormalizer)
+    report("index build (first DataNormalizer)", build_time)
+
+    cold_time, compiled = timed(lambda: [normalizer.normalize_field_name(name) for name in names])
+    report("compiled index, cold memo", cold_time, legacy_time)
+
+    warm_time, _ = timed(lambda: [normalizer.normalize_field_name(name) for name in names])
+    report("compiled index, warm memo", warm_time, legacy_time)
+
+    changed = sum(1 for a, b in zip(legacy, compiled) if a != b)
+    print(f"   {changed:,} names ({changed / n:.1%}) now resolve differently (longest match instead of dict order)")
+
+# ===========================================
+# VALUES
+# ===========================================
+
+def synthetic_field_values(n: int, seed: int = 7) -> list:
+    """(normalized field name, raw OCR value) pairs in roughly the mix a catalog batch produces"""
+    rng = random.Random(seed)
+    samples = {
+        "precio_unitario": ["$12.50", "USD 8", "25", "precio 10.99 c/u", "N/A"],
+        "peso": ["10.5 KF", "3 lbs", "250 G", "1.2kg", "2 libras", "0.5 CBM", "pesado"],
+        "talla": ["m", "xl", "XXL", "38", "s/m"],
+        "color": ["azul marino", "ROJO", "verde"],
+        "qty_por_caja": ["24", "12 pcs", "6 piezas", "2 x 12"],
+        "composicion_textil": ["100% algodon", "poliester 65%"],
+        "sku": ["ab-123", "SKU 77"],
+    }
+    fields = list(samples)
+    return [(f, rng.choice(samples[f])) for f in (rng.choice(fields) for _ in range(n))]
+
+def legacy_normalize_value(field_name, value, industry="general"):
+    """DataNormalizer.normalize_value before the precompiled engine"""
+    if not value:
+        return ""
+    value_str = str(value).strip()
+
+    if "precio" in field_name or "price" in field_name:
+        numbers = re.findall(r'\d+\.?\d*', value_str)
+        return f"${float(numbers[0]):.2f}" if numbers else value_str
+
+    elif "peso" in field_name or "weight" in field_name:
+        for wrong, correct in UNIT_CORRECTIONS.items():
+            if wrong.lower() in value_str.lower():
+                value_str = value_str.lower().replace(wrong.lower(), correct)
+        match = re.search(r'(\d+\.?\d*)\s*([a-zA-Z]+)', value_str)
+        return f"{match.group(1)} {UNIT_CORRECTIONS.get(match.group(2).upper(), match.group(2).lower())}" if match else value_str
+
+    elif "talla" in field_name or "size" in field_name:
+        size_map = {"S": "S", "M": "M", "L": "L", "XL": "XL", "XXL": "XXL"}
+        return size_map.get(value_str.upper(), value_str.upper())
+
+    elif "color" in field_name:
+        return value_str.capitalize()
+
+    return value_str.capitalize() if value_str else value_str
+
+def bench_values(n: int = 200_000):
+    print(f"\n🔢 normalize_value on {n:,} synthetic values")
+    pairs = synthetic_field_values(n)
+    normalizer = DataNormalizer()
+
+    legacy_time, legacy = timed(lambda: [legacy_normalize_value(f, v) for f, v in pairs])
+    report("legacy (per-call regex + unit rescans)", legacy_time)
+
+    new_time, current = timed(lambda: [normalizer.normalize_value(f, v) for f, v in pairs])
+    report("precompiled engine", new_time, legacy_time)
+
+    changed = sum(1 for a, b in zip(legacy, current) if a != b)
+    print(f"   {changed:,} values differ (expected 0)")
+
+# ===========================================
+# BATCH NORMALIZATION
+# ===========================================
+
+def synthetic_batch(images: int, fields_per_image: int = 15, seed: int = 11) -> list:
+    """structured_data dicts shaped like OCR output for one batch"""
+    rng = random.Random(seed)
+    names = synthetic_field_names(2000, seed=seed)
+    values = [value for _, value in synthetic_field_values(2000, seed=seed)]
+    return [
+        {rng.choice(names): rng.choice(values) for _ in range(fields_per_image)}
+        for _ in range(images)
+    ]
+
+def finish_batch_frame(normalizer, batch):
+    """Per-image normalize_data plus the wide DataFrame build, as finish_batch does"""
+    return pd.DataFrame([normalizer.normalize_data(raw)[0] for raw in batch])
+
+class BatchNormalizer(DataNormalizer):
+    """
+    DataNormalizer over a whole batch at once: the structured_data of every image becomes one
+    long (image, raw_key, raw_value) frame and each normalization runs as a vectorized string op.
+    Kept here as the pandas candidate bench_batch_normalize compares with finish_batch's
+    per-image normalize_data; it loses at the batch sizes the tiers allow, so the app doesn't use it.
+    """
+    
+    PRICE_GROUP = re.compile(f"({app.PRICE_PATTERN.pattern})")
+    
+    @classmethod
+    def _normalize_price_series(cls, text):
+        numbers = text.str.extract(cls.PRICE_GROUP, expand=False)
+        found = numbers.notna()
+        result = text.copy()
+        result[found] = numbers[found].astype(float).map("${:.2f}".format)
+        return result
+    
+    @staticmethod
+    def _normalize_weight_series(text):
+        lowered = text.str.lower()
+        has_unit = lowered.str.contains(app.UNIT_PATTERN)
+        corrected = lowered.str.replace(app.UNIT_PATTERN, lambda m: app.UNIT_LOOKUP[m.group()], regex=True)
+        text = corrected.where(has_unit, text)
+        
+        parts = text.str.extract(app.WEIGHT_PATTERN)
+        found = parts[0].notna()
+        units = parts.loc[found, 1]
+        result = text.copy()
+        result[found] = parts.loc[found, 0] + " " + units.str.upper().map(app.UNIT_CORRECTIONS).fillna(units.str.lower())
+        return result
+    
+    @staticmethod
+    def _normalize_size_series(text):
+        upper = text.str.upper()
+        return upper.map(app.SIZE_MAP).fillna(upper)
+    
+    @staticmethod
+    def _normalize_text_series(text):
+        return text.str.capitalize()
+    
+    def normalize_batch(self, raw_data_list: list):
+        """
+        Normalize the structured_data of every image in a batch.
+        Returns (wide frame with one row per image for Excel, per-image dicts for JSON, per-image industries).
+        """
+        records = [
+            (image, raw_key, raw_value)
+            for image, raw_data in enumerate(raw_data_list)
+            for raw_key, raw_value in raw_data.items()
+            if not raw_key.startswith("_")
+        ]
+        frame = pd.DataFrame(records, columns=["image", "raw_key", "raw_value"])
+        
+        raw_keys = frame["raw_key"].unique()
+        frame["field"] = frame["raw_key"].map({k: self.normalize_field_name(k) for k in raw_keys})
+        frame["kind"] = frame["field"].map({f: self.value_kind(f) for f in frame["field"].unique()})
+        
+        # Falsy raw values (None, 0, "") normalize to "", like normalize_value
+        frame["text"] = frame["raw_value"].astype(str).str.strip()
+        usable = frame["raw_value"].map(bool) & (frame["text"] != "")
+        
+        # Catalog batches repeat the same values ("M", "Azul", "$10.00"), so each distinct
+        # (kind, text) pair is normalized once and the result is joined back
+        distinct = frame.loc[usable, ["kind", "text"]].drop_duplicates()
+        distinct["value"] = ""
+        for kind, group in distinct.groupby("kind", sort=False):
+            distinct.loc[group.index, "value"] = getattr(self, f"_normalize_{kind}_series")(group["text"])
+        lookup = dict(zip(zip(distinct["kind"], distinct["text"]), distinct["value"]))
+        frame["value"] = [
+            lookup[(kind, text)] if ok else ""
+            for kind, text, ok in zip(frame["kind"].tolist(), frame["text"].tolist(), usable.tolist())
+        ]
+        
+        # A repeated field keeps its first position but its last value, like dict assignment
+        if frame.duplicated(["image", "field"]).any():
+            frame["value"] = frame.groupby(["image", "field"], sort=False)["value"].transform("last")
+            frame = frame.drop_duplicates(["image", "field"], keep="first")
+        
+        normalized = [{} for _ in raw_data_list]
+        for image, field, value in zip(frame["image"].tolist(), frame["field"].tolist(), frame["value"].tolist()):
+            normalized[image][field] = value
+        
+        wide = frame.pivot(index="image", columns="field", values="value")
+        wide = wide.reindex(range(len(raw_data_list))).fillna("")
+        wide.columns.name = None
+        
+        return wide, normalized, [self.detect_industry(raw_data) for raw_data in raw_data_list]
+
+def bench_batch_normalize(images: int = 500, rounds: int = 5):
+    print(f"\n🧮 Batch normalization, {images} images x 15 fields, best of {rounds}")
+    batch = synthetic_batch(images)
+    normalizer = BatchNormalizer()
+
+    # Fresh field names each round would only measure the memo; warm both paths first
+    finish_batch_frame(normalizer, batch)
+    normalizer.normalize_batch(batch)
+
+    legacy_time = min(timed(finish_batch_frame, normalizer, batch)[0] for _ in range(rounds))
+    report("per-image normalize_data + DataFrame", legacy_time)
+
+    batch_time = min(timed(normalizer.normalize_batch, batch)[0] for _ in range(rounds))
+    report("BatchNormalizer.normalize_batch", batch_time, legacy_time)
+
+# ===========================================
+# EXCEL
+# ===========================================
+
+def synthetic_thumbnails(count: int, seed: int = 5) -> list:
+    """150px PNG thumbnails of smooth noise, so compression behaves roughly like product photos"""
+    rng = random.Random(seed)
+    thumbnails = []
+    for _ in range(min(count, 50)):
+        img = Image.effect_noise((24, 24), rng.randint(20, 80)).resize((150, 150), Image.Resampling.BILINEAR)
+        img = Image.merge("RGB", (img, img.rotate(90), img.rotate(180)))
+        output = BytesIO()
+        img.save(output, format="PNG")
+        thumbnails.append(output.getvalue())
+    return [thumbnails[i % len(thumbnails)] for i in range(count)]
+
+def legacy_generate_excel(frame, thumbnails) -> bytes:
+    """generate_excel before the streaming writer: to_excel -> load_workbook -> style -> save"""
+    df = frame.copy()
+    df.insert(0, "Imagen", "")
+    output = BytesIO()
+    df.to_excel(output, sheet_name="Datos", index=False, engine='openpyxl')
+    output.seek(0)
+
+    wb = load_workbook(output)
+    ws = wb["Datos"]
+    for cell in ws[1]:
+        cell.fill = PatternFill(start_color="4472C4", end_color="4472C4", fill_type="solid")
+        cell.font = Font(bold=True, color="FFFFFF", size=11)
+        cell.alignment = Alignment(horizontal="center", vertical="center")
+    ws.column_dimensions["A"].width = 25
+    for col in range(2, ws.max_column + 1):
+        ws.column_dimensions[get_column_letter(col)].width = 18
+
+    for idx, thumbnail in enumerate(thumbnails):
+        xl_img = XLImage(BytesIO(thumbnail))
+        ws.row_dimensions[idx + 2].height = 120
+        xl_img.anchor = f"A{idx + 2}"
+        ws.add_image(xl_img)
+
+    final_output = BytesIO()
+    wb.save(final_output)
+    return final_output.getvalue()
+
+def streaming_generate_excel(frame, thumbnails) -> int:
+    # Saved to disk, as an upload stream would consume it, so RSS reflects the writer alone
+    writer = StreamingExcelWriter(["Imagen", *frame.columns])
+    try:
+        for row, thumbnail in zip(frame.itertuples(index=False, name=None), thumbnails):
+            writer.add_row(["", *row], thumbnail)
+        with tempfile.TemporaryFile() as output:
+            writer.save(output)
+            return output.tell()
+    finally:
+        writer.close()
+
+def excel_worker(mode: str, rows: int):
+    """Runs in a child process so ru_maxrss is the peak of this one export"""
+    frame = finish_batch_frame(DataNormalizer(), synthetic_batch(rows, fields_per_image=12))
+    thumbnails = synthetic_thumbnails(rows)
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if mode == "legacy":
+        seconds, size = timed(lambda: len(legacy_generate_excel(frame, thumbnails)))
+    else:
+        seconds, size = timed(streaming_generate_excel, frame, thumbnails)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(json.dumps({"seconds": seconds, "peak_mb": peak / 1024, "growth_mb": (peak - baseline) / 1024, "size_mb": size / 2**20}))
+
+def bench_excel(sizes=(100, 1_000, 10_000)):
+    print("\n📊 Excel export (wall time, peak RSS and RSS growth during the export)")
+    for rows in sizes:
+        for mode in ("legacy", "streaming"):
+            child = subprocess.run(
+                [sys.executable, __file__, "--excel-worker", mode, str(rows)],
+                capture_output=True, text=True
+            )
+            if child.returncode != 0:
+                print(f"   {mode:<10} {rows:>6} rows  ❌ {child.stderr.strip().splitlines()[-1]}")
+                continue
+            result = json.loads(child.stdout.strip().splitlines()[-1])
+            print(f"   {mode:<10} {rows:>6} rows  {result['seconds']:>7.2f} s  "
+                  f"peak {result['peak_mb']:>7.1f} MB  +{result['growth_mb']:>6.1f} MB  "
+                  f"file {result['size_mb']:.1f} MB")
+
+# ===========================================
+# THUMBNAILS
+# ===========================================
+
+def sample_photos(count: int, seed: int = 3) -> list:
+    """JPEG bytes from BENCH_PHOTOS_DIR if set, else synthetic 12MP camera-like JPEGs"""
+    photos_dir = os.getenv("BENCH_PHOTOS_DIR")
+    if photos_dir:
+        paths = sorted(p for p in Path(photos_dir).iterdir() if p.suffix.lower() in (".jpg", ".jpeg", ".png"))
+        return [paths[i % len(paths)].read_bytes() for i in range(count)]
+    
+    rng = random.Random(seed)
+    photos = []
+    for _ in range(min(count, 8)):
+        small = Image.effect_noise((80, 60), 60).convert("RGB")
+        tint = Image.new("RGB", small.size, tuple(rng.randrange(256) for _ in range(3)))
+        img = Image.blend(small, tint, 0.5).resize((4000, 3000), Image.Resampling.BICUBIC)
+        output = BytesIO()
+        img.save(output, format="JPEG", quality=90)
+        photos.append(output.getvalue())
+    return [photos[i % len(photos)] for i in range(count)]
+
+def legacy_thumbnails(image_bytes: bytes) -> dict:
+    """make_excel_thumbnail + create_thumbnail before the process pool: one decode per size, in-process"""
+    thumbnails = {}
+    for name, (size, fmt) in THUMBNAIL_TARGETS.items():
+        img = Image.open(BytesIO(image_bytes))
+        img.thumbnail(size, Image.Resampling.LANCZOS)
+        output = BytesIO()
+        if fmt == "JPEG":
+            img.convert("RGB").save(output, format="JPEG", quality=85)
+        else:
+            img.save(output, format=fmt)
+        thumbnails[name] = output.getvalue()
+    return thumbnails
+
+def bench_thumbnails(count: int = 64):
+    photos = sample_photos(count)
+    source = "BENCH_PHOTOS_DIR" if os.getenv("BENCH_PHOTOS_DIR") else "synthetic 4000x3000"
+    print(f"\n🖼️  Thumbnails: {count} photos ({source}), excel + supplier sizes")
+    names = tuple(THUMBNAIL_TARGETS)
+    
+    legacy_seconds, _ = timed(lambda: [legacy_thumbnails(photo) for photo in photos])
+    report("legacy (sequential, decode per size)", legacy_seconds)
+    
+    # Threads share the GIL for most of the resize work; this is what the API did under concurrency
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as pool:
+        seconds, _ = timed(lambda: list(pool.map(legacy_thumbnails, photos)))
+    report("legacy (thread pool)", seconds, legacy_seconds)
+    
+    image_service.render_thumbnails(photos[0], names)  # spawn the workers outside the timing
+    seconds, _ = timed(lambda: [f.result() for f in [image_service.submit_thumbnails(p, names) for p in photos]])
+    report(f"process pool ({image_service.processes} procs, draft decode)", seconds, legacy_seconds)
+    image_service.close()
+
+# ===========================================
+# PRE-OCR RESIZE
+# ===========================================
+
+def bench_preprocess(count: int = 16):
+    """
+    Bytes sent to each engine with and without the pre-OCR stage. With BENCH_LIVE_OCR=true
+    (and engine credentials) it also times real OCR requests for the first few photos both ways.
+    """
+    photos = sample_photos(count)
+    print(f"\n📐 Pre-OCR resize: {count} photos")
+    image_service.submit_prepare(photos[0], "gemini").result()  # spawn the workers outside the timing
+    
+    for engine, profile in OCR_PREPROCESS_PROFILES.items():
+        seconds, prepared = timed(
+            lambda: [f.result() for f in [image_service.submit_prepare(p, engine) for p in photos]]
+        )
+        before = sum(len(p) for p in photos)
+        after = sum(len(p['ocr_bytes']) for p in prepared)
+        if engine == "gemini":
+            before, after = before * 4 // 3, after * 4 // 3
+        print(f"   {engine:<14} max {profile['max_side']}px q{profile['quality']}  "
+              f"sent {before / 1e6:>7.1f} MB -> {after / 1e6:>6.1f} MB  "
+              f"({before / max(after, 1):.1f}x smaller, {seconds * 1000 / count:.0f} ms/image to prepare)")
+        
+        if os.getenv("BENCH_LIVE_OCR", "false").lower() != "true":
+            continue
+        ocr = google_vision_ocr if engine == "google_vision" else (lambda b: gemini_ocr(b, "image/jpeg"))
+        for photo, prep in list(zip(photos, prepared))[:3]:
+            raw_seconds, raw = timed(ocr, photo)
+            small_seconds, small = timed(ocr, prep['ocr_bytes'])
+            same = raw['structured_data'] == small['structured_data']
+            print(f"      OCR {raw_seconds * 1000:>7.0f} ms -> {small_seconds * 1000:>6.0f} ms  "
+                  f"same fields: {'yes' if same else 'no'}")
+    image_service.close()
+
+# ===========================================
+# GOOGLE VISION BATCHING
+# ===========================================
+
+class FakeImageAnnotatorClient:
+    """
+    Local stand-in for vision.ImageAnnotatorClient: every call costs a fixed round-trip plus a
+    little per image, and the text is derived from the image bytes so ordering can be checked.
+    Images containing b"FAIL" get a per-image error; a call containing b"BOOM" fails as a whole.
+    """
+    
+    def __init__(self, latency: float = 0.15, per_image: float = 0.005):
+        self.latency = latency
+        self.per_image = per_image
+        self.calls = []
+        self._lock = threading.Lock()
+    
+    @staticmethod
+    def expected_code(content: bytes) -> str:
+        return hashlib.md5(content).hexdigest()[:8]
+    
+    def _annotate(self, content: bytes):
+        if b"FAIL" in content:
+            return vision.AnnotateImageResponse(error={"message": "Bad image data"})
+        return vision.AnnotateImageResponse(text_annotations=[
+            {"description": f"codigo: {self.expected_code(content)}\nprecio: $10.50"}
+        ])
+    
+    def _call(self, contents):
+        with self._lock:
+            self.calls.append(len(contents))
+        time.sleep(self.latency + self.per_image * len(contents))
+        if any(b"BOOM" in content for content in contents):
+            raise Exception("400 Request payload size exceeds the limit")
+    
+    def text_detection(self, image):
+        self._call([image.content])
+        return self._annotate(image.content)
+    
+    def batch_annotate_images(self, requests):
+        contents = [request.image.content for request in requests]
+        self._call(contents)
+        return vision.BatchAnnotateImagesResponse(responses=[self._annotate(c) for c in contents])
+
+def bench_vision_batch(count: int = 200, concurrency: int = 8):
+    print(f"\n👁️  Google Vision: {count} images, {concurrency} calls in flight (fake client, 150 ms/call)")
+    images = [f"img-{i}".encode() for i in range(count)]
+    
+    fake = app.vision_client = FakeImageAnnotatorClient()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        single_seconds, _ = timed(lambda: list(pool.map(google_vision_ocr, images)))
+    report(f"text_detection per image ({len(fake.calls)} calls)", single_seconds)
+    
+    fake = app.vision_client = FakeImageAnnotatorClient()
+    seconds, _ = timed(lambda: asyncio.run(google_vision_batch_ocr(images, concurrency)))
+    report(f"batch_annotate_images ({len(fake.calls)} calls)", seconds, single_seconds)
+
+# ===========================================
+# GEMINI CLIENT
+# ===========================================
+
+class GeminiStubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    
+    def setup(self):
+        super().setup()
+        with self.server.lock:
+            self.server.connections += 1
+        time.sleep(self.server.handshake)  # stands in for the TCP + TLS handshake
+    
+    def _reply(self, status: int, body: dict, headers: dict = None):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+    
+    def do_POST(self):
+        self.rfile.read(int(self.headers["Content-Length"]))
+        server = self.server
+        with server.lock:
+            server.requests += 1
+            server.in_flight += 1
+            scripted = server.script[server.requests - 1] if server.requests <= len(server.script) else None
+            throttled = scripted == 429 or (scripted is None and server.in_flight > server.capacity)
+            failed = scripted == 503 or (scripted is None and server.rng.random() < server.error_rate)
+        try:
+            time.sleep(server.latency)
+            if throttled:
+                self._reply(429, {"error": {"code": 429, "status": "RESOURCE_EXHAUSTED"}},
+                            {"Retry-After": str(server.retry_after)})
+            elif failed:
+                self._reply(503, {"error": {"code": 503, "status": "UNAVAILABLE"}})
+            else:
+                text = json.dumps({"precio": "$10.50", "talla": "M"})
+                self._reply(200, {"candidates": [{"content": {"parts": [{"text": text}]}}]})
+        finally:
+            with server.lock:
+                server.in_flight -= 1
+    
+    def log_message(self, format, *args):
+        pass
+
+def start_gemini_stub(latency=0.1, handshake=0.05, capacity=8, retry_after=0.5, error_rate=0.0, script=()):
+    """
+    Local generateContent stand-in on a free port: fixed latency, a per-connection handshake
+    cost, 429 + Retry-After above `capacity` concurrent requests and random 503s at error_rate.
+    The first requests can be scripted instead: script=(429, 503) answers them in that order.
+    """
+    server = ThreadingHTTPServer(("127.0.0.1", 0), GeminiStubHandler)
+    server.daemon_threads = True
+    server.lock = threading.Lock()
+    server.rng = random.Random(13)
+    server.latency, server.handshake, server.capacity = latency, handshake, capacity
+    server.retry_after, server.error_rate, server.script = retry_after, error_rate, script
+    server.connections = server.requests = server.in_flight = 0
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}/v1/models/stub:generateContent"
+
+def legacy_gemini_post(url: str, payload: dict) -> dict:
+    """gemini_ocr's HTTP call before GeminiClient: a fresh connection per image and no retries"""
+    r = requests.post(f"{url}?key=stub", json=payload, timeout=30)
+    r.raise_for_status()
+    return r.json()
+
+def stub_client(url: str, **overrides) -> GeminiClient:
+    options = dict(max_concurrency=16, max_retries=4, breaker_threshold=5, breaker_cooldown=30, timeout=5)
+    options.update(overrides)
+    return GeminiClient(url, "stub", **options)
+
+def bench_gemini(count: int = 160, threads: int = 16):
+    print(f"\n♊ Gemini client: {count} images from {threads} threads against a local stub "
+          f"(100 ms latency, 50 ms handshake per connection)")
+    payload = {"contents": [{"parts": [{"text": "stub"}, {"inline_data": {"mime_type": "image/jpeg", "data": "eA=="}}]}]}
+    
+    def run(call):
+        failures = 0
+        def one(_):
+            nonlocal failures
+            try:
+                call()
+            except Exception:
+                failures += 1
+        with ThreadPoolExecutor(max_workers=threads) as pool:
+            seconds, _ = timed(lambda: list(pool.map(one, range(count))))
+        return seconds, failures
+    
+    scenarios = [
+        ("healthy API", dict(capacity=64, error_rate=0.0)),
+        ("429 above 8 concurrent, 3% 503s", dict(capacity=8, error_rate=0.03)),
+    ]
+    for label, options in scenarios:
+        print(f"   {label}:")
+        server, url = start_gemini_stub(**options)
+        legacy_seconds, failures = run(lambda: legacy_gemini_post(url, payload))
+        report(f"requests.post ({failures} failed, {server.connections} conns)", legacy_seconds)
+        server.shutdown()
+        
+        server, url = start_gemini_stub(**options)
+        client = app.gemini_client = stub_client(url)
+        seconds, failures = run(lambda: gemini_ocr(b"x", "image/jpeg"))
+        report(f"GeminiClient ({failures} failed, {server.connections} conns)", seconds, legacy_seconds)
+        stats = client.stats()
+        print(f"      {server.requests} requests, {stats['retries']} retries, {stats['throttled']} throttled, "
+              f"limit settled at {stats['limit']}")
+        server.shutdown()
+
+# ===========================================
+# STREAMING INGESTION
+# ===========================================
+
+BOUNDARY = "ocrimageflow-bench"
+
+def multipart_chunks(count: int, image_bytes: bytes, chunk_size: int = 64 * 1024):
+    """A multipart/form-data body with `count` image parts, produced lazily in socket-sized chunks"""
+    for i in range(count):
+        yield (f"--{BOUNDARY}\r\nContent-Disposition: form-data; name=\"files\"; filename=\"{i}.jpg\"\r\n"
+               f"Content-Type: image/jpeg\r\n\r\n").encode()
+        for start in range(0, len(image_bytes), chunk_size):
+            yield image_bytes[start:start + chunk_size]
+        yield b"\r\n"
+    yield f"--{BOUNDARY}--\r\n".encode()
+
+async def post_multipart(path: str, count: int, image_bytes: bytes):
+    """Drive the ASGI app directly so the body really arrives chunk by chunk (TestClient buffers it)"""
+    chunks = multipart_chunks(count, image_bytes)
+    upcoming = [next(chunks)]
+    response = {}
+    
+    async def receive():
+        if not upcoming:
+            return {"type": "http.disconnect"}
+        chunk = upcoming.pop()
+        following = next(chunks, None)
+        if following is not None:
+            upcoming.append(following)
+        return {"type": "http.request", "body": chunk, "more_body": following is not None}
+    
+    async def send(message):
+        if message["type"] == "http.response.start":
+            response["status"] = message["status"]
+        elif message["type"] == "http.response.body":
+            response["body"] = response.get("body", b"") + message.get("body", b"")
+    
+    scope = {
+        "type": "http", "http_version": "1.1", "method": "POST", "scheme": "http",
+        "path": path, "raw_path": path.encode(), "root_path": "", "query_string": b"",
+        "headers": [(b"content-type", f"multipart/form-data; boundary={BOUNDARY}".encode())],
+        "server": ("bench", 80), "client": ("127.0.0.1", 1)
+    }
+    await app.app(scope, receive, send)
+    return response["status"], json.loads(response["body"])
+
+class UnlimitedReservation(app.QuotaReservation):
+    """QuotaReservation without the database: every claim fits the pro tier"""
+    
+    def reserve(self, count: int) -> dict:
+        self.images += count
+        self.tier, self.config = "pro", app.TIER_CONFIGS["pro"]
+        return {"tier": self.tier, "config": self.config, "images_this_month": self.images}
+    
+    def release(self):
+        self.images = 0
+
+def stream_worker(mode: str, count: int):
+    """Runs in a child process: one batch through /process/batch or /process/batch/stream with S3, OCR and DB faked"""
+    config = app.TIER_CONFIGS["pro"]
+    config.update(ocr_engine="google_vision", max_images_per_batch=10_000, max_images=10_000)
+    app.app.dependency_overrides[app.get_current_user] = lambda: 1
+    app.check_batch_limits = lambda user_id, batch_size: {"tier": "pro", "config": config, "images_this_month": 0}
+    app.QuotaReservation = UnlimitedReservation
+    app.upload_to_s3 = lambda *args: "https://bucket.s3.amazonaws.com/bench"
+    app.S3MultipartWriter = lambda *args: BytesIO()
+    app.ocr_cache.get = lambda *args: None
+    app.ocr_cache.put = lambda *args: None
+    app.record_batch_usage = lambda *args, **kwargs: (0, args[2])
+    app.vision_client = FakeImageAnnotatorClient(latency=0.05)
+    
+    output = BytesIO()
+    Image.effect_noise((1000, 750), 80).convert("RGB").save(output, format="JPEG", quality=90)
+    image_bytes = output.getvalue()
+    app.image_service.render_thumbnails(image_bytes)  # spawn the workers outside the measurement
+    
+    path = "/process/batch" if mode == "buffered" else "/process/batch/stream"
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    seconds, (status, body) = timed(lambda: asyncio.run(post_multipart(path, count, image_bytes)))
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    app.image_service.close()
+    print(json.dumps({
+        "status": status, "processed": body.get("images_processed"), "seconds": seconds,
+        "batch_mb": count * len(image_bytes) / 2**20, "peak_mb": peak / 1024, "growth_mb": (peak - baseline) / 1024
+    }))
+
+def bench_stream(sizes=(50, 200)):
+    print("\n🌊 Batch ingestion: buffered UploadFile reads vs streaming multipart (0.6 MB photos, pro tier)")
+    for count in sizes:
+        for mode in ("buffered", "streaming"):
+            child = subprocess.run(
+                [sys.executable, __file__, "--stream-worker", mode, str(count)],
+                capture_output=True, text=True
+            )
+            if child.returncode != 0:
+                print(f"   {mode:<10} {count:>4} images  ❌ {child.stderr.strip().splitlines()[-1]}")
+                continue
+            result = json.loads(child.stdout.strip().splitlines()[-1])
+            print(f"   {mode:<10} {count:>4} images ({result['batch_mb']:>5.0f} MB)  {result['seconds']:>6.2f} s  "
+                  f"peak {result['peak_mb']:>6.1f} MB  +{result['growth_mb']:>6.1f} MB  "
+                  f"HTTP {result['status']}, {result['processed']} processed")
+
+# ===========================================
+# PRESIGNED UPLOADS
+# ===========================================
+
+def start_moto_server(port: int = 5123):
+    """moto's S3 stand-in in a child process (so its request handling doesn't share our GIL)"""
+    server = subprocess.Popen(
+        [sys.executable, "-m", "moto.server", "-p", str(port)],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    url = f"http://127.0.0.1:{port}"
+    for _ in range(100):
+        try:
+            requests.get(url, timeout=1)
+            return server, url
+        except requests.ConnectionError:
+            time.sleep(0.1)
+    server.kill()
+    raise RuntimeError("moto server did not start")
+
+def use_moto_s3(url: str, bucket: str = "bench"):
+    """Point the app's S3 client at the moto server"""
+    app.s3_client = boto3.client(
+        "s3", endpoint_url=url, region_name="us-east-1",
+        aws_access_key_id="bench", aws_secret_access_key="bench",
+        config=BotoConfig(max_pool_connections=app.OCR_MAX_WORKERS + app.S3_FETCH_WORKERS)
+    )
+    app.s3_transfer = app.create_transfer_manager(app.s3_client, app.s3_transfer_config)
+    app.AWS_BUCKET_NAME = bucket
+    app.s3_client.create_bucket(Bucket=bucket)
+
+def bench_presigned(count: int = 64):
+    print(f"\n📤 Presigned uploads: images read back by key from a local S3 stand-in (moto, {count} photos)")
+    try:
+        import moto.server  # noqa: F401
+    except ImportError:
+        print("   ⏭️  moto no instalado (pip install 'moto[server]'), se omite")
+        return
+    
+    output = BytesIO()
+    Image.effect_noise((1000, 750), 80).convert("RGB").save(output, format="JPEG", quality=90)
+    image_bytes = output.getvalue()
+    
+    server, url = start_moto_server()
+    try:
+        use_moto_s3(url)
+        
+        keys = []
+        for i in range(count):
+            upload = app.presign_upload(1, f"{i}.jpg", "image/jpeg")
+            requests.post(upload["url"], data=upload["fields"], files={"file": (f"{i}.jpg", image_bytes)})
+            keys.append(upload["key"])
+        
+        sequential, _ = timed(lambda: [app.fetch_upload(key) for key in keys])
+        pooled, images = timed(lambda: list(app.s3_fetch_executor.map(app.fetch_upload, keys)))
+        assert all(image[0] == image_bytes for image in images)
+        report("get_object one by one", sequential)
+        report(f"pooled ({app.S3_FETCH_WORKERS} threads)", pooled, sequential)
+        
+        batch_mb = count * len(image_bytes) / 2**20
+        print(f"   API tier traffic for {batch_mb:.0f} MB of photos: /process/batch {2 * batch_mb:.0f} MB "
+              f"(client upload in + put_object out), /process/keys {batch_mb:.0f} MB (get_object in, same region)")
+    finally:
+        server.terminate()
+        server.wait()
+
+def start_throttled_proxy(target_port: int, bytes_per_second: float, port: int = 5130) -> str:
+    """
+    TCP proxy in a daemon thread capping every connection at bytes_per_second in each direction,
+    like the per-connection throughput ceiling of a real S3 endpoint (loopback has none)
+    """
+    async def pipe(reader, writer):
+        start, sent = time.perf_counter(), 0
+        try:
+            while data := await reader.read(64 * 1024):
+                writer.write(data)
+                await writer.drain()
+                sent += len(data)
+                delay = sent / bytes_per_second - (time.perf_counter() - start)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+    
+    async def handle(client_reader, client_writer):
+        server_reader, server_writer = await asyncio.open_connection("127.0.0.1", target_port)
+        await asyncio.gather(pipe(client_reader, server_writer), pipe(server_reader, client_writer))
+    
+    async def serve(ready):
+        await asyncio.start_server(handle, "127.0.0.1", port)
+        ready.set()
+        await asyncio.Event().wait()
+    
+    ready = threading.Event()
+    threading.Thread(target=lambda: asyncio.run(serve(ready)), daemon=True).start()
+    ready.wait()
+    return f"http://127.0.0.1:{port}"
+
+def generate_excel(frame, thumbnails) -> bytes:
+    """export_excel before the multipart writer: write_excel into memory, then one put_object"""
+    output = BytesIO()
+    app.write_excel(output, frame, [], "general", thumbnails)
+    return output.getvalue()
+
+def bench_s3_transfer(object_mb: int = 64, rows: int = 2_000, mb_per_connection: int = 25):
+    print(f"\n🪣 S3 transfers against a local S3 stand-in (moto): {object_mb} MB object, {rows}-row Excel export")
+    try:
+        import moto.server  # noqa: F401
+    except ImportError:
+        print("   ⏭️  moto no instalado (pip install 'moto[server]'), se omite")
+        return
+    
+    server, url = start_moto_server()
+    try:
+        use_moto_s3(url)
+        
+        payload = random.Random(2).randbytes(object_mb * 2**20)
+        frame = finish_batch_frame(DataNormalizer(), synthetic_batch(rows, fields_per_image=12))
+        thumbnails = synthetic_thumbnails(rows)
+        
+        def generate_then_put():
+            excel_bytes = generate_excel(frame, thumbnails)
+            app.s3_client.put_object(Bucket=app.AWS_BUCKET_NAME, Key="bench/export.xlsx", Body=excel_bytes)
+            return len(excel_bytes)
+        
+        proxy_url = start_throttled_proxy(int(url.rsplit(":", 1)[1]), mb_per_connection * 2**20)
+        for label, endpoint in (("loopback", url), (f"{mb_per_connection} MB/s per connection", proxy_url)):
+            print(f"   -- {label}")
+            use_moto_s3(endpoint)
+            single, _ = timed(app.s3_client.put_object, Bucket=app.AWS_BUCKET_NAME, Key="bench/single.bin", Body=payload)
+            multipart, _ = timed(app.upload_to_s3, payload, "multipart.bin", 1, "application/octet-stream")
+            report("put_object", single)
+            report(f"transfer manager ({app.S3_MULTIPART_CHUNKSIZE >> 20} MB parts x {app.S3_MAX_CONCURRENCY})",
+                   multipart, single)
+            
+            before, size = timed(generate_then_put)
+            after, (excel_url, _) = timed(app.export_excel, frame, [], "general", 1, "export.xlsx", thumbnails)
+            report(f"Excel: generate, then put_object ({size / 2**20:.0f} MB)", before)
+            report("Excel: export_excel streamed to multipart", after, before)
+        
+        key = excel_url.split(".amazonaws.com/", 1)[1]
+        exported = app.s3_client.get_object(Bucket=app.AWS_BUCKET_NAME, Key=key)["Body"].read()
+        sheet = load_workbook(BytesIO(exported), read_only=True)["Datos"]
+        assert sum(1 for _ in sheet.iter_rows(values_only=True)) == rows + 1
+    finally:
+        server.terminate()
+        server.wait()
+
+class InlineExecutor:
+    """Runs submitted calls on the caller's thread: the upload-before-OCR order stage_image used to have"""
+    
+    def submit(self, fn, *args):
+        future = Future()
+        try:
+            future.set_result(fn(*args))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+def fake_s3_upload(latency: float):
+    """upload_to_s3 stand-in that only waits, like a network-bound PUT (moto would compete for the CPU)"""
+    def upload(file_content, filename, user_id, content_type):
+        time.sleep(latency)
+        return f"https://bucket.s3.amazonaws.com/user_{user_id}/{filename}"
+    return upload
+
+def bench_upload_overlap(count: int = 64, upload_latency: float = 0.3):
+    print(f"\n🔀 Image uploads to S3 before OCR vs during OCR ({count} photos, {upload_latency * 1000:.0f} ms fake "
+          f"S3 PUT, fake Vision client, enterprise concurrency)")
+    config = dict(app.TIER_CONFIGS["enterprise"], ocr_engine="google_vision")
+    app.ocr_cache.get = lambda *args: None
+    app.ocr_cache.put = lambda *args: None
+    # Small photos keep resizing off the critical path, so the timings isolate the S3 / OCR scheduling
+    output = BytesIO()
+    Image.effect_noise((400, 300), 80).convert("RGB").save(output, format="JPEG", quality=90)
+    images = [(output.getvalue(), f"{i}.jpg", "image/jpeg") for i in range(count)]
+    app.image_service.render_thumbnails(images[0][0])  # spawn the workers outside the measurement
+    
+    upload_to_s3, upload_executor, batch_size = app.upload_to_s3, app.s3_upload_executor, app.VISION_BATCH_SIZE
+    app.upload_to_s3 = fake_s3_upload(upload_latency)
+    try:
+        for app.VISION_BATCH_SIZE, label in ((1, "text_detection per image"), (batch_size, "batch_annotate_images")):
+            print(f"   -- {label}")
+            baseline = None
+            for mode, executor in (("upload, then OCR", InlineExecutor()), ("upload during OCR", upload_executor)):
+                app.s3_upload_executor = executor
+                app.vision_client = FakeImageAnnotatorClient()
+                seconds, results = timed(lambda: asyncio.run(app.process_images_concurrently(images, 1, config)))
+                assert all(result["status"] == "succeeded" for result in results), results[0]
+                stats = [result["ocr_stats"] for result in results]
+                report(mode, seconds, baseline)
+                print(f"      uploads {sum(s['upload_ms'] for s in stats) / 1000:.1f} s, "
+                      f"not hidden by OCR {sum(s.get('upload_wait_ms', s['upload_ms']) for s in stats) / 1000:.1f} s "
+                      f"(summed over images)")
+                baseline = baseline or seconds
+    finally:
+        app.upload_to_s3, app.s3_upload_executor, app.VISION_BATCH_SIZE = upload_to_s3, upload_executor, batch_size
+
+# ===========================================
+# USAGE LOG
+# ===========================================
+
+class FakeUsageDB:
+    """
+    Stand-in for db_pool that only keeps usage_logs rows and waits rtt per round trip (execute / commit).
+    Rows of bad_users fail the foreign key, rows of bad_actions are rejected as invalid data.
+    """
+    
+    def __init__(self, rtt: float = 0.0, bad_users=(), bad_actions=(), down: bool = False):
+        self.rtt = rtt
+        self.bad_users = set(bad_users)
+        self.bad_actions = set(bad_actions)
+        self.down = down
+        self.rows = []
+        self.round_trips = 0
+        self._lock = threading.Lock()
+    
+    def wait(self):
+        with self._lock:
+            self.round_trips += 1
+        time.sleep(self.rtt)
+    
+    @contextmanager
+    def connection(self):
+        if self.down:
+            raise app.HTTPException(status_code=503, detail="Database connection failed")
+        yield FakeUsageConnection(self)
+
+class FakeUsageConnection:
+    encoding = "UTF8"  # read by execute_values
+    
+    def __init__(self, db: FakeUsageDB):
+        self.db = db
+        self.pending = []
+    
+    def cursor(self):
+        return FakeUsageCursor(self)
+    
+    def commit(self):
+        self.db.wait()
+        with self.db._lock:
+            self.db.rows.extend(self.pending)
+        self.pending = []
+    
+    def rollback(self):
+        self.pending = []
+
+class FakeUsageCursor:
+    def __init__(self, conn: FakeUsageConnection):
+        self.conn = self.connection = conn
+        self.savepoint = 0
+    
+    def mogrify(self, template, args):
+        return json.dumps(list(args), default=str).encode()
+    
+    def execute(self, sql, params=None):
+        self.conn.db.wait()
+        if isinstance(sql, bytes):  # execute_values: "INSERT ... VALUES [row],[row]"
+            rows = [json.loads(row) for row in re.findall(rb"\[[^\[\]]*\]", sql.split(b"VALUES", 1)[1])]
+        elif sql.startswith("SAVEPOINT"):
+            self.savepoint = len(self.conn.pending)
+            return
+        elif sql.startswith("ROLLBACK TO SAVEPOINT"):
+            del self.conn.pending[self.savepoint:]
+            return
+        else:  # the single-row INSERT log_usage used to run
+            rows = [list(params)]
+        self.conn.pending.extend(rows)
+        if any(row[0] in self.conn.db.bad_users for row in rows):
+            raise psycopg2.IntegrityError("usage_logs_user_id_fkey")
+        if any(row[1] in self.conn.db.bad_actions for row in rows):
+            raise psycopg2.DataError("invalid input syntax for type json")
+    
+    def close(self):
+        pass
+
+def legacy_log_usage(db: FakeUsageDB, user_id: int, action: str, details=None):
+    """log_usage before the buffered writer: one INSERT + commit on the caller's thread"""
+    with db.connection() as conn:
+        cursor = conn.cursor()
+        try:
+            cursor.execute(
+                "INSERT INTO usage_logs (user_id, action, details, images_processed, cost) VALUES (%s, %s, %s, %s, %s)",
+                (user_id, action, json.dumps(details) if details else None,
+                 details.get('images_processed', 0) if details else 0,
+                 details.get('cost', 0.0) if details else 0.0)
+            )
+            conn.commit()
+        finally:
+            cursor.close()
+
+def bench_usage_log(threads: int = 16, events: int = 100, rtt: float = 0.002):
+    print(f"\n🧾 Usage logging: INSERT + commit per event vs buffered writer "
+          f"({threads} threads x {events} logins, {rtt * 1000:.0f} ms fake DB round trip)")
+    pool = app.db_pool
+    try:
+        baseline = None
+        for mode in ("INSERT per event", "buffered writer"):
+            app.db_pool = db = FakeUsageDB(rtt)
+            writer = app.UsageLogWriter(app.USAGE_LOG_BATCH_SIZE, app.USAGE_LOG_FLUSH_MS / 1000, app.USAGE_LOG_MAX_BUFFERED)
+            log = (lambda *args: legacy_log_usage(db, *args)) if mode == "INSERT per event" else writer.log
+            latencies = []
+            
+            def worker(user_id):
+                for _ in range(events):
+                    start = time.perf_counter()
+                    log(user_id, "user_login", None)
+                    latencies.append(time.perf_counter() - start)
+            
+            start = time.perf_counter()
+            with ThreadPoolExecutor(threads) as executor:
+                list(executor.map(worker, range(threads)))
+            writer.close()
+            seconds = time.perf_counter() - start
+            assert len(db.rows) == threads * events
+            report(mode, seconds, baseline)
+            latencies.sort()
+            print(f"      per login {latencies[len(latencies) // 2] * 1e6:8.1f} µs p50, "
+                  f"{latencies[int(len(latencies) * 0.99)] * 1e6:8.1f} µs p99; {db.round_trips} DB round trips")
+            baseline = baseline or seconds
+    finally:
+        app.db_pool = pool
+
+BENCHMARKS = {
+    "fields": bench_fields,
+    "values": bench_values,
+    "batch_normalize": bench_batch_normalize,
+    "excel": bench_excel,
+    "thumbnails": bench_thumbnails,
+    "preprocess": bench_preprocess,
+    "vision_batch": bench_vision_batch,
+    "gemini": bench_gemini,
+    "stream": bench_stream,
+    "presigned": bench_presigned,
+    "s3_transfer": bench_s3_transfer,
+    "upload_overlap": bench_upload_overlap,
+    "usage_log": bench_usage_log,
+}
+
+def main():
+    if sys.argv[1:2] == ["--excel-worker"]:
+        return excel_worker(sys.argv[2], int(sys.argv[3]))
+    if sys.argv[1:2] == ["--stream-worker"]:
+        return stream_worker(sys.argv[2], int(sys.argv[3]))
+
+    selected = sys.argv[1:] or list(BENCHMARKS)
+    print("=" * 70)
+    print("⏱️  OCRimageflow benchmarks")
+    print("=" * 70)
+    for name in selected:
+        if name not in BENCHMARKS:
+            print(f"\n❌ Unknown benchmark '{name}'. Available: {', '.join(BENCHMARKS)}")
+            continue
+        BENCHMARKS[name]()
+    print("\n" + "=" * 70)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+"""
+OCRimageflow - Imágenes
+Miniaturas (Excel y S3) y la copia reducida que se envía al OCR, con una sola decodificación por imagen
+"""
+
+import time
+from io import BytesIO
+from PIL import Image, ImageOps
+
+# Decode JPEGs at no less than this multiple of the largest thumbnail, so LANCZOS still has detail to work with
+DRAFT_MARGIN = 2
+
+# EXIF tag holding the camera orientation
+EXIF_ORIENTATION = 0x0112
+
+def _to_rgb(img: Image.Image) -> Image.Image:
+    """RGB copy for JPEG output; transparent areas become white instead of black so text stays readable"""
+    if img.mode in ("RGBA", "LA") or (img.mode == "P" and "transparency" in img.info):
+        img = img.convert("RGBA")
+        background = Image.new("RGB", img.size, (255, 255, 255))
+        background.paste(img, mask=img.getchannel("A"))
+        return background
+    return img.convert("RGB")
+
+def _encode(img: Image.Image, fmt: str, quality: int = 85) -> bytes:
+    output = BytesIO()
+    if fmt == "JPEG":
+        _to_rgb(img).save(output, format="JPEG", quality=quality, optimize=True)
+    else:
+        img.save(output, format=fmt)
+    return output.getvalue()
+
+def _render(img: Image.Image, targets: dict) -> dict:
+    """Resize img in place through targets, largest first, so each size starts from the previous one"""
+    thumbnails = {}
+    for name, (size, fmt) in sorted(targets.items(), key=lambda t: -t[1][0][0] * t[1][0][1]):
+        img.thumbnail(size, Image.Resampling.LANCZOS)
+        thumbnails[name] = _encode(img, fmt)
+    return thumbnails
+
+def render_thumbnails(image_bytes: bytes, targets: dict) -> dict:
+    """
+    Decode image_bytes once and return {name: bytes} for targets {name: ((width, height), format)}.
+    JPEGs are decoded in draft mode (DCT scaling) when the largest target is much smaller than the source.
+    Every name maps to None if the image can't be decoded.
+    """
+    try:
+        img = Image.open(BytesIO(image_bytes))
+
+        largest = max((size for size, _ in targets.values()), key=lambda s: s[0] * s[1])
+        if img.format == "JPEG":
+            img.draft("RGB", (largest[0] * DRAFT_MARGIN, largest[1] * DRAFT_MARGIN))
+        return _render(ImageOps.exif_transpose(img), targets)
+    except (OSError, ValueError, Image.DecompressionBombError) as e:
+        print(f"Error creating thumbnails: {e}")
+        return {name: None for name in targets}
+
+def prepare_image(image_bytes: bytes, max_side: int, quality: int, thumbnail_targets: dict) -> dict:
+    """
+    Decode image_bytes once and build both the copy sent to OCR and the thumbnails.
+    The OCR copy is EXIF-rotated, downscaled so its longest side is at most max_side and re-encoded
+    as JPEG at quality. Upright JPEGs already within max_side are sent as they are.
+    If the image can't be decoded, the original bytes go to OCR unchanged and thumbnails are None.
+    """
+    start = time.perf_counter()
+    result = {
+        "ocr_bytes": image_bytes,
+        "mime_type": None,
+        "width": None,
+        "height": None,
+        "thumbnails": {name: None for name in thumbnail_targets}
+    }
+    try:
+        img = Image.open(BytesIO(image_bytes))
+        source_format = img.format
+        scale = min(1.0, max_side / max(img.size))
+        rotated = img.getexif().get(EXIF_ORIENTATION, 1) != 1
+
+        if source_format == "JPEG" and scale < 1:
+            img.draft("RGB", (round(img.width * scale), round(img.height * scale)))
+        img = ImageOps.exif_transpose(img)
+        img.thumbnail((max_side, max_side), Image.Resampling.LANCZOS)
+
+        if source_format != "JPEG" or scale < 1 or rotated:
+            encoded = _encode(img, "JPEG", quality)
+            # Small PNG screenshots can come out bigger as JPEG; only swap when it pays off
+            if len(encoded) < len(image_bytes) or scale < 1 or rotated:
+                result["ocr_bytes"] = encoded
+                result["mime_type"] = "image/jpeg"
+
+        result["width"], result["height"] = img.size
+        result["thumbnails"] = _render(img, thumbnail_targets)
+    except (OSError, ValueError, Image.DecompressionBombError) as e:
+        print(f"Error preparing image for OCR: {e}")
+
+    result["prepare_ms"] = round((time.perf_counter() - start) * 1000, 1)
+    return result
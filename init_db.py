@@ -39,12 +39,82 @@ CREATE TABLE IF NOT EXISTS usage_logs (
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
 );
 
+-- Batch jobs table (async /jobs API)
+CREATE TABLE IF NOT EXISTS batch_jobs (
+    id UUID PRIMARY KEY,
+    user_id INTEGER NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+    status VARCHAR(20) DEFAULT 'queued' CHECK (status IN ('queued', 'processing', 'completed', 'partial', 'failed')),
+    images_total INTEGER DEFAULT 0,
+    images_done INTEGER DEFAULT 0,
+    industry_detected VARCHAR(50),
+    excel_url TEXT,
+    normalized_data JSONB,
+    failed_images JSONB,
+    error TEXT,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+-- OCR result cache (content-addressed: cache_key = engine + SHA-256 of the image)
+CREATE TABLE IF NOT EXISTS ocr_cache (
+    user_id INTEGER NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+    cache_key VARCHAR(100) NOT NULL,
+    image_url TEXT NOT NULL,
+    ocr_result JSONB NOT NULL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    expires_at TIMESTAMP NOT NULL,
+    PRIMARY KEY (user_id, cache_key)
+);
+
+-- Per-image checkpoints of batches submitted with a batch_id (resubmitting skips finished images)
+CREATE TABLE IF NOT EXISTS batch_checkpoints (
+    user_id INTEGER NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+    batch_id VARCHAR(100) NOT NULL,
+    image_hash CHAR(64) NOT NULL,
+    filename VARCHAR(255),
+    image_url TEXT NOT NULL,
+    ocr_result JSONB NOT NULL,
+    billed BOOLEAN DEFAULT FALSE,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (user_id, batch_id, image_hash)
+);
+
+-- Usage rollups per user, action and day / month, kept current by the rollup_usage_logs trigger
+-- so usage stats never scan usage_logs
+CREATE TABLE IF NOT EXISTS usage_daily (
+    user_id INTEGER NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+    action VARCHAR(100) NOT NULL,
+    day DATE NOT NULL,
+    events INTEGER NOT NULL DEFAULT 0,
+    images_processed INTEGER NOT NULL DEFAULT 0,
+    cost DECIMAL(12, 4) NOT NULL DEFAULT 0.0,
+    PRIMARY KEY (user_id, action, day)
+);
+
+CREATE TABLE IF NOT EXISTS usage_monthly (
+    user_id INTEGER NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+    action VARCHAR(100) NOT NULL,
+    month DATE NOT NULL,  -- first day of the month
+    events INTEGER NOT NULL DEFAULT 0,
+    images_processed INTEGER NOT NULL DEFAULT 0,
+    cost DECIMAL(12, 4) NOT NULL DEFAULT 0.0,
+    PRIMARY KEY (user_id, action, month)
+);
+
 -- Indexes for better performance
 CREATE INDEX IF NOT EXISTS idx_users_email ON users(email);
 CREATE INDEX IF NOT EXISTS idx_users_tier ON users(tier);
-CREATE INDEX IF NOT EXISTS idx_usage_logs_user_id ON usage_logs(user_id);
+-- Keyset pagination of /usage/logs on (created_at, id), with and without an action filter
+CREATE INDEX IF NOT EXISTS idx_usage_logs_user_created_id ON usage_logs(user_id, created_at, id);
+CREATE INDEX IF NOT EXISTS idx_usage_logs_user_action_created_id ON usage_logs(user_id, action, created_at, id);
+DROP INDEX IF EXISTS idx_usage_logs_user_id;  -- leading column of both
 CREATE INDEX IF NOT EXISTS idx_usage_logs_action ON usage_logs(action);
 CREATE INDEX IF NOT EXISTS idx_usage_logs_created_at ON usage_logs(created_at);
+CREATE INDEX IF NOT EXISTS idx_batch_jobs_user_id ON batch_jobs(user_id);
+-- Stale job sweep (JobRunner): only the few queued/processing rows
+CREATE INDEX IF NOT EXISTS idx_batch_jobs_active_updated ON batch_jobs(updated_at) WHERE status IN ('queued', 'processing');
+CREATE INDEX IF NOT EXISTS idx_ocr_cache_expires_at ON ocr_cache(expires_at);
+CREATE INDEX IF NOT EXISTS idx_batch_checkpoints_created_at ON batch_checkpoints(created_at);
 
 -- Function to update updated_at timestamp
 CREATE OR REPLACE FUNCTION update_updated_at_column()
@@ -59,6 +129,62 @@ $$ language 'plpgsql';
 DROP TRIGGER IF EXISTS update_users_updated_at ON users;
 CREATE TRIGGER update_users_updated_at BEFORE UPDATE ON users
     FOR EACH ROW EXECUTE FUNCTION update_updated_at_column();
+
+DROP TRIGGER IF EXISTS update_batch_jobs_updated_at ON batch_jobs;
+CREATE TRIGGER update_batch_jobs_updated_at BEFORE UPDATE ON batch_jobs
+    FOR EACH ROW EXECUTE FUNCTION update_updated_at_column();
+
+-- Rollups: one statement-level pass per INSERT into usage_logs (the app writes logs in batches).
+-- Keys are upserted in a fixed order so concurrent writers can't deadlock on them
+CREATE OR REPLACE FUNCTION rollup_usage_logs()
+RETURNS TRIGGER AS $$
+BEGIN
+    INSERT INTO usage_daily AS d (user_id, action, day, events, images_processed, cost)
+    SELECT user_id, action, created_at::date, COUNT(*), COALESCE(SUM(images_processed), 0), COALESCE(SUM(cost), 0)
+    FROM new_logs
+    GROUP BY user_id, action, created_at::date
+    ORDER BY user_id, action, created_at::date
+    ON CONFLICT (user_id, action, day) DO UPDATE SET
+        events = d.events + EXCLUDED.events,
+        images_processed = d.images_processed + EXCLUDED.images_processed,
+        cost = d.cost + EXCLUDED.cost;
+    
+    INSERT INTO usage_monthly AS m (user_id, action, month, events, images_processed, cost)
+    SELECT user_id, action, date_trunc('month', created_at)::date, COUNT(*),
+           COALESCE(SUM(images_processed), 0), COALESCE(SUM(cost), 0)
+    FROM new_logs
+    GROUP BY user_id, action, date_trunc('month', created_at)::date
+    ORDER BY user_id, action, date_trunc('month', created_at)::date
+    ON CONFLICT (user_id, action, month) DO UPDATE SET
+        events = m.events + EXCLUDED.events,
+        images_processed = m.images_processed + EXCLUDED.images_processed,
+        cost = m.cost + EXCLUDED.cost;
+    RETURN NULL;
+END;
+$$ language 'plpgsql';
+
+-- Backfill the rollups from existing logs the first time they are created. Logs inserted
+-- between the backfill and CREATE TRIGGER would never be rolled up, so the lock keeps
+-- writers out until the trigger is in place (SCHEMA runs as one transaction)
+LOCK TABLE usage_logs IN SHARE ROW EXCLUSIVE MODE;
+
+INSERT INTO usage_daily (user_id, action, day, events, images_processed, cost)
+SELECT user_id, action, created_at::date, COUNT(*), COALESCE(SUM(images_processed), 0), COALESCE(SUM(cost), 0)
+FROM usage_logs
+WHERE NOT EXISTS (SELECT 1 FROM usage_daily)
+GROUP BY user_id, action, created_at::date;
+
+INSERT INTO usage_monthly (user_id, action, month, events, images_processed, cost)
+SELECT user_id, action, date_trunc('month', created_at)::date, COUNT(*),
+       COALESCE(SUM(images_processed), 0), COALESCE(SUM(cost), 0)
+FROM usage_logs
+WHERE NOT EXISTS (SELECT 1 FROM usage_monthly)
+GROUP BY user_id, action, date_trunc('month', created_at)::date;
+
+DROP TRIGGER IF EXISTS rollup_usage_logs ON usage_logs;
+CREATE TRIGGER rollup_usage_logs AFTER INSERT ON usage_logs
+    REFERENCING NEW TABLE AS new_logs
+    FOR EACH STATEMENT EXECUTE FUNCTION rollup_usage_logs();
 """
 
 def init_database():
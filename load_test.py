@@ -0,0 +1,110 @@
+"""
+Load test for /auth/login: login throughput, rejections, and the latency a login storm adds
+to other endpoints
+Uso: python load_test.py [--url URL] [--concurrency 32] [--duration 20] [--probe /tiers]
+"""
+
+import argparse
+import statistics
+import threading
+import time
+
+import requests
+
+EMAIL = "loadtest@ocrflow.com"
+PASSWORD = "loadtest123"
+
+def percentiles(samples: list) -> str:
+    if len(samples) < 2:
+        return "n/a"
+    cuts = statistics.quantiles(samples, n=100)
+    return f"p50 {cuts[49] * 1000:7.1f} ms   p95 {cuts[94] * 1000:7.1f} ms   p99 {cuts[98] * 1000:7.1f} ms"
+
+def ensure_user(url: str):
+    """Register the load test user; 400 means it already exists, which is fine"""
+    response = requests.post(f"{url}/auth/register", json={
+        "email": EMAIL, "password": PASSWORD, "name": "Load Test", "tier": "free"
+    })
+    if response.status_code not in (200, 400):
+        raise SystemExit(f"❌ Could not register the load test user: {response.status_code} {response.text}")
+
+def probe(url: str, path: str, stop: threading.Event, interval: float = 0.05) -> list:
+    """Latency of sequential requests to path until stop is set"""
+    session = requests.Session()
+    samples = []
+    while not stop.is_set():
+        start = time.perf_counter()
+        session.get(f"{url}{path}").raise_for_status()
+        samples.append(time.perf_counter() - start)
+        time.sleep(interval)
+    return samples
+
+def login_worker(url: str, stop: threading.Event, results: dict, lock: threading.Lock):
+    session = requests.Session()
+    while not stop.is_set():
+        start = time.perf_counter()
+        response = session.post(f"{url}/auth/login", json={"email": EMAIL, "password": PASSWORD})
+        elapsed = time.perf_counter() - start
+        with lock:
+            results.setdefault(response.status_code, []).append(elapsed)
+        if response.status_code == 503:
+            # What a well-behaved client does with Retry-After
+            time.sleep(float(response.headers.get("Retry-After", "1")))
+
+def run_probe(url: str, path: str, seconds: float) -> list:
+    stop = threading.Event()
+    timer = threading.Timer(seconds, stop.set)
+    timer.start()
+    return probe(url, path, stop)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--url", default="http://localhost:8000")
+    parser.add_argument("--concurrency", type=int, default=32, help="concurrent login loops")
+    parser.add_argument("--duration", type=float, default=20, help="seconds of login storm")
+    parser.add_argument("--probe", default="/tiers", help="endpoint whose latency is watched")
+    args = parser.parse_args()
+
+    print("=" * 70)
+    print(f"🔐 Login load test: {args.concurrency} concurrent clients for {args.duration:.0f} s on {args.url}")
+    print("=" * 70)
+    ensure_user(args.url)
+
+    baseline = run_probe(args.url, args.probe, min(args.duration, 5))
+
+    stop = threading.Event()
+    results, lock = {}, threading.Lock()
+    workers = [
+        threading.Thread(target=login_worker, args=(args.url, stop, results, lock), daemon=True)
+        for _ in range(args.concurrency)
+    ]
+    started = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    under_load = run_probe(args.url, args.probe, args.duration)
+    stop.set()
+    for worker in workers:
+        worker.join()
+    elapsed = time.perf_counter() - started
+
+    ok = results.get(200, [])
+    rejected = results.get(503, [])
+    others = {code: len(samples) for code, samples in results.items() if code not in (200, 503)}
+    print(f"\n✅ Logins: {len(ok)} in {elapsed:.1f} s = {len(ok) / elapsed:.1f}/s")
+    print(f"   latency   {percentiles(ok)}")
+    print(f"⛔ Rejected (503): {len(rejected)}" + (f"   latency {percentiles(rejected)}" if rejected else ""))
+    if others:
+        print(f"⚠️  Other status codes: {others}")
+    print(f"\n📡 {args.probe} latency")
+    print(f"   idle      {percentiles(baseline)}")
+    print(f"   storm     {percentiles(under_load)}")
+    if len(baseline) > 1 and len(under_load) > 1:
+        added = statistics.median(under_load) - statistics.median(baseline)
+        print(f"   added     {added * 1000:.1f} ms at the median")
+
+if __name__ == "__main__":
+    try:
+        main()
+    except requests.exceptions.ConnectionError as e:
+        print(f"\n❌ Could not connect: {e}")
+        print("   Make sure the server is running with: uvicorn main:app")
@@ -3,36 +3,62 @@ OCRimageflow - FastAPI Backend
 Sistema de procesamiento de imágenes con Google Vision, Gemini AI y normalización inteligente
 """
 
-from fastapi import FastAPI, HTTPException, Depends, status, UploadFile, File, Form
+from fastapi import FastAPI, HTTPException, Depends, status, UploadFile, File, Form, Query, Request, Response
+from fastapi.concurrency import run_in_threadpool
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import StreamingResponse
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel, EmailStr
 from typing import Optional, List, Dict
-from datetime import datetime, timedelta
+from datetime import date, datetime, timedelta
 import jwt
-import bcrypt
 import os
 from dotenv import load_dotenv
 import psycopg2
-from psycopg2.extras import RealDictCursor
+import psycopg2.extensions
+import psycopg2.errors
+from psycopg2.extras import RealDictCursor, execute_values
+from psycopg2.pool import ThreadedConnectionPool
 import boto3
+from boto3.s3.transfer import TransferConfig, create_transfer_manager
+from botocore.config import Config as BotoConfig
 from botocore.exceptions import ClientError
 import uuid
+import hashlib
+from collections import OrderedDict, deque
+from functools import lru_cache
 import base64
 import json
 import mimetypes
 import requests
 import re
+import random
+import secrets
+from email.utils import parsedate_to_datetime
 from google.cloud import vision
 import io
+import asyncio
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+import multiprocessing
+from concurrent.futures import Future, ThreadPoolExecutor, ProcessPoolExecutor
 from PIL import Image
 import pandas as pd
-from openpyxl import load_workbook
+from openpyxl import Workbook
+from openpyxl.cell import WriteOnlyCell
 from openpyxl.drawing.image import Image as XLImage
 from openpyxl.styles import Font, PatternFill, Alignment
 from openpyxl.utils import get_column_letter
 from io import BytesIO
 import tempfile
+from imaging import render_thumbnails, prepare_image
+from passwords import hash_password, check_password
+from multipart.exceptions import FormParserError
+from multipart.multipart import MultipartParser, parse_options_header
+from prometheus_client import Counter, Histogram, REGISTRY, CONTENT_TYPE_LATEST, generate_latest
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
 
 load_dotenv()
 
@@ -52,13 +78,106 @@ security = HTTPBearer()
 SECRET_KEY = os.getenv("JWT_SECRET_KEY", "your-secret-key-change-in-production")
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 60 * 24 * 7  # 7 días
+# Bearer token Prometheus sends to scrape /metrics; without one /metrics is disabled (404)
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")
+
+# Password hashing: bcrypt work factor (older hashes are upgraded on login), processes doing it,
+# and hash/verify calls allowed to be queued or running before new ones are rejected with 503
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))
+BCRYPT_PROCESSES = int(os.getenv("BCRYPT_PROCESSES", "0")) or max(1, (os.cpu_count() or 2) // 2)
+BCRYPT_MAX_PENDING = int(os.getenv("BCRYPT_MAX_PENDING", "0")) or BCRYPT_PROCESSES * 4
 
 # API Keys
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
 GOOGLE_CREDENTIALS_JSON = os.getenv("GOOGLE_CREDENTIALS_JSON")  # Base64 encoded
 
+# Concurrency: size of the worker pool that runs blocking S3 / OCR SDK calls
+OCR_MAX_WORKERS = int(os.getenv("OCR_MAX_WORKERS", "32"))
+
+# Threads for the archival S3 upload of each image, which runs in the background while it is OCR'd
+S3_UPLOAD_WORKERS = int(os.getenv("S3_UPLOAD_WORKERS", "32"))
+# Extra attempts for that upload; it only starts once the image is staged, so OCR has usually been paid for
+S3_UPLOAD_RETRIES = int(os.getenv("S3_UPLOAD_RETRIES", "2"))
+
+# Parallel S3 downloads when an Excel file is rebuilt without the original image bytes
+THUMBNAIL_FETCH_WORKERS = int(os.getenv("THUMBNAIL_FETCH_WORKERS", "16"))
+
+# Image processing processes for thumbnails and pre-OCR resizing (defaults to one per core)
+IMAGE_PROCESSES = int(os.getenv("IMAGE_PROCESSES", "0")) or os.cpu_count() or 2
+
+# Pre-OCR stage: EXIF-rotate, downscale and recompress uploads before they are sent to an OCR engine
+OCR_PREPROCESS = os.getenv("OCR_PREPROCESS", "true").lower() == "true"
+VISION_MAX_SIDE = int(os.getenv("VISION_MAX_SIDE", "2048"))
+VISION_JPEG_QUALITY = int(os.getenv("VISION_JPEG_QUALITY", "90"))
+GEMINI_MAX_SIDE = int(os.getenv("GEMINI_MAX_SIDE", "1536"))
+GEMINI_JPEG_QUALITY = int(os.getenv("GEMINI_JPEG_QUALITY", "85"))
+
+# Gemini client: endpoint, per-request timeout, in-flight request ceiling (halved on 429, grown back
+# on success), retries per image, and the circuit breaker (consecutive failures / seconds open)
+GEMINI_API_URL = os.getenv(
+    "GEMINI_API_URL", "https://generativelanguage.googleapis.com/v1/models/gemini-2.0-flash-exp:generateContent"
+)
+GEMINI_TIMEOUT = float(os.getenv("GEMINI_TIMEOUT", "30"))
+GEMINI_MAX_CONCURRENCY = int(os.getenv("GEMINI_MAX_CONCURRENCY", "16"))
+GEMINI_MAX_RETRIES = int(os.getenv("GEMINI_MAX_RETRIES", "4"))
+GEMINI_BREAKER_THRESHOLD = int(os.getenv("GEMINI_BREAKER_THRESHOLD", "5"))
+GEMINI_BREAKER_COOLDOWN = float(os.getenv("GEMINI_BREAKER_COOLDOWN", "30"))
+
+# Google Vision batching: images per batch_annotate_images call (API max 16, 1 = one call per image)
+# and a request size budget per call
+VISION_BATCH_SIZE = min(int(os.getenv("VISION_BATCH_SIZE", "16")), 16)
+VISION_BATCH_MAX_BYTES = int(os.getenv("VISION_BATCH_MAX_BYTES", str(8 * 1024 * 1024)))
+
+# OCR result cache: entries kept in the in-process LRU tier (the Postgres tier is unbounded, TTL-evicted)
+OCR_CACHE_SIZE = int(os.getenv("OCR_CACHE_SIZE", "2048"))
+
+# User context cache (tier + monthly counter per user): seconds an entry is trusted, and users kept.
+# Quota is enforced in the database, so the TTL only bounds how stale reads like /usage/stats can be
+USER_CONTEXT_TTL = float(os.getenv("USER_CONTEXT_TTL", "30"))
+USER_CONTEXT_SIZE = int(os.getenv("USER_CONTEXT_SIZE", "10000"))
+
+# Days to keep per-image checkpoints of batches submitted with a batch_id
+CHECKPOINT_RETENTION_DAYS = int(os.getenv("CHECKPOINT_RETENTION_DAYS", "7"))
+
+# Streaming uploads: bytes of each part kept in RAM before it spills to a temp file, and
+# parts / staged images allowed to wait for a worker before the request body stops being read
+STREAM_SPOOL_MEMORY = int(os.getenv("STREAM_SPOOL_MEMORY", str(1024 * 1024)))
+STREAM_QUEUE_SIZE = int(os.getenv("STREAM_QUEUE_SIZE", "8"))
+
+# Direct-to-S3 uploads: lifetime of presigned POST policies (seconds), largest accepted object,
+# and parallel S3 reads when a batch is processed from uploaded keys
+PRESIGN_EXPIRES = int(os.getenv("PRESIGN_EXPIRES", "900"))
+UPLOAD_MAX_BYTES = int(os.getenv("UPLOAD_MAX_BYTES", str(20 * 1024 * 1024)))
+S3_FETCH_WORKERS = int(os.getenv("S3_FETCH_WORKERS", "16"))
+
+# S3 transfers: objects from S3_MULTIPART_THRESHOLD bytes up go in S3_MULTIPART_CHUNKSIZE parts,
+# with up to S3_MAX_CONCURRENCY parts in flight (Excel exports stream into multipart uploads)
+S3_MULTIPART_THRESHOLD = int(os.getenv("S3_MULTIPART_THRESHOLD", str(8 * 1024 * 1024)))
+S3_MULTIPART_CHUNKSIZE = max(int(os.getenv("S3_MULTIPART_CHUNKSIZE", str(8 * 1024 * 1024))), 5 * 1024 * 1024)
+S3_MAX_CONCURRENCY = int(os.getenv("S3_MAX_CONCURRENCY", "8"))
+
 # Database Configuration
 DATABASE_URL = os.getenv("DATABASE_URL")
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", "2"))
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", "20"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "10"))  # seconds to wait for a free connection
+DB_POOL_PING_AFTER = float(os.getenv("DB_POOL_PING_AFTER", "30"))  # re-check connections idle longer than this
+
+# Usage log writer: events per multi-row INSERT, longest an event waits in memory (ms), and events
+# kept while the database is unreachable before the oldest are dropped
+USAGE_LOG_BATCH_SIZE = int(os.getenv("USAGE_LOG_BATCH_SIZE", "500"))
+USAGE_LOG_FLUSH_MS = int(os.getenv("USAGE_LOG_FLUSH_MS", "1000"))
+USAGE_LOG_MAX_BUFFERED = int(os.getenv("USAGE_LOG_MAX_BUFFERED", "50000"))
+# Largest /usage/logs page a client can ask for (also the rows per query of an NDJSON export)
+USAGE_LOGS_MAX_PAGE = int(os.getenv("USAGE_LOGS_MAX_PAGE", "500"))
+
+# Async batch jobs: "postgres" (shared state, any replica can answer) or "local" (in-process, for tests)
+JOB_BACKEND = os.getenv("JOB_BACKEND", "postgres")
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "4"))
+# Each replica touches its unfinished jobs every JOB_HEARTBEAT_SECONDS; queued/processing jobs nobody
+# touched for JOB_STALE_SECONDS (their replica crashed or was killed) are marked failed
+JOB_HEARTBEAT_SECONDS = int(os.getenv("JOB_HEARTBEAT_SECONDS", "30"))
+JOB_STALE_SECONDS = int(os.getenv("JOB_STALE_SECONDS", "300"))
 
 # AWS S3 Configuration
 AWS_ACCESS_KEY_ID = os.getenv("AWS_ACCESS_KEY_ID")
@@ -66,13 +185,28 @@ AWS_SECRET_ACCESS_KEY = os.getenv("AWS_SECRET_ACCESS_KEY")
 AWS_BUCKET_NAME = os.getenv("AWS_BUCKET_NAME")
 AWS_REGION = os.getenv("AWS_REGION", "us-east-1")
 
-# Initialize S3 client
+# Initialize S3 client, shared by every thread: one pooled connection per thread that can call it
+# (OCR workers, image uploads, key fetches, multipart parts), keep-alive, and retries with client-side throttling
 s3_client = boto3.client(
     's3',
     aws_access_key_id=AWS_ACCESS_KEY_ID,
     aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
-    region_name=AWS_REGION
+    region_name=AWS_REGION,
+    config=BotoConfig(
+        max_pool_connections=OCR_MAX_WORKERS + S3_UPLOAD_WORKERS + S3_FETCH_WORKERS + S3_MAX_CONCURRENCY,
+        tcp_keepalive=True,
+        retries={"max_attempts": 5, "mode": "adaptive"}
+    )
+)
+
+# Multipart transfers for large objects; smaller ones stay a single put_object on the calling thread
+s3_transfer_config = TransferConfig(
+    multipart_threshold=S3_MULTIPART_THRESHOLD,
+    multipart_chunksize=S3_MULTIPART_CHUNKSIZE,
+    max_concurrency=S3_MAX_CONCURRENCY
 )
+s3_transfer = create_transfer_manager(s3_client, s3_transfer_config)
+s3_part_executor = ThreadPoolExecutor(max_workers=S3_MAX_CONCURRENCY, thread_name_prefix="s3parts")
 
 # Initialize Google Vision (decode credentials from env)
 if GOOGLE_CREDENTIALS_JSON:
@@ -83,6 +217,22 @@ if GOOGLE_CREDENTIALS_JSON:
 
 vision_client = vision.ImageAnnotatorClient()
 
+# Worker threads for blocking SDK calls, so they never run on the event loop
+ocr_executor = ThreadPoolExecutor(max_workers=OCR_MAX_WORKERS, thread_name_prefix="ocr")
+
+# Keep-alive session + threads for thumbnail downloads from S3 (fallback path only)
+thumbnail_executor = ThreadPoolExecutor(max_workers=THUMBNAIL_FETCH_WORKERS, thread_name_prefix="thumbs")
+thumbnail_session = requests.Session()
+thumbnail_session.mount("https://", requests.adapters.HTTPAdapter(
+    pool_connections=THUMBNAIL_FETCH_WORKERS, pool_maxsize=THUMBNAIL_FETCH_WORKERS
+))
+
+# Threads for image uploads to S3, so OCR never waits for them to start
+s3_upload_executor = ThreadPoolExecutor(max_workers=S3_UPLOAD_WORKERS, thread_name_prefix="s3upload")
+
+# Threads for get_object calls when a batch is processed from presigned uploads
+s3_fetch_executor = ThreadPoolExecutor(max_workers=S3_FETCH_WORKERS, thread_name_prefix="s3fetch")
+
 # ===========================================
 # DICCIONARIOS DE NORMALIZACIÓN
 # ===========================================
@@ -131,6 +281,8 @@ UNIT_CORRECTIONS = {
     "M3": "m³", "CBM": "m³"
 }
 
+SIZE_MAP = {"S": "S", "M": "M", "L": "L", "XL": "XL", "XXL": "XXL"}
+
 INDUSTRY_KEYWORDS = {
     "fashion": ["camisa", "pantalon", "ropa", "talla", "composicion", "shirt", "clothing", "fabric"],
     "furniture": ["mueble", "silla", "mesa", "furniture", "chair", "alto", "ancho"],
@@ -154,45 +306,310 @@ TIER_CONFIGS = {
         "max_images_per_batch": 5,
         "ocr_engine": "google_vision",
         "retention_days": 3,
-        "max_suppliers": 1
+        "max_suppliers": 1,
+        "ocr_concurrency": 2
     },
     "starter": {
         "max_images": 200,
         "max_images_per_batch": 50,
         "ocr_engine": "google_vision",
         "retention_days": 30,
-        "max_suppliers": 3
+        "max_suppliers": 3,
+        "ocr_concurrency": 4
     },
     "basic": {
         "max_images": 500,
         "max_images_per_batch": 100,
         "ocr_engine": "google_vision",
         "retention_days": 30,
-        "max_suppliers": 3
+        "max_suppliers": 3,
+        "ocr_concurrency": 4
     },
     "pro": {
         "max_images": 2000,
         "max_images_per_batch": 200,
         "ocr_engine": "gemini",
         "retention_days": 90,
-        "max_suppliers": 5
+        "max_suppliers": 5,
+        "ocr_concurrency": 8
     },
     "enterprise": {
         "max_images": 10000,
         "max_images_per_batch": 500,
         "ocr_engine": "gemini",
         "retention_days": 90,
-        "max_suppliers": 999
+        "max_suppliers": 999,
+        "ocr_concurrency": 16
     }
 }
 
+# Thumbnail sizes, all rendered from a single decode: name -> (max size, format)
+THUMBNAIL_TARGETS = {
+    "excel": ((150, 150), "PNG"),
+    "supplier": ((300, 300), "JPEG")
+}
+
+# Pre-OCR resize per engine. Vision keeps more pixels for small print; Gemini tiles images at
+# 768px, so anything past two tiles per side only adds upload time.
+OCR_PREPROCESS_PROFILES = {
+    "google_vision": {"max_side": VISION_MAX_SIDE, "quality": VISION_JPEG_QUALITY},
+    "gemini": {"max_side": GEMINI_MAX_SIDE, "quality": GEMINI_JPEG_QUALITY}
+}
+
+# ===========================================
+# METRICS
+# ===========================================
+
+STAGE_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+# prepare / upload / upload_wait / ocr are observed once per image; the other stages once per batch
+STAGE_SECONDS = Histogram(
+    "ocrimageflow_stage_seconds", "Time spent in each batch pipeline stage",
+    ["stage", "engine", "tier"], buckets=STAGE_BUCKETS
+)
+IMAGES = Counter(
+    "ocrimageflow_images", "Batch images by outcome (ocr, cache_hit, restored, failed)",
+    ["engine", "tier", "outcome"]
+)
+BATCHES = Counter("ocrimageflow_batches", "Batches by final status", ["engine", "tier", "status"])
+DB_POOL_WAIT_SECONDS = Histogram(
+    "ocrimageflow_db_pool_wait_seconds", "Time spent waiting for a pooled Postgres connection", buckets=STAGE_BUCKETS
+)
+PASSWORD_HASH_SECONDS = Histogram(
+    "ocrimageflow_password_hash_seconds", "bcrypt hash/verify time including the wait for a worker",
+    ["op"], buckets=STAGE_BUCKETS
+)
+DB_CONNECTION_SECONDS = Histogram(
+    "ocrimageflow_db_connection_seconds", "Time a pooled Postgres connection was held", buckets=STAGE_BUCKETS
+)
+
+class RuntimeStatsCollector:
+    """Exports the counters db_pool, gemini_client, password_hasher and usage_log already keep, read at scrape time"""
+    
+    def describe(self):
+        # Registered before those objects exist, so don't let REGISTRY call collect() yet
+        return []
+    
+    def collect(self):
+        pool = db_pool.stats()
+        connections = GaugeMetricFamily(
+            "ocrimageflow_db_pool_connections", "Postgres pool connections by state", labels=["state"]
+        )
+        connections.add_metric(["in_use"], pool['in_use'])
+        connections.add_metric(["max"], pool['max_size'])
+        yield connections
+        yield GaugeMetricFamily("ocrimageflow_db_pool_waiting", "Threads waiting for a connection", value=pool['waiting'])
+        for name in ("checkouts", "timeouts", "discarded"):
+            yield CounterMetricFamily(f"ocrimageflow_db_pool_{name}", f"Postgres pool {name}", value=pool[name])
+        
+        gemini = gemini_client.stats()
+        yield GaugeMetricFamily("ocrimageflow_gemini_limit", "Gemini in-flight request limit (AIMD)", value=gemini['limit'])
+        yield GaugeMetricFamily("ocrimageflow_gemini_in_flight", "Gemini requests in flight", value=gemini['in_flight'])
+        breaker = GaugeMetricFamily("ocrimageflow_gemini_breaker", "Gemini circuit breaker state", labels=["state"])
+        for state in ("closed", "half_open", "open"):
+            breaker.add_metric([state], 1 if gemini['breaker'] == state else 0)
+        yield breaker
+        for name in ("requests", "retries", "throttled", "failures", "rejected"):
+            yield CounterMetricFamily(f"ocrimageflow_gemini_{name}", f"Gemini client {name}", value=gemini[name])
+        
+        hasher = password_hasher.stats()
+        yield GaugeMetricFamily("ocrimageflow_password_hash_pending", "bcrypt calls queued or running", value=hasher['pending'])
+        yield CounterMetricFamily(
+            "ocrimageflow_password_hash_rejected", "bcrypt calls rejected with 503 (queue full)", value=hasher['rejected']
+        )
+        
+        usage = usage_log.stats()
+        yield GaugeMetricFamily("ocrimageflow_usage_log_buffered", "Usage events waiting to be written", value=usage['buffered'])
+        for name, documentation in (
+            ("written", "Usage events written to usage_logs"),
+            ("dropped", "Usage events dropped (buffer full, rejected row or logged after shutdown)"),
+            ("flush_failures", "Usage log flushes that failed and were retried")
+        ):
+            yield CounterMetricFamily(f"ocrimageflow_usage_log_{name}", documentation, value=usage[name])
+
+REGISTRY.register(RuntimeStatsCollector())
+
+class StageTimer:
+    """
+    Wall time per stage of one batch: observed into STAGE_SECONDS with the batch's engine and tier,
+    and kept (summed per stage) for usage_logs.details so slow batches can be looked at later
+    """
+    
+    def __init__(self, engine: str, tier: str):
+        self.engine = engine
+        self.tier = tier
+        self.seconds = {}
+    
+    @contextmanager
+    def stage(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.seconds[name] = self.seconds.get(name, 0.0) + elapsed
+            STAGE_SECONDS.labels(name, self.engine, self.tier).observe(elapsed)
+    
+    def observe_image(self, ocr_stats: dict):
+        """Per-image stage timings from process_image's ocr_stats (histograms only)"""
+        for stage in ("prepare", "upload", "upload_wait", "ocr"):
+            if f"{stage}_ms" in ocr_stats:
+                STAGE_SECONDS.labels(stage, self.engine, self.tier).observe(ocr_stats[f"{stage}_ms"] / 1000)
+    
+    def as_dict(self) -> dict:
+        return {name: round(seconds, 3) for name, seconds in self.seconds.items()}
+
 # ===========================================
 # DATABASE CONNECTION
 # ===========================================
 
-def get_db_connection():
-    conn = psycopg2.connect(DATABASE_URL, cursor_factory=RealDictCursor)
-    return conn
+class DatabasePool:
+    """
+    Shared pool of Postgres connections.
+    Waits (up to DB_POOL_TIMEOUT) instead of failing when every connection is busy,
+    pings connections that sat idle before handing them out, and counts saturation.
+    """
+    
+    def __init__(self, dsn: str, minconn: int, maxconn: int, timeout: float, ping_after: float):
+        self.dsn = dsn
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.ping_after = ping_after
+        self._pool = None
+        self._slots = threading.BoundedSemaphore(maxconn)
+        self._lock = threading.Lock()
+        self._returned_at = {}
+        self._checked_out_at = {}
+        self.in_use = 0
+        self.waiting = 0
+        self.checkouts = 0
+        self.timeouts = 0
+        self.discarded = 0
+    
+    def _get_pool(self) -> ThreadedConnectionPool:
+        # Created lazily so importing the app never needs a database
+        with self._lock:
+            if self._pool is None:
+                self._pool = ThreadedConnectionPool(
+                    self.minconn, self.maxconn, self.dsn, cursor_factory=RealDictCursor
+                )
+            return self._pool
+    
+    def _is_healthy(self, conn) -> bool:
+        if conn.closed:
+            return False
+        # Brand new connections and recently used ones are trusted without a round-trip
+        idle_since = self._returned_at.get(id(conn))
+        if idle_since is None or time.monotonic() - idle_since < self.ping_after:
+            return True
+        try:
+            cursor = conn.cursor()
+            cursor.execute("SELECT 1")
+            cursor.close()
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+    
+    def getconn(self):
+        with self._lock:
+            self.waiting += 1
+        start = time.perf_counter()
+        acquired = self._slots.acquire(timeout=self.timeout)
+        DB_POOL_WAIT_SECONDS.observe(time.perf_counter() - start)
+        with self._lock:
+            self.waiting -= 1
+            if not acquired:
+                self.timeouts += 1
+        if not acquired:
+            raise HTTPException(status_code=503, detail="Database busy, try again")
+        
+        try:
+            pool = self._get_pool()
+            conn = pool.getconn()
+            if not self._is_healthy(conn):
+                self._returned_at.pop(id(conn), None)
+                pool.putconn(conn, close=True)
+                with self._lock:
+                    self.discarded += 1
+                conn = pool.getconn()
+        except psycopg2.Error as e:
+            self._slots.release()
+            raise HTTPException(status_code=503, detail=f"Database connection failed: {str(e)}")
+        except Exception:
+            self._slots.release()
+            raise
+        
+        with self._lock:
+            self.in_use += 1
+            self.checkouts += 1
+        self._checked_out_at[id(conn)] = time.perf_counter()
+        return conn
+    
+    def putconn(self, conn):
+        try:
+            if not conn.closed and conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                conn.rollback()
+        except psycopg2.Error:
+            pass
+        finally:
+            checked_out_at = self._checked_out_at.pop(id(conn), None)
+            if checked_out_at is not None:
+                DB_CONNECTION_SECONDS.observe(time.perf_counter() - checked_out_at)
+            broken = bool(conn.closed)
+            if broken:
+                self._returned_at.pop(id(conn), None)
+            else:
+                self._returned_at[id(conn)] = time.monotonic()
+            self._get_pool().putconn(conn, close=broken)
+            with self._lock:
+                self.in_use -= 1
+            self._slots.release()
+    
+    @contextmanager
+    def connection(self):
+        """Borrow a connection for a `with` block (for code outside request handlers)"""
+        conn = self.getconn()
+        try:
+            yield conn
+        finally:
+            self.putconn(conn)
+    
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "max_size": self.maxconn,
+                "in_use": self.in_use,
+                "waiting": self.waiting,
+                "saturation": round(self.in_use / self.maxconn, 3),
+                "checkouts": self.checkouts,
+                "timeouts": self.timeouts,
+                "discarded": self.discarded
+            }
+    
+    def close(self):
+        with self._lock:
+            if self._pool is not None:
+                self._pool.closeall()
+                self._pool = None
+
+db_pool = DatabasePool(DATABASE_URL, DB_POOL_MIN, DB_POOL_MAX, DB_POOL_TIMEOUT, DB_POOL_PING_AFTER)
+
+def get_db():
+    """FastAPI dependency: lend a pooled connection for the duration of the request"""
+    conn = db_pool.getconn()
+    try:
+        yield conn
+    finally:
+        db_pool.putconn(conn)
+
+@app.on_event("shutdown")
+def close_db_pool():
+    # Fail unfinished jobs and write out buffered usage logs while the pool is still open
+    job_runner.shutdown()
+    usage_log.close()
+    db_pool.close()
 
 # ===========================================
 # PYDANTIC MODELS
@@ -208,6 +625,17 @@ class UserLogin(BaseModel):
     email: EmailStr
     password: str
 
+class PresignFile(BaseModel):
+    filename: str
+    content_type: str = "image/jpeg"
+
+class PresignRequest(BaseModel):
+    files: List[PresignFile]
+
+class ProcessKeysRequest(BaseModel):
+    keys: List[str]
+    batch_id: Optional[str] = None
+
 class ProcessResponse(BaseModel):
     status: str
     images_processed: int
@@ -219,11 +647,79 @@ class ProcessResponse(BaseModel):
 # HELPER FUNCTIONS
 # ===========================================
 
-def hash_password(password: str) -> str:
-    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
+async def gather_or_cancel(coroutines) -> list:
+    """asyncio.gather that cancels the remaining coroutines as soon as one fails"""
+    tasks = [asyncio.ensure_future(coroutine) for coroutine in coroutines]
+    try:
+        return await asyncio.gather(*tasks)
+    except Exception:
+        # Don't start OCR calls that nobody is going to use
+        for task in tasks:
+            task.cancel()
+        raise
+
+class PasswordHasher:
+    """
+    bcrypt (hundreds of ms of CPU per call) on a small spawned process pool, so a login storm never
+    ties up the request threadpool or the API's cores. At most max_pending calls can be queued or
+    running; past that new ones are rejected right away with 503 instead of queueing for seconds.
+    Workers only import passwords.py.
+    """
+    
+    def __init__(self, processes: int, max_pending: int, rounds: int):
+        self.processes = processes
+        self.max_pending = max_pending
+        self.rounds = rounds
+        self._pool = None
+        self._lock = threading.Lock()
+        # Only touched from the event loop
+        self.pending = 0
+        self.rejected = 0
+    
+    def _get_pool(self) -> ProcessPoolExecutor:
+        with self._lock:
+            if self._pool is None:
+                self._pool = ProcessPoolExecutor(
+                    max_workers=self.processes, mp_context=multiprocessing.get_context("spawn")
+                )
+            return self._pool
+    
+    async def _run(self, op: str, fn, *args):
+        if self.pending >= self.max_pending:
+            self.rejected += 1
+            raise HTTPException(
+                status_code=503, detail="Too many sign-ins in progress, try again", headers={"Retry-After": "1"}
+            )
+        self.pending += 1
+        start = time.perf_counter()
+        try:
+            return await asyncio.wrap_future(self._get_pool().submit(fn, *args))
+        finally:
+            self.pending -= 1
+            PASSWORD_HASH_SECONDS.labels(op).observe(time.perf_counter() - start)
+    
+    async def hash(self, password: str) -> str:
+        return await self._run("hash", hash_password, password, self.rounds)
+    
+    async def check(self, password: str, hashed: str):
+        """(matches, new_hash); new_hash is set when hashed used an older work factor and should be replaced"""
+        return await self._run("verify", check_password, password, hashed, self.rounds)
+    
+    def stats(self) -> dict:
+        return {"processes": self.processes, "pending": self.pending, "max_pending": self.max_pending,
+                "rejected": self.rejected}
+    
+    def close(self):
+        with self._lock:
+            if self._pool is not None:
+                self._pool.shutdown(cancel_futures=True)
+                self._pool = None
+
+password_hasher = PasswordHasher(BCRYPT_PROCESSES, BCRYPT_MAX_PENDING, BCRYPT_ROUNDS)
 
-def verify_password(password: str, hashed: str) -> bool:
-    return bcrypt.checkpw(password.encode('utf-8'), hashed.encode('utf-8'))
+@app.on_event("shutdown")
+def close_password_hasher():
+    password_hasher.close()
 
 def create_access_token(data: dict) -> str:
     to_encode = data.copy()
@@ -244,46 +740,513 @@ def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(securit
     except jwt.JWTError:
         raise HTTPException(status_code=401, detail="Invalid token")
 
+metrics_security = HTTPBearer(auto_error=False)
+
+def require_metrics_token(credentials: Optional[HTTPAuthorizationCredentials] = Depends(metrics_security)):
+    """Only scrapers holding METRICS_TOKEN get /metrics; with no token configured it doesn't exist"""
+    if not METRICS_TOKEN:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if credentials is None or not secrets.compare_digest(credentials.credentials.encode(), METRICS_TOKEN.encode()):
+        raise HTTPException(status_code=401, detail="Invalid metrics token")
+
+class UsageLogWriter:
+    """
+    Buffered usage_logs writer. log() only appends the event to an in-memory buffer; a background
+    thread writes the buffer with one multi-row INSERT every batch_size events or flush_interval
+    seconds, whichever comes first. created_at is the time the event was logged, not written.
+    While the database is unreachable events stay buffered and are retried; past max_buffered
+    the oldest are dropped (and counted). Rows the database rejects are dropped one by one so
+    they never hold up the rest. close() writes whatever is left.
+    """
+    
+    # Errors that mean the database went away, not that a row is bad: the whole page is retried
+    CONNECTION_ERRORS = (psycopg2.OperationalError, psycopg2.InterfaceError)
+    
+    # Each page of events is one statement, so the rollup_usage_logs trigger folds it into the rollups in one pass
+    INSERT = "INSERT INTO usage_logs (user_id, action, details, images_processed, cost, created_at) VALUES %s"
+    # The age is applied by Postgres, so created_at stays on the database's clock like the column default
+    TEMPLATE = "(%s, %s, %s, %s, %s, CURRENT_TIMESTAMP - %s * INTERVAL '1 second')"
+    
+    def __init__(self, batch_size: int, flush_interval: float, max_buffered: int):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_buffered = max_buffered
+        self._buffer = deque()
+        self._cond = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._thread = None
+        self._closed = False
+        self._written = 0
+        self._dropped = 0
+        self._failures = 0
+    
+    def log(self, user_id: int, action: str, details: Optional[dict] = None):
+        event = (
+            user_id, action, json.dumps(details) if details else None,
+            details.get('images_processed', 0) if details else 0,
+            details.get('cost', 0.0) if details else 0.0,
+            time.monotonic()
+        )
+        with self._cond:
+            if self._closed:
+                self._dropped += 1
+                return
+            self._buffer.append(event)
+            self._trim()
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="usage-log-writer", daemon=True)
+                self._thread.start()
+            if len(self._buffer) >= self.batch_size:
+                self._cond.notify()
+    
+    def _trim(self):
+        while len(self._buffer) > self.max_buffered:
+            self._buffer.popleft()
+            self._dropped += 1
+    
+    def _run(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(
+                    lambda: self._closed or len(self._buffer) >= self.batch_size, timeout=self.flush_interval
+                )
+                closed = self._closed
+            if closed:
+                return
+            if not self.flush():
+                # Back off instead of spinning on a full buffer while the database is down
+                with self._cond:
+                    self._cond.wait_for(lambda: self._closed, timeout=self.flush_interval)
+    
+    def _insert(self, cursor, events: list):
+        now = time.monotonic()
+        execute_values(
+            cursor, self.INSERT, [event[:5] + (now - event[5],) for event in events],
+            template=self.TEMPLATE, page_size=self.batch_size
+        )
+    
+    def flush(self) -> bool:
+        """Write everything buffered so far (blocking). Returns False if it had to be put back"""
+        with self._flush_lock:
+            with self._cond:
+                events = list(self._buffer)
+                self._buffer.clear()
+            if not events:
+                return True
+            
+            dropped = 0
+            try:
+                with db_pool.connection() as conn:
+                    cursor = conn.cursor()
+                    try:
+                        try:
+                            self._insert(cursor, events)
+                        except self.CONNECTION_ERRORS:
+                            raise
+                        except psycopg2.Error:
+                            # One bad row (its user deleted meanwhile, a value the column rejects)
+                            # must not block the rest
+                            conn.rollback()
+                            for event in events:
+                                cursor.execute("SAVEPOINT usage_event")
+                                try:
+                                    self._insert(cursor, [event])
+                                except self.CONNECTION_ERRORS:
+                                    raise
+                                except psycopg2.Error as e:
+                                    cursor.execute("ROLLBACK TO SAVEPOINT usage_event")
+                                    print(f"Usage log row rejected ({event[1]} for user {event[0]}): {e}")
+                                    dropped += 1
+                        conn.commit()
+                    finally:
+                        cursor.close()
+            except Exception as e:
+                print(f"Usage log flush failed, {len(events)} events kept for retry: {e}")
+                with self._cond:
+                    self._failures += 1
+                    self._buffer.extendleft(reversed(events))
+                    self._trim()
+                return False
+            
+            with self._cond:
+                self._written += len(events) - dropped
+                self._dropped += dropped
+            return True
+    
+    def stats(self) -> dict:
+        with self._cond:
+            return {
+                "buffered": len(self._buffer),
+                "written": self._written,
+                "dropped": self._dropped,
+                "flush_failures": self._failures
+            }
+    
+    def close(self):
+        """Stop the flusher and write what is still buffered; later events are dropped"""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+            thread = self._thread
+        if thread is not None:
+            thread.join()
+        self.flush()
+
+usage_log = UsageLogWriter(USAGE_LOG_BATCH_SIZE, USAGE_LOG_FLUSH_MS / 1000, USAGE_LOG_MAX_BUFFERED)
+
+def log_usage(user_id: int, action: str, details: Optional[dict] = None):
+    """Log user actions to usage_logs (buffered: returns right away, usage_log writes it in the background)"""
+    usage_log.log(user_id, action, details)
+
+# ===========================================
+# S3 TRANSFERS
+# ===========================================
+
+def s3_object_url(key: str) -> str:
+    return f"https://{AWS_BUCKET_NAME}.s3.{AWS_REGION}.amazonaws.com/{key}"
+
+def s3_user_key(user_id: int, filename: str) -> str:
+    return f"user_{user_id}/{uuid.uuid4()}_{filename}"
+
 def upload_to_s3(file_content: bytes, filename: str, user_id: int, content_type: str) -> str:
-    """Upload file to S3 and return the URL"""
+    """
+    Upload file to S3 and return the URL. Files from S3_MULTIPART_THRESHOLD up go through
+    the shared transfer manager as concurrent multipart parts.
+    """
     try:
-        unique_filename = f"user_{user_id}/{uuid.uuid4()}_{filename}"
+        unique_filename = s3_user_key(user_id, filename)
         
-        s3_client.put_object(
-            Bucket=AWS_BUCKET_NAME,
-            Key=unique_filename,
-            Body=file_content,
-            ContentType=content_type
-        )
+        if len(file_content) < S3_MULTIPART_THRESHOLD:
+            s3_client.put_object(
+                Bucket=AWS_BUCKET_NAME,
+                Key=unique_filename,
+                Body=file_content,
+                ContentType=content_type
+            )
+        else:
+            s3_transfer.upload(
+                BytesIO(file_content), AWS_BUCKET_NAME, unique_filename,
+                extra_args={"ContentType": content_type}
+            ).result()
         
-        return f"https://{AWS_BUCKET_NAME}.s3.{AWS_REGION}.amazonaws.com/{unique_filename}"
+        return s3_object_url(unique_filename)
     except ClientError as e:
         raise HTTPException(status_code=500, detail=f"S3 upload failed: {str(e)}")
 
-def log_usage(user_id: int, action: str, details: Optional[dict] = None):
-    """Log user actions to database"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    try:
-        cursor.execute(
-            "INSERT INTO usage_logs (user_id, action, details, images_processed, cost) VALUES (%s, %s, %s, %s, %s)",
-            (user_id, action, json.dumps(details) if details else None, 
-             details.get('images_processed', 0) if details else 0,
-             details.get('cost', 0.0) if details else 0.0)
+class S3MultipartWriter:
+    """
+    Write-only file object that streams into an S3 object, for writers that produce large
+    output (the Excel export). Every S3_MULTIPART_CHUNKSIZE bytes written become a multipart
+    part, uploaded on s3_part_executor while writing goes on, with at most S3_MAX_CONCURRENCY
+    parts in flight. Output smaller than one part goes up as a single put_object.
+    Not seekable: zipfile (openpyxl) falls back to streaming mode with data descriptors.
+    """
+    
+    def __init__(self, key: str, content_type: str):
+        self.key = key
+        self.content_type = content_type
+        self.closed = False
+        self._buffer = bytearray()
+        self._position = 0
+        self._upload_id = None
+        self._parts = []
+        self._slots = threading.Semaphore(S3_MAX_CONCURRENCY)
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+    
+    def write(self, data) -> int:
+        self._buffer += data
+        self._position += len(data)
+        while len(self._buffer) >= S3_MULTIPART_CHUNKSIZE:
+            self._submit(bytes(self._buffer[:S3_MULTIPART_CHUNKSIZE]))
+            del self._buffer[:S3_MULTIPART_CHUNKSIZE]
+        return len(data)
+    
+    def tell(self) -> int:
+        return self._position
+    
+    def seekable(self) -> bool:
+        return False
+    
+    def flush(self):
+        pass
+    
+    def _submit(self, data: bytes):
+        if self._upload_id is None:
+            self._upload_id = s3_client.create_multipart_upload(
+                Bucket=AWS_BUCKET_NAME, Key=self.key, ContentType=self.content_type
+            )['UploadId']
+        # Blocks the writer once S3_MAX_CONCURRENCY parts are queued, which bounds memory
+        self._slots.acquire()
+        future = s3_part_executor.submit(self._upload_part, len(self._parts) + 1, data)
+        future.add_done_callback(lambda _: self._slots.release())
+        self._parts.append(future)
+    
+    def _upload_part(self, number: int, data: bytes) -> dict:
+        response = s3_client.upload_part(
+            Bucket=AWS_BUCKET_NAME, Key=self.key, UploadId=self._upload_id, PartNumber=number, Body=data
         )
-        conn.commit()
-    finally:
-        cursor.close()
-        conn.close()
+        return {"PartNumber": number, "ETag": response['ETag']}
+    
+    def close(self):
+        """Upload what is left and complete the object (blocking)"""
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            if self._upload_id is None:
+                s3_client.put_object(
+                    Bucket=AWS_BUCKET_NAME, Key=self.key, Body=bytes(self._buffer), ContentType=self.content_type
+                )
+                return
+            if self._buffer:
+                self._submit(bytes(self._buffer))
+            parts = [future.result() for future in self._parts]
+            s3_client.complete_multipart_upload(
+                Bucket=AWS_BUCKET_NAME, Key=self.key, UploadId=self._upload_id, MultipartUpload={"Parts": parts}
+            )
+        except Exception:
+            self.abort()
+            raise
+        finally:
+            self._buffer = bytearray()
+    
+    def abort(self):
+        """Drop the upload so S3 doesn't keep (and bill) orphaned parts"""
+        self.closed = True
+        self._buffer = bytearray()
+        if self._upload_id is None:
+            return
+        for future in self._parts:
+            future.cancel()
+        try:
+            s3_client.abort_multipart_upload(Bucket=AWS_BUCKET_NAME, Key=self.key, UploadId=self._upload_id)
+        except ClientError as e:
+            print(f"Error aborting multipart upload of {self.key}: {e}")
+        self._upload_id = None
+
+@app.on_event("shutdown")
+def close_s3_transfers():
+    s3_transfer.shutdown()
+    s3_part_executor.shutdown(wait=False, cancel_futures=True)
+
+def upload_image(image_bytes: bytes, filename: str, user_id: int, content_type: str):
+    """
+    upload_to_s3 for the archival copy of a batch image (runs on s3_upload_executor), retried
+    S3_UPLOAD_RETRIES times. Returns (image_url, upload_ms)
+    """
+    start = time.perf_counter()
+    for attempt in range(S3_UPLOAD_RETRIES + 1):
+        try:
+            image_url = upload_to_s3(image_bytes, filename, user_id, content_type)
+            break
+        except HTTPException as e:
+            if attempt == S3_UPLOAD_RETRIES:
+                raise
+            print(f"Upload of {filename} failed, retrying: {e.detail}")
+    return image_url, round((time.perf_counter() - start) * 1000, 1)
+
+def discard_upload(upload_future: Optional[Future]):
+    """
+    Drop the archival copy of an image that won't be part of its batch (staging or OCR failed):
+    cancel the upload if it hasn't started, otherwise delete the object once it lands
+    """
+    if upload_future is None or upload_future.cancel():
+        return
+    upload_future.add_done_callback(delete_upload)
+
+def delete_upload(upload_future: Future):
+    """discard_upload callback: delete what upload_image created, or log why there is nothing to delete"""
+    error = upload_future.exception()
+    if error is not None:
+        print(f"Upload of a discarded image failed: {error.detail if isinstance(error, HTTPException) else error}")
+        return
+    key = upload_future.result()[0][len(s3_object_url("")):]
+    try:
+        s3_client.delete_object(Bucket=AWS_BUCKET_NAME, Key=key)
+    except ClientError as e:
+        print(f"Error deleting orphaned upload {key}: {e}")
+
+def presign_upload(user_id: int, filename: str, content_type: str) -> dict:
+    """
+    Presigned POST policy for uploading one image straight to S3 under user_{id}/uploads/.
+    S3 itself rejects the upload if the Content-Type differs or it is over UPLOAD_MAX_BYTES.
+    """
+    name = os.path.basename(filename.replace("\\", "/")) or "image"
+    key = f"user_{user_id}/uploads/{uuid.uuid4()}_{name}"
+    post = s3_client.generate_presigned_post(
+        Bucket=AWS_BUCKET_NAME,
+        Key=key,
+        Fields={"Content-Type": content_type},
+        Conditions=[{"Content-Type": content_type}, ["content-length-range", 1, UPLOAD_MAX_BYTES]],
+        ExpiresIn=PRESIGN_EXPIRES
+    )
+    return {"key": key, "url": post['url'], "fields": post['fields']}
+
+def fetch_upload(key: str) -> tuple:
+    """
+    Read a presigned upload back from S3 (blocking, runs on s3_fetch_executor).
+    Returns a (bytes, filename, content_type, image_url) batch entry; the object stays where
+    it is and becomes the image's S3 copy, so the pipeline doesn't upload it again.
+    """
+    try:
+        obj = s3_client.get_object(Bucket=AWS_BUCKET_NAME, Key=key)
+    except ClientError as e:
+        if e.response['Error']['Code'] in ("NoSuchKey", "404"):
+            raise HTTPException(status_code=400, detail=f"Upload not found: {key}")
+        raise HTTPException(status_code=500, detail=f"S3 download failed: {str(e)}")
+    
+    with obj['Body'] as body:
+        if obj['ContentLength'] > UPLOAD_MAX_BYTES:
+            raise HTTPException(status_code=413, detail=f"Upload too large: {key}")
+        content = body.read()
+    filename = key.rsplit("/", 1)[-1].split("_", 1)[-1]
+    return (content, filename, obj.get('ContentType') or 'image/jpeg', s3_object_url(key))
 
 # ===========================================
 # DATA NORMALIZER
 # ===========================================
 
+TOKEN_PATTERN = re.compile(r"\w+")
+PRICE_PATTERN = re.compile(r"\d+\.?\d*")
+WEIGHT_PATTERN = re.compile(r"(\d+\.?\d*)\s*([a-zA-Z]+)")
+
+# All UNIT_CORRECTIONS spellings in one alternation, longest first so "lbs" beats "lb" and "m3" beats "m"
+UNIT_LOOKUP = {wrong.lower(): correct for wrong, correct in UNIT_CORRECTIONS.items()}
+UNIT_PATTERN = re.compile("|".join(re.escape(u) for u in sorted(UNIT_LOOKUP, key=len, reverse=True)))
+
+def clean_field_name(raw_name: str) -> str:
+    return raw_name.lower().strip().replace("$", "").replace(":", "").replace("_", " ").strip()
+
+class FieldNameIndex:
+    """
+    FIELD_NORMALIZATION compiled once for fast, order-independent lookups:
+    1. exact match on the cleaned name
+    2. dictionary keys found inside the name, as whole tokens or (Aho-Corasick) substrings;
+       the longest key wins, then the leftmost, then dictionary order
+    3. the name is a fragment of a key ("alt" -> "altura"); the shortest such key wins
+    Keys shorter than MIN_SUBSTRING_LEN ("h", "w", "l", "m3") only match exactly or as whole tokens.
+    """
+    
+    MIN_SUBSTRING_LEN = 3
+    _compiled = {}
+    
+    def __init__(self, field_map: dict):
+        self.exact = {}
+        self.rank = {}
+        for position, (key, normalized) in enumerate(field_map.items()):
+            clean_key = clean_field_name(key)
+            if clean_key and clean_key not in self.exact:
+                self.exact[clean_key] = normalized
+                self.rank[clean_key] = position
+        
+        long_keys = [k for k in self.exact if len(k) >= self.MIN_SUBSTRING_LEN]
+        self._build_automaton(long_keys)
+        
+        # Every fragment of a key -> the shortest key containing it
+        self.fragments = {}
+        for key in sorted(long_keys, key=lambda k: (len(k), self.rank[k])):
+            for start in range(len(key)):
+                for end in range(start + self.MIN_SUBSTRING_LEN, len(key) + 1):
+                    self.fragments.setdefault(key[start:end], key)
+        
+        self.lookup = lru_cache(maxsize=65536)(self._lookup)
+    
+    @classmethod
+    def for_map(cls, field_map: dict) -> "FieldNameIndex":
+        """Return the compiled index for this dictionary, rebuilding only if its contents changed"""
+        snapshot = tuple(field_map.items())
+        index = cls._compiled.get(snapshot)
+        if index is None:
+            index = cls._compiled[snapshot] = cls(field_map)
+        return index
+    
+    def _build_automaton(self, keys: List[str]):
+        self.goto = [{}]
+        self.fail = [0]
+        self.output = [[]]
+        for key in keys:
+            node = 0
+            for ch in key:
+                if ch not in self.goto[node]:
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.output.append([])
+                    self.goto[node][ch] = len(self.goto) - 1
+                node = self.goto[node][ch]
+            self.output[node].append(key)
+        
+        queue = deque(self.goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for ch, child in self.goto[node].items():
+                queue.append(child)
+                fallback = self.fail[node]
+                while fallback and ch not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[child] = self.goto[fallback].get(ch, 0) if node else 0
+                self.output[child] = self.output[child] + self.output[self.fail[child]]
+        
+        # Flatten goto + fail links into a DFA so scanning is one dict lookup per character
+        alphabet = {ch for edges in self.goto for ch in edges}
+        self.delta = [dict(edges) for edges in self.goto]
+        for node in self._bfs_order():
+            for ch in alphabet:
+                if ch not in self.delta[node]:
+                    self.delta[node][ch] = self.delta[self.fail[node]].get(ch, 0) if node else 0
+    
+    def _bfs_order(self):
+        order, queue = [], deque([0])
+        while queue:
+            node = queue.popleft()
+            order.append(node)
+            queue.extend(self.goto[node].values())
+        return order
+    
+    def _substring_hits(self, text: str) -> List[tuple]:
+        hits = []
+        delta, output = self.delta, self.output
+        node = 0
+        for i, ch in enumerate(text):
+            node = delta[node].get(ch, 0)
+            if output[node]:
+                hits.extend((i - len(key) + 1, key) for key in output[node])
+        return hits
+    
+    def _lookup(self, raw_name: str) -> str:
+        clean = clean_field_name(raw_name)
+        if clean in self.exact:
+            return self.exact[clean]
+        
+        hits = self._substring_hits(clean)
+        if not hits:
+            # Short keys can't beat a substring hit, so whole tokens only matter without one
+            hits = [
+                (token.start(), token.group()) for token in TOKEN_PATTERN.finditer(clean)
+                if token.group() in self.exact
+            ]
+        if hits:
+            _, key = min(hits, key=lambda hit: (-len(hit[1]), hit[0], self.rank[hit[1]]))
+            return self.exact[key]
+        
+        key = self.fragments.get(clean)
+        if key:
+            return self.exact[key]
+        
+        return clean.replace(" ", "_")
+
 class DataNormalizer:
     def __init__(self):
         self.field_map = FIELD_NORMALIZATION
         self.unit_map = UNIT_CORRECTIONS
+        self.field_index = FieldNameIndex.for_map(self.field_map)
     
     def detect_industry(self, raw_data):
         text = " ".join([str(v).lower() for v in raw_data.values()])
@@ -292,36 +1255,48 @@ class DataNormalizer:
         return max(scores, key=scores.get) if max(scores.values()) > 0 else "general"
     
     def normalize_field_name(self, raw_name):
-        clean = raw_name.lower().strip().replace("$", "").replace(":", "").replace("_", " ").strip()
-        for key, normalized in self.field_map.items():
-            if key in clean or clean in key:
-                return normalized
-        return clean.replace(" ", "_")
+        return self.field_index.lookup(raw_name)
+    
+    @staticmethod
+    def _normalize_price(value_str):
+        match = PRICE_PATTERN.search(value_str)
+        return f"${float(match.group()):.2f}" if match else value_str
+    
+    @staticmethod
+    def _normalize_weight(value_str):
+        corrected, replacements = UNIT_PATTERN.subn(lambda m: UNIT_LOOKUP[m.group()], value_str.lower())
+        if replacements:
+            value_str = corrected
+        match = WEIGHT_PATTERN.search(value_str)
+        return f"{match.group(1)} {UNIT_CORRECTIONS.get(match.group(2).upper(), match.group(2).lower())}" if match else value_str
+    
+    @staticmethod
+    def _normalize_size(value_str):
+        return SIZE_MAP.get(value_str.upper(), value_str.upper())
+    
+    @staticmethod
+    def _normalize_text(value_str):
+        return value_str.capitalize()
+    
+    @staticmethod
+    @lru_cache(maxsize=65536)
+    def value_kind(field_name):
+        """Kind of value ("price", "weight", ...) for a normalized field name, bounded like FieldNameIndex.lookup"""
+        if "precio" in field_name or "price" in field_name:
+            return "price"
+        if "peso" in field_name or "weight" in field_name:
+            return "weight"
+        if "talla" in field_name or "size" in field_name:
+            return "size"
+        return "text"
     
     def normalize_value(self, field_name, value, industry="general"):
         if not value:
             return ""
         value_str = str(value).strip()
-        
-        if "precio" in field_name or "price" in field_name:
-            numbers = re.findall(r'\d+\.?\d*', value_str)
-            return f"${float(numbers[0]):.2f}" if numbers else value_str
-        
-        elif "peso" in field_name or "weight" in field_name:
-            for wrong, correct in self.unit_map.items():
-                if wrong.lower() in value_str.lower():
-                    value_str = value_str.lower().replace(wrong.lower(), correct)
-            match = re.search(r'(\d+\.?\d*)\s*([a-zA-Z]+)', value_str)
-            return f"{match.group(1)} {self.unit_map.get(match.group(2).upper(), match.group(2).lower())}" if match else value_str
-        
-        elif "talla" in field_name or "size" in field_name:
-            size_map = {"S": "S", "M": "M", "L": "L", "XL": "XL", "XXL": "XXL"}
-            return size_map.get(value_str.upper(), value_str.upper())
-        
-        elif "color" in field_name:
-            return value_str.capitalize()
-        
-        return value_str.capitalize() if value_str else value_str
+        if not value_str:
+            return value_str
+        return getattr(self, f"_normalize_{self.value_kind(field_name)}")(value_str)
     
     def normalize_data(self, raw_data, industry=None):
         if not industry:
@@ -336,40 +1311,321 @@ class DataNormalizer:
         
         return normalized, industry
 
+# ===========================================
+# IMAGE PROCESSING
+# ===========================================
+
+class ImageService:
+    """
+    Runs image decoding, resizing and encoding on a process pool sized to the machine's cores,
+    so that work never holds the GIL of the API process. Workers are spawned and only import imaging.py.
+    """
+    
+    def __init__(self, processes: int):
+        self.processes = processes
+        self._pool = None
+        self._lock = threading.Lock()
+    
+    def _get_pool(self) -> ProcessPoolExecutor:
+        with self._lock:
+            if self._pool is None:
+                self._pool = ProcessPoolExecutor(
+                    max_workers=self.processes, mp_context=multiprocessing.get_context("spawn")
+                )
+            return self._pool
+    
+    def submit_thumbnails(self, image_bytes: bytes, names=("excel",)):
+        """Start rendering the THUMBNAIL_TARGETS in names; the future resolves to {name: bytes or None}"""
+        targets = {name: THUMBNAIL_TARGETS[name] for name in names}
+        return self._get_pool().submit(render_thumbnails, image_bytes, targets)
+    
+    def render_thumbnails(self, image_bytes: bytes, names=("excel",)) -> dict:
+        return self.submit_thumbnails(image_bytes, names).result()
+    
+    def submit_prepare(self, image_bytes: bytes, engine: str, names=("excel",)):
+        """
+        Start preparing image_bytes for the OCR engine (see imaging.prepare_image) and rendering the
+        thumbnails in names from the same decode
+        """
+        profile = OCR_PREPROCESS_PROFILES[engine]
+        targets = {name: THUMBNAIL_TARGETS[name] for name in names}
+        return self._get_pool().submit(
+            prepare_image, image_bytes, profile['max_side'], profile['quality'], targets
+        )
+    
+    def close(self):
+        with self._lock:
+            if self._pool is not None:
+                self._pool.shutdown(cancel_futures=True)
+                self._pool = None
+
+image_service = ImageService(IMAGE_PROCESSES)
+
+@app.on_event("shutdown")
+def close_image_service():
+    image_service.close()
+
 # ===========================================
 # OCR ENGINES
 # ===========================================
 
+def vision_result(response) -> dict:
+    """OCR result from one AnnotateImageResponse"""
+    if response.error.message:
+        raise Exception(response.error.message)
+    
+    texts = response.text_annotations
+    if not texts:
+        return {"text": "", "confidence": 0, "structured_data": {}, "engine": "google_vision"}
+    
+    full_text = texts[0].description
+    confidence = texts[0].score if hasattr(texts[0], 'score') else 0.9
+    
+    return {
+        "text": full_text,
+        "confidence": confidence,
+        "structured_data": parse_text_to_dict(full_text),
+        "engine": "google_vision"
+    }
+
 def google_vision_ocr(image_bytes: bytes) -> dict:
     """Extract text using Google Vision API"""
     try:
         image = vision.Image(content=image_bytes)
-        response = vision_client.text_detection(image=image)
-        
-        if response.error.message:
-            raise Exception(response.error.message)
-        
-        texts = response.text_annotations
-        if not texts:
-            return {"text": "", "confidence": 0, "structured_data": {}}
-        
-        full_text = texts[0].description
-        confidence = texts[0].score if hasattr(texts[0], 'score') else 0.9
-        
-        return {
-            "text": full_text,
-            "confidence": confidence,
-            "structured_data": parse_text_to_dict(full_text),
-            "engine": "google_vision"
-        }
+        return vision_result(vision_client.text_detection(image=image))
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Google Vision OCR failed: {str(e)}")
 
+def vision_chunks(images: List[bytes]) -> List[List[int]]:
+    """Group image indexes into batch_annotate_images calls of at most VISION_BATCH_SIZE images / VISION_BATCH_MAX_BYTES"""
+    chunks, current, current_bytes = [], [], 0
+    for i, image_bytes in enumerate(images):
+        if current and (len(current) >= VISION_BATCH_SIZE or current_bytes + len(image_bytes) > VISION_BATCH_MAX_BYTES):
+            chunks.append(current)
+            current, current_bytes = [], 0
+        current.append(i)
+        current_bytes += len(image_bytes)
+    if current:
+        chunks.append(current)
+    return chunks
+
+def google_vision_batch_annotate(images: List[bytes]) -> list:
+    """
+    One batch_annotate_images round-trip for up to 16 images. Returns, in input order, an OCR
+    result dict or the HTTPException for each image; raises if the call itself fails.
+    """
+    feature = vision.Feature(type_=vision.Feature.Type.TEXT_DETECTION)
+    response = vision_client.batch_annotate_images(requests=[
+        vision.AnnotateImageRequest(image=vision.Image(content=image_bytes), features=[feature])
+        for image_bytes in images
+    ])
+    if len(response.responses) != len(images):
+        raise Exception(f"expected {len(images)} responses, got {len(response.responses)}")
+    
+    results = []
+    for annotation in response.responses:
+        try:
+            results.append(vision_result(annotation))
+        except Exception as e:
+            results.append(HTTPException(status_code=500, detail=f"Google Vision OCR failed: {str(e)}"))
+    return results
+
+def ocr_or_error(ocr, *args):
+    """Run one OCR call, returning the exception instead of raising it"""
+    try:
+        return ocr(*args)
+    except Exception as e:
+        return e
+
+async def google_vision_batch_ocr(images: List[bytes], concurrency: int, on_chunk=None) -> List[tuple]:
+    """
+    OCR many images with batched Vision calls, at most `concurrency` calls in flight.
+    Returns (result, ocr_ms) per image in input order, where result is an OCR dict or the
+    exception for that image alone. A call that fails as a whole is retried image by image,
+    so one bad image can't fail the rest of its chunk. on_chunk, if given, is awaited with
+    the size of every finished chunk.
+    """
+    loop = asyncio.get_running_loop()
+    semaphore = asyncio.Semaphore(concurrency)
+    results = [None] * len(images)
+    
+    async def run_chunk(indexes):
+        chunk = [images[i] for i in indexes]
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                chunk_results = await loop.run_in_executor(ocr_executor, google_vision_batch_annotate, chunk)
+            except Exception as e:
+                print(f"Vision batch of {len(chunk)} failed ({e}), retrying images one by one")
+                chunk_results = await asyncio.gather(*[
+                    loop.run_in_executor(ocr_executor, ocr_or_error, google_vision_ocr, image_bytes)
+                    for image_bytes in chunk
+                ])
+            ocr_ms = round((time.perf_counter() - start) * 1000, 1)
+        for i, result in zip(indexes, chunk_results):
+            results[i] = (result, ocr_ms)
+        if on_chunk:
+            await on_chunk(len(indexes))
+    
+    await gather_or_cancel([run_chunk(indexes) for indexes in vision_chunks(images)])
+    return results
+
+class GeminiClient:
+    """
+    Shared HTTP client for the Gemini API, used from every OCR thread:
+    - one keep-alive connection pool, so images don't each pay a TCP + TLS handshake
+    - adaptive concurrency: a 429 halves the in-flight limit and pauses new requests for
+      Retry-After; every success grows the limit back by 1/limit (AIMD)
+    - retries on 429, 5xx, timeouts and connection errors with full-jitter exponential backoff
+    - a circuit breaker that fails fast with 503 after repeated failures, then lets a single
+      probe request through once the cooldown has passed
+    """
+    
+    RETRY_STATUS = {429, 500, 502, 503, 504}
+    BACKOFF_BASE = 0.5
+    BACKOFF_CAP = 20.0
+    
+    def __init__(self, url: str, api_key: str, max_concurrency: int, max_retries: int,
+                 breaker_threshold: int, breaker_cooldown: float, timeout: float):
+        self.url = url
+        self.api_key = api_key
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.breaker_threshold = breaker_threshold
+        self.breaker_cooldown = breaker_cooldown
+        self.timeout = timeout
+        
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=max_concurrency)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        
+        self._cond = threading.Condition()
+        self.limit = float(max_concurrency)
+        self.in_flight = 0
+        self._blocked_until = 0.0
+        self._failures = 0
+        self._opened_at = None
+        self._probing = False
+        self.counters = {"requests": 0, "retries": 0, "throttled": 0, "failures": 0, "rejected": 0}
+    
+    def _check_breaker(self):
+        with self._cond:
+            if self._opened_at is None:
+                return
+            if self._probing or time.monotonic() - self._opened_at < self.breaker_cooldown:
+                self.counters['rejected'] += 1
+                raise HTTPException(status_code=503, detail="Gemini OCR temporarily unavailable, try again later")
+            self._probing = True
+    
+    def _acquire(self):
+        with self._cond:
+            while True:
+                wait = self._blocked_until - time.monotonic()
+                if wait > 0:
+                    self._cond.wait(wait)
+                elif self.in_flight < int(self.limit):
+                    self.in_flight += 1
+                    self.counters['requests'] += 1
+                    return
+                else:
+                    self._cond.wait()
+    
+    def _release(self, outcome: str, throttled_for: float = 0.0):
+        """Free the slot and feed the outcome (ok / throttled / failure / client_error) to the limiter and breaker"""
+        with self._cond:
+            self.in_flight -= 1
+            now = time.monotonic()
+            if outcome == "throttled":
+                self.counters['throttled'] += 1
+                # Requests already in flight will 429 too; only the first one in a pause shrinks the limit
+                if now >= self._blocked_until:
+                    self.limit = max(1.0, self.limit / 2)
+                self._blocked_until = max(self._blocked_until, now + throttled_for)
+                self._probing = False
+            elif outcome == "failure":
+                self.counters['failures'] += 1
+                self._failures += 1
+                if self._probing or self._failures >= self.breaker_threshold:
+                    self._opened_at = now
+                    self._probing = False
+            else:
+                if outcome == "ok":
+                    self.limit = min(float(self.max_concurrency), self.limit + 1 / self.limit)
+                self._failures = 0
+                self._opened_at = None
+                self._probing = False
+            self._cond.notify_all()
+    
+    def _backoff(self, attempt: int) -> float:
+        return random.uniform(0, min(self.BACKOFF_CAP, self.BACKOFF_BASE * 2 ** attempt))
+    
+    @staticmethod
+    def _retry_after(response) -> Optional[float]:
+        """Seconds to wait from a Retry-After header (seconds or HTTP date), if there is one"""
+        value = response.headers.get("Retry-After")
+        if not value:
+            return None
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            pass
+        try:
+            retry_at = parsedate_to_datetime(value)
+            return max(0.0, (retry_at - datetime.now(retry_at.tzinfo)).total_seconds())
+        except (TypeError, ValueError):
+            return None
+    
+    def generate(self, payload: dict) -> dict:
+        """POST payload to generateContent and return the decoded JSON response (blocking)"""
+        for attempt in range(self.max_retries + 1):
+            self._check_breaker()
+            self._acquire()
+            retry_after = None
+            try:
+                r = self.session.post(self.url, params={"key": self.api_key}, json=payload, timeout=self.timeout)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                self._release("failure")
+                error = e
+            else:
+                if r.status_code == 429:
+                    retry_after = self._retry_after(r)
+                    self._release("throttled", retry_after if retry_after is not None else self._backoff(attempt))
+                elif r.status_code in self.RETRY_STATUS:
+                    self._release("failure")
+                else:
+                    # The API answered; a 4xx other than 429 is our request's fault and is not retried
+                    self._release("ok" if r.ok else "client_error")
+                    r.raise_for_status()
+                    return r.json()
+                error = requests.HTTPError(f"{r.status_code} {r.reason}", response=r)
+            
+            if attempt == self.max_retries:
+                break
+            with self._cond:
+                self.counters['retries'] += 1
+            time.sleep(max(retry_after or 0.0, self._backoff(attempt)))
+        raise error
+    
+    def stats(self) -> dict:
+        with self._cond:
+            if self._opened_at is None:
+                breaker = "closed"
+            elif self._probing or time.monotonic() - self._opened_at >= self.breaker_cooldown:
+                breaker = "half_open"
+            else:
+                breaker = "open"
+            return {"limit": round(self.limit, 2), "in_flight": self.in_flight, "breaker": breaker, **self.counters}
+
+gemini_client = GeminiClient(
+    GEMINI_API_URL, GEMINI_API_KEY, GEMINI_MAX_CONCURRENCY, GEMINI_MAX_RETRIES,
+    GEMINI_BREAKER_THRESHOLD, GEMINI_BREAKER_COOLDOWN, GEMINI_TIMEOUT
+)
+
 def gemini_ocr(image_bytes: bytes, mime_type: str) -> dict:
     """Extract text using Gemini AI"""
     try:
         b64 = base64.b64encode(image_bytes).decode()
-        url = "https://generativelanguage.googleapis.com/v1/models/gemini-2.0-flash-exp:generateContent"
         payload = {
             "contents": [{
                 "parts": [
@@ -379,10 +1635,9 @@ def gemini_ocr(image_bytes: bytes, mime_type: str) -> dict:
             }]
         }
         
-        r = requests.post(f"{url}?key={GEMINI_API_KEY}", json=payload, timeout=30)
-        r.raise_for_status()
+        response = gemini_client.generate(payload)
         
-        content = r.json()["candidates"][0]["content"]["parts"][0]["text"]
+        content = response["candidates"][0]["content"]["parts"][0]["text"]
         content = content.replace("```json", "").replace("```", "").strip()
         data = json.loads(content)
         
@@ -392,6 +1647,8 @@ def gemini_ocr(image_bytes: bytes, mime_type: str) -> dict:
             "structured_data": data,
             "engine": "gemini"
         }
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Gemini OCR failed: {str(e)}")
 
@@ -409,61 +1666,1450 @@ def parse_text_to_dict(text: str) -> dict:
 # EXCEL GENERATION
 # ===========================================
 
-def generate_excel(data_list: List[dict], image_urls: List[str], industry: str, user_id: int) -> bytes:
-    """Generate Excel file with images and normalized data"""
-    column_order = INDUSTRY_COLUMN_ORDER.get(industry, [])
-    all_fields = set()
-    for item in data_list:
-        all_fields.update(k for k in item.keys() if k != '_metadata')
-    
-    ordered_fields = [c for c in column_order if c in all_fields]
-    ordered_fields.extend(sorted(all_fields - set(ordered_fields)))
-    
-    rows = [{"Imagen": "", **{f: item.get(f, "") for f in ordered_fields}} for item in data_list]
-    df = pd.DataFrame(rows)
-    
-    output = BytesIO()
-    df.to_excel(output, sheet_name="Datos", index=False, engine='openpyxl')
-    output.seek(0)
-    
-    wb = load_workbook(output)
-    ws = wb["Datos"]
+HEADER_FILL = PatternFill(start_color="4472C4", end_color="4472C4", fill_type="solid")
+HEADER_FONT = Font(bold=True, color="FFFFFF", size=11)
+HEADER_ALIGNMENT = Alignment(horizontal="center", vertical="center")
+THUMBNAIL_ROW_HEIGHT = 120
+XLSX_MIME = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+
+class StreamingExcelWriter:
+    """
+    Single-pass xlsx writer on openpyxl's write-only mode: header styling, column widths,
+    row heights and thumbnails go out as rows are appended, so the workbook is never
+    loaded back. Thumbnails are spooled to a temp directory until save, keeping memory
+    flat as the row count grows.
+    """
     
-    # Style headers
-    header_fill = PatternFill(start_color="4472C4", end_color="4472C4", fill_type="solid")
-    header_font = Font(bold=True, color="FFFFFF", size=11)
+    def __init__(self, columns: List[str], sheet_name: str = "Datos"):
+        self.wb = Workbook(write_only=True)
+        self.ws = self.wb.create_sheet(sheet_name)
+        self._thumbnails = tempfile.TemporaryDirectory()
+        self._row = 1
+        
+        # Column widths must be set before the first row is written
+        self.ws.column_dimensions["A"].width = 25
+        for col in range(2, len(columns) + 1):
+            self.ws.column_dimensions[get_column_letter(col)].width = 18
+        
+        header = []
+        for name in columns:
+            cell = WriteOnlyCell(self.ws, value=name)
+            cell.fill = HEADER_FILL
+            cell.font = HEADER_FONT
+            cell.alignment = HEADER_ALIGNMENT
+            header.append(cell)
+        self.ws.append(header)
     
-    for cell in ws[1]:
-        cell.fill = header_fill
-        cell.font = header_font
-        cell.alignment = Alignment(horizontal="center", vertical="center")
+    def add_row(self, values: list, thumbnail: Optional[bytes] = None):
+        """Append a data row; the thumbnail, if any, is anchored in column A"""
+        self._row += 1
+        if thumbnail:
+            path = os.path.join(self._thumbnails.name, f"{self._row}")
+            with open(path, "wb") as f:
+                f.write(thumbnail)
+            xl_img = XLImage(path)
+            xl_img.anchor = f"A{self._row}"
+            self.ws.add_image(xl_img)
+            self.ws.row_dimensions[self._row].height = THUMBNAIL_ROW_HEIGHT
+        self.ws.append([None if value == "" else value for value in values])
     
-    ws.column_dimensions["A"].width = 25
-    for col in range(2, ws.max_column + 1):
-        ws.column_dimensions[get_column_letter(col)].width = 18
+    def save(self, fileobj):
+        self.wb.save(fileobj)
     
-    # Add images
-    for idx, img_url in enumerate(image_urls):
+    def close(self):
+        self._thumbnails.cleanup()
+
+def make_excel_thumbnail(image_bytes: bytes) -> Optional[bytes]:
+    """150px PNG thumbnail for the Excel export, or None if the image can't be decoded"""
+    return image_service.render_thumbnails(image_bytes)["excel"]
+
+def fetch_thumbnail(img_url: str) -> Optional[bytes]:
+    """Download an image from S3 and thumbnail it, or None if that fails"""
+    try:
+        response = thumbnail_session.get(img_url, timeout=10)
+        response.raise_for_status()
+    except requests.RequestException as e:
+        print(f"Error downloading {img_url}: {e}")
+        return None
+    return make_excel_thumbnail(response.content)
+
+def fetch_thumbnails(image_urls: List[str]) -> List[Optional[bytes]]:
+    """Parallel fetch_thumbnail over pooled connections, in input order"""
+    return list(thumbnail_executor.map(fetch_thumbnail, image_urls))
+
+def write_excel(output, frame: pd.DataFrame, image_urls: List[str], industry: str,
+                thumbnails: Optional[List[Optional[bytes]]] = None, timer: Optional[StageTimer] = None) -> int:
+    """
+    Write the Excel file with images and the normalized wide frame (one row per image) to the
+    file object output. thumbnails come from the pipeline; without them (rebuilding an old batch)
+    they are downloaded from image_urls. Returns the number of rows without a thumbnail.
+    """
+    column_order = INDUSTRY_COLUMN_ORDER.get(industry, [])
+    all_fields = set(c for c in frame.columns if c != '_metadata')
+    
+    ordered_fields = [c for c in column_order if c in all_fields]
+    ordered_fields.extend(sorted(all_fields - set(ordered_fields)))
+    
+    rows = frame.reindex(columns=ordered_fields).fillna("").itertuples(index=False, name=None)
+    
+    if thumbnails is None:
+        with timer.stage("thumbnails") if timer else nullcontext():
+            thumbnails = fetch_thumbnails(image_urls)
+    
+    writer = StreamingExcelWriter(["Imagen", *ordered_fields])
+    try:
+        for row, thumbnail in zip(rows, thumbnails):
+            writer.add_row(["", *row], thumbnail)
+        
+        writer.save(output)
+        return sum(1 for thumbnail in thumbnails if thumbnail is None)
+    finally:
+        writer.close()
+
+def export_excel(frame: pd.DataFrame, image_urls: List[str], industry: str, user_id: int, filename: str,
+                 thumbnails: Optional[List[Optional[bytes]]] = None, timer: Optional[StageTimer] = None):
+    """
+    write_excel straight into an S3 multipart upload, so parts go up while the workbook is still
+    being compressed and the finished file is never held in memory (blocking).
+    Returns (excel_url, number of rows without a thumbnail).
+    """
+    key = s3_user_key(user_id, filename)
+    try:
+        with S3MultipartWriter(key, XLSX_MIME) as output:
+            thumbnail_failures = write_excel(output, frame, image_urls, industry, thumbnails, timer)
+    except ClientError as e:
+        raise HTTPException(status_code=500, detail=f"S3 upload failed: {str(e)}")
+    return s3_object_url(key), thumbnail_failures
+
+# ===========================================
+# OCR CACHE
+# ===========================================
+
+class OCRCache:
+    """
+    Content-addressed OCR results: sha256(image bytes) + engine -> image_url + OCR output.
+    An in-process LRU sits in front of the ocr_cache table. Entries live as long as the
+    tier's retention_days, so a hit never points at an S3 object that is already gone.
+    """
+    
+    EVICT_EVERY = 3600  # seconds between DELETEs of expired rows
+    
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._last_eviction = 0.0
+    
+    @staticmethod
+    def key(image_bytes: bytes, engine: str) -> str:
+        return f"{engine}:{hashlib.sha256(image_bytes).hexdigest()}"
+    
+    def _remember(self, user_id: int, cache_key: str, entry: dict):
+        with self._lock:
+            self._entries[(user_id, cache_key)] = entry
+            self._entries.move_to_end((user_id, cache_key))
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+    
+    def get(self, user_id: int, cache_key: str) -> Optional[dict]:
+        with self._lock:
+            entry = self._entries.get((user_id, cache_key))
+            if entry and entry['expires_at'] > time.time():
+                self._entries.move_to_end((user_id, cache_key))
+                return entry
+            if entry:
+                del self._entries[(user_id, cache_key)]
+        
         try:
-            # Download image from S3
-            response = requests.get(img_url, timeout=10)
-            if response.status_code == 200:
-                img = Image.open(BytesIO(response.content))
-                img.thumbnail((150, 150), Image.Resampling.LANCZOS)
-                img_io = BytesIO()
-                img.save(img_io, format='PNG')
-                img_io.seek(0)
-                xl_img = XLImage(img_io)
-                ws.row_dimensions[idx + 2].height = 120
-                xl_img.anchor = f"A{idx + 2}"
-                ws.add_image(xl_img)
-        except:
-            pass
+            with db_pool.connection() as conn:
+                cursor = conn.cursor()
+                try:
+                    cursor.execute(
+                        """SELECT image_url, ocr_result, EXTRACT(EPOCH FROM (expires_at - NOW())) AS ttl
+                           FROM ocr_cache
+                           WHERE user_id = %s AND cache_key = %s AND expires_at > NOW()""",
+                        (user_id, cache_key)
+                    )
+                    row = cursor.fetchone()
+                finally:
+                    cursor.close()
+        except Exception as e:
+            print(f"OCR cache lookup failed: {e}")
+            return None
+        
+        if not row:
+            return None
+        entry = {
+            "image_url": row['image_url'],
+            "ocr_result": row['ocr_result'],
+            "expires_at": time.time() + float(row['ttl'])
+        }
+        self._remember(user_id, cache_key, entry)
+        return entry
+    
+    def put(self, user_id: int, cache_key: str, image_url: str, ocr_result: dict, retention_days: int):
+        self._remember(user_id, cache_key, {
+            "image_url": image_url,
+            "ocr_result": ocr_result,
+            "expires_at": time.time() + retention_days * 86400
+        })
+        
+        try:
+            with db_pool.connection() as conn:
+                cursor = conn.cursor()
+                try:
+                    cursor.execute(
+                        """INSERT INTO ocr_cache (user_id, cache_key, image_url, ocr_result, expires_at)
+                           VALUES (%s, %s, %s, %s, NOW() + %s * INTERVAL '1 day')
+                           ON CONFLICT (user_id, cache_key) DO UPDATE
+                           SET image_url = EXCLUDED.image_url, ocr_result = EXCLUDED.ocr_result,
+                               expires_at = EXCLUDED.expires_at""",
+                        (user_id, cache_key, image_url, json.dumps(ocr_result), retention_days)
+                    )
+                    if time.time() - self._last_eviction > self.EVICT_EVERY:
+                        self._last_eviction = time.time()
+                        cursor.execute("DELETE FROM ocr_cache WHERE expires_at <= NOW()")
+                    conn.commit()
+                finally:
+                    cursor.close()
+        except Exception as e:
+            print(f"OCR cache write failed: {e}")
+
+ocr_cache = OCRCache(OCR_CACHE_SIZE)
+
+# ===========================================
+# BATCH CHECKPOINTS
+# ===========================================
+
+class BatchCheckpoints:
+    """
+    Per-image progress of batches submitted with a client batch_id. Each image is saved to
+    batch_checkpoints as soon as its OCR finishes, so resubmitting the batch after a restart
+    only processes what is missing. Rows remember whether they were billed, so sending a
+    finished batch again doesn't charge it twice.
+    """
+    
+    PURGE_EVERY = 3600  # seconds between DELETEs of old checkpoints
+    
+    def __init__(self, retention_days: int):
+        self.retention_days = retention_days
+        self._last_purge = 0.0
+    
+    @staticmethod
+    def image_hash(image_bytes: bytes) -> str:
+        return hashlib.sha256(image_bytes).hexdigest()
+    
+    def load(self, user_id: int, batch_id: str) -> dict:
+        """{image_hash: {image_hash, image_url, ocr_result}} for the batch; empty if it is new or the lookup fails"""
+        try:
+            with db_pool.connection() as conn:
+                cursor = conn.cursor()
+                try:
+                    cursor.execute(
+                        """SELECT image_hash, image_url, ocr_result FROM batch_checkpoints
+                           WHERE user_id = %s AND batch_id = %s""",
+                        (user_id, batch_id)
+                    )
+                    return {row['image_hash']: row for row in cursor.fetchall()}
+                finally:
+                    cursor.close()
+        except Exception as e:
+            print(f"Checkpoint lookup failed, processing batch {batch_id} from scratch: {e}")
+            return {}
+    
+    def save(self, user_id: int, batch_id: str, image_hash: str, filename: str, image_url: str, ocr_result: dict):
+        try:
+            with db_pool.connection() as conn:
+                cursor = conn.cursor()
+                try:
+                    cursor.execute(
+                        """INSERT INTO batch_checkpoints (user_id, batch_id, image_hash, filename, image_url, ocr_result)
+                           VALUES (%s, %s, %s, %s, %s, %s)
+                           ON CONFLICT (user_id, batch_id, image_hash) DO NOTHING""",
+                        (user_id, batch_id, image_hash, filename, image_url, json.dumps(ocr_result))
+                    )
+                    if time.time() - self._last_purge > self.PURGE_EVERY:
+                        self._last_purge = time.time()
+                        cursor.execute(
+                            "DELETE FROM batch_checkpoints WHERE created_at < NOW() - %s * INTERVAL '1 day'",
+                            (self.retention_days,)
+                        )
+                    conn.commit()
+                finally:
+                    cursor.close()
+        except Exception as e:
+            print(f"Checkpoint write failed for batch {batch_id}: {e}")
+    
+    @staticmethod
+    def bill(cursor, user_id: int, batch_id: str, image_hashes: List[Optional[str]]) -> int:
+        """
+        Mark the checkpoints of a batch's images billed, inside the caller's transaction, and return
+        how many of the images to charge: those whose row this call flipped, plus those with no row
+        (None: never checkpointed). A row another submission of the batch billed first is not charged
+        again; if both bill at once, the row lock makes the second one see it already billed.
+        """
+        checkpointed = list({image_hash for image_hash in image_hashes if image_hash})
+        if not checkpointed:
+            return len(image_hashes)
+        cursor.execute(
+            """UPDATE batch_checkpoints SET billed = TRUE
+               WHERE user_id = %s AND batch_id = %s AND image_hash = ANY(%s) AND NOT billed
+               RETURNING image_hash""",
+            (user_id, batch_id, checkpointed)
+        )
+        flipped = {row['image_hash'] for row in cursor.fetchall()}
+        cursor.execute(
+            "SELECT image_hash FROM batch_checkpoints WHERE user_id = %s AND batch_id = %s AND image_hash = ANY(%s)",
+            (user_id, batch_id, checkpointed)
+        )
+        saved = {row['image_hash'] for row in cursor.fetchall()}
+        return sum(1 for image_hash in image_hashes if image_hash in flipped or image_hash not in saved)
+
+batch_checkpoints = BatchCheckpoints(CHECKPOINT_RETENTION_DAYS)
+
+# ===========================================
+# USER CONTEXT & QUOTA
+# ===========================================
+
+class UserContextCache:
+    """
+    Per-process copy of what authenticated routes need about a user: tier, its TIER_CONFIGS
+    entry, the monthly image counter and signup date. Entries live ttl seconds, take the
+    counter this process reads back whenever it moves it, and are dropped when the tier
+    changes; changes made elsewhere (other replicas, the monthly reset) show up within ttl.
+    The quota itself is enforced by QuotaReservation in the database, never from this copy.
+    """
+    
+    def __init__(self, ttl: float, max_entries: int):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # user_id -> (expires at, context)
+        self._lock = threading.Lock()
+    
+    def _remember(self, user_id: int, context: dict):
+        self._entries[user_id] = (time.monotonic() + self.ttl, context)
+        self._entries.move_to_end(user_id)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+    
+    def get(self, user_id: int, conn=None) -> dict:
+        """Context of user_id, loaded (blocking, on conn when given) if missing or stale"""
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry and entry[0] > time.monotonic():
+                self._entries.move_to_end(user_id)
+                return entry[1]
+        return self.load(user_id, conn)
+    
+    def load(self, user_id: int, conn=None) -> dict:
+        """Read the user's context from the database and cache it. 404 if the user is gone"""
+        if conn is None:
+            with db_pool.connection() as conn:
+                return self.load(user_id, conn)
+        
+        cursor = conn.cursor()
+        try:
+            cursor.execute(
+                "SELECT tier, images_processed_this_month, created_at FROM users WHERE id = %s",
+                (user_id,)
+            )
+            user = cursor.fetchone()
+        finally:
+            cursor.close()
+        
+        if not user:
+            self.invalidate(user_id)
+            raise HTTPException(status_code=404, detail="User not found")
+        context = {
+            "tier": user['tier'],
+            "config": TIER_CONFIGS[user['tier']],
+            "images_this_month": user['images_processed_this_month'] or 0,
+            "created_at": user['created_at']
+        }
+        with self._lock:
+            self._remember(user_id, context)
+        return context
+    
+    def update_count(self, user_id: int, tier: str, images_this_month: int):
+        """Take a counter value just read back from users; a different tier drops the entry instead"""
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None:
+                return
+            if entry[1]['tier'] != tier:
+                del self._entries[user_id]
+                return
+            self._remember(user_id, dict(entry[1], images_this_month=images_this_month))
     
-    final_output = BytesIO()
-    wb.save(final_output)
-    final_output.seek(0)
-    return final_output.getvalue()
+    def invalidate(self, user_id: int):
+        """Forget a user, e.g. after changing their tier"""
+        with self._lock:
+            self._entries.pop(user_id, None)
+
+user_contexts = UserContextCache(USER_CONTEXT_TTL, USER_CONTEXT_SIZE)
+
+def check_batch_limits(user_id: int, batch_size: int) -> dict:
+    """
+    Fail fast on a batch the user's tier can't take (blocking; usually no query, the context is
+    cached). Returns the user context. Only a hint for the monthly limit: the binding check is
+    QuotaReservation.reserve.
+    """
+    context = user_contexts.get(user_id)
+    tier, config = context['tier'], context['config']
+    
+    if batch_size > config['max_images_per_batch']:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Batch too large. Max {config['max_images_per_batch']} images per batch for {tier} tier"
+        )
+    
+    if context['images_this_month'] + batch_size > config['max_images']:
+        raise HTTPException(
+            status_code=403,
+            detail=f"Monthly limit exceeded. {context['images_this_month']}/{config['max_images']} images used"
+        )
+    
+    return context
+
+class QuotaReservation:
+    """
+    Images one batch holds against its user's monthly quota. reserve() claims them with a single
+    conditional UPDATE, so parallel batches can't both slip under the limit on the same stale count.
+    record_batch_usage settles the reservation (images that weren't charged go back in the billing
+    transaction); release() hands back whatever is still held if the batch fails before that.
+    """
+    
+    def __init__(self, user_id: int):
+        self.user_id = user_id
+        self.images = 0
+        self.tier = None
+        self.config = None
+    
+    def reserve(self, count: int) -> dict:
+        """Claim count more images (blocking). Returns the user context the claim was made under"""
+        context = user_contexts.get(self.user_id)
+        # A miss can mean the cached tier is out of date: retry once with the database's copy
+        for attempt in range(2):
+            tier, config = context['tier'], context['config']
+            if self.images + count > config['max_images_per_batch']:
+                raise HTTPException(
+                    status_code=400,
+                    detail=f"Batch too large. Max {config['max_images_per_batch']} images per batch for {tier} tier"
+                )
+            
+            with db_pool.connection() as conn:
+                cursor = conn.cursor()
+                try:
+                    cursor.execute(
+                        """UPDATE users
+                           SET images_processed_this_month = COALESCE(images_processed_this_month, 0) + %s
+                           WHERE id = %s AND tier = %s
+                             AND COALESCE(images_processed_this_month, 0) + %s <= %s
+                           RETURNING images_processed_this_month""",
+                        (count, self.user_id, tier, count, config['max_images'])
+                    )
+                    row = cursor.fetchone()
+                    conn.commit()
+                finally:
+                    cursor.close()
+            
+            if row:
+                self.images += count
+                self.tier, self.config = tier, config
+                user_contexts.update_count(self.user_id, tier, row['images_processed_this_month'])
+                return dict(context, images_this_month=row['images_processed_this_month'])
+            
+            context = user_contexts.load(self.user_id)
+            if context['tier'] == tier:
+                break
+        
+        raise HTTPException(
+            status_code=403,
+            detail=f"Monthly limit exceeded. {context['images_this_month']}/{context['config']['max_images']} images used"
+        )
+    
+    def settle(self, cursor, charged: int) -> dict:
+        """
+        Keep charged images and return the rest of the reservation, inside the caller's transaction.
+        Charging more than was reserved adds the difference. Returns the user's tier and new counter;
+        call settled() once the transaction commits.
+        """
+        cursor.execute(
+            """UPDATE users
+               SET images_processed_this_month = GREATEST(COALESCE(images_processed_this_month, 0) - %s, 0)
+               WHERE id = %s
+               RETURNING tier, images_processed_this_month""",
+            (self.images - charged, self.user_id)
+        )
+        return cursor.fetchone()
+    
+    def settled(self, row: dict):
+        self.images = 0
+        user_contexts.update_count(self.user_id, row['tier'], row['images_processed_this_month'])
+    
+    def release(self):
+        """Hand back every image still held (blocking); nothing to do once the batch was billed"""
+        if not self.images:
+            return
+        with db_pool.connection() as conn:
+            cursor = conn.cursor()
+            try:
+                row = self.settle(cursor, 0)
+                conn.commit()
+            finally:
+                cursor.close()
+        if row:
+            self.settled(row)
+
+# ===========================================
+# BATCH PIPELINE
+# ===========================================
+
+def stage_image(image_bytes: bytes, filename: str, content_type: str, user_id: int, config: dict,
+                image_url: Optional[str] = None) -> dict:
+    """
+    Everything before the OCR call (blocking, runs on ocr_executor): cache lookup and pre-OCR resize.
+    The S3 upload is only started here (on s3_upload_executor) and collected by finish_image, so it
+    overlaps with the OCR call. Cache hits come back as a finished result; otherwise the dict carries
+    the bytes to send to the engine. Images already in S3 (presigned uploads) pass their image_url
+    and skip the upload.
+    """
+    start = time.perf_counter()
+    ocr_engine = config['ocr_engine']
+    profile = OCR_PREPROCESS_PROFILES[ocr_engine]
+    
+    # The resize settings change what the engine sees, so they are part of the cache key
+    engine_tag = f"{ocr_engine}@{profile['max_side']}q{profile['quality']}" if OCR_PREPROCESS else ocr_engine
+    cache_key = OCRCache.key(image_bytes, engine_tag)
+    cached = ocr_cache.get(user_id, cache_key)
+    if cached:
+        return {"status": "succeeded", "image_url": image_url or cached['image_url'], "ocr_result": cached['ocr_result'], "cache_hit": True,
+                "thumbnail": image_service.render_thumbnails(image_bytes)["excel"],
+                "ocr_stats": {"original_bytes": len(image_bytes)}}
+    
+    # Decoding, resizing and the thumbnail run on the process pool and the original goes to S3
+    # on the upload pool; OCR only waits for the resize, the Excel stage never downloads the image
+    if OCR_PREPROCESS:
+        prepared_future = image_service.submit_prepare(image_bytes, ocr_engine)
+    else:
+        prepared_future = image_service.submit_thumbnails(image_bytes)
+    
+    upload_future = None
+    if image_url is None:
+        upload_future = s3_upload_executor.submit(upload_image, image_bytes, filename, user_id, content_type)
+    
+    stats = {"original_bytes": len(image_bytes)}
+    staged = {"status": "staged", "image_url": image_url, "upload_future": upload_future, "cache_hit": False,
+              "cache_key": cache_key, "start": start, "ocr_bytes": image_bytes, "ocr_mime": content_type,
+              "ocr_stats": stats, "thumbnail_future": prepared_future}
+    if OCR_PREPROCESS:
+        try:
+            prepared = prepared_future.result()
+        except BaseException:
+            discard_upload(upload_future)
+            raise
+        staged.update(ocr_bytes=prepared['ocr_bytes'], ocr_mime=prepared['mime_type'] or content_type,
+                      thumbnail=prepared['thumbnails']['excel'])
+        stats.update(prepare_ms=prepared['prepare_ms'], width=prepared['width'], height=prepared['height'])
+    stats['ocr_bytes'] = len(staged['ocr_bytes'])
+    # Gemini carries the image base64-encoded inside the JSON body
+    stats['request_bytes'] = 4 * -(-stats['ocr_bytes'] // 3) if ocr_engine == 'gemini' else stats['ocr_bytes']
+    return staged
+
+def ocr_staged(staged: dict, config: dict):
+    """Run the tier's OCR engine on one staged image (blocking). Returns (ocr_result, ocr_ms)"""
+    ocr_start = time.perf_counter()
+    if config['ocr_engine'] == 'google_vision':
+        ocr_result = google_vision_ocr(staged['ocr_bytes'])
+    else:
+        ocr_result = gemini_ocr(staged['ocr_bytes'], staged['ocr_mime'])
+    return ocr_result, round((time.perf_counter() - ocr_start) * 1000, 1)
+
+def finish_image(staged: dict, ocr_result: dict, ocr_ms: float, user_id: int, config: dict) -> dict:
+    """
+    Wait for the S3 upload of a staged image, cache its OCR result and build its process_image
+    result (blocking). upload_wait_ms is the part of upload_ms that OCR didn't hide.
+    If the upload failed for good the OCR result is kept anyway: the image succeeds without an
+    image_url, with the reason in upload_error, and is neither cached nor checkpointed.
+    """
+    stats = staged['ocr_stats']
+    upload_error = None
+    if staged['upload_future'] is not None:
+        wait_start = time.perf_counter()
+        try:
+            staged['image_url'], stats['upload_ms'] = staged['upload_future'].result()
+        except Exception as e:
+            upload_error = e.detail if isinstance(e, HTTPException) else str(e)
+            print(f"Keeping the OCR result of an image whose upload failed: {upload_error}")
+        stats['upload_wait_ms'] = round((time.perf_counter() - wait_start) * 1000, 1)
+    
+    if upload_error is None:
+        ocr_cache.put(user_id, staged['cache_key'], staged['image_url'], ocr_result, config['retention_days'])
+    
+    thumbnail = staged['thumbnail'] if 'thumbnail' in staged else staged['thumbnail_future'].result()['excel']
+    stats['ocr_ms'] = ocr_ms
+    stats['total_ms'] = round((time.perf_counter() - staged['start']) * 1000, 1)
+    result = {"status": "succeeded", "image_url": staged['image_url'], "ocr_result": ocr_result, "cache_hit": False,
+              "thumbnail": thumbnail, "ocr_stats": stats}
+    if upload_error is not None:
+        result['upload_error'] = upload_error
+    return result
+
+def image_failure(filename: str, error: Exception) -> dict:
+    """Result entry for an image that could not be uploaded or OCR'd; the rest of the batch goes on"""
+    detail = error.detail if isinstance(error, HTTPException) else str(error)
+    print(f"Image {filename} failed: {detail}")
+    return {"status": "failed", "filename": filename, "error": detail}
+
+def process_image(image_bytes: bytes, filename: str, content_type: str, user_id: int, config: dict,
+                  image_url: Optional[str] = None) -> dict:
+    """
+    Upload one image to S3 and run OCR on it (blocking, runs on ocr_executor).
+    Images seen before are served from ocr_cache without a new OCR call or S3 object.
+    With OCR_PREPROCESS the engine gets a resized copy; S3 always keeps the original.
+    Returns the OCR result plus ocr_stats: bytes sent and time spent per stage.
+    """
+    staged = stage_image(image_bytes, filename, content_type, user_id, config, image_url)
+    if staged['status'] == "succeeded":
+        return staged
+    
+    try:
+        ocr_result, ocr_ms = ocr_staged(staged, config)
+    except BaseException:
+        discard_upload(staged['upload_future'])
+        raise
+    return finish_image(staged, ocr_result, ocr_ms, user_id, config)
+
+async def process_images_concurrently(images: List[tuple], user_id: int, config: dict,
+                                     on_progress=None, checkpoint=None) -> List[dict]:
+    """
+    Run process_image for every (bytes, filename, content_type[, image_url]) tuple with at most
+    config['ocr_concurrency'] images in flight. Results keep the input order; an image that
+    fails comes back as an image_failure entry instead of failing the batch.
+    on_progress, if given, is awaited with the number of finished images; checkpoint, if given,
+    is called (blocking, on ocr_executor) with the index and result of every successful image.
+    """
+    if config['ocr_engine'] == 'google_vision' and VISION_BATCH_SIZE > 1:
+        return await process_images_batched(images, user_id, config, on_progress, checkpoint)
+    
+    loop = asyncio.get_running_loop()
+    semaphore = asyncio.Semaphore(config['ocr_concurrency'])
+    done = 0
+    
+    async def run_one(index, image_bytes, filename, content_type, image_url=None):
+        nonlocal done
+        async with semaphore:
+            try:
+                result = await loop.run_in_executor(
+                    ocr_executor, process_image,
+                    image_bytes, filename, content_type, user_id, config, image_url
+                )
+                if checkpoint:
+                    await loop.run_in_executor(ocr_executor, checkpoint, index, result)
+            except Exception as e:
+                result = image_failure(filename, e)
+        done += 1
+        if on_progress:
+            await on_progress(done)
+        return result
+    
+    return await gather_or_cancel([run_one(i, *image) for i, image in enumerate(images)])
+
+async def process_images_batched(images: List[tuple], user_id: int, config: dict,
+                                 on_progress=None, checkpoint=None) -> List[dict]:
+    """
+    process_images_concurrently for Google Vision: images are staged ocr_concurrency at a time and
+    every VISION_BATCH_SIZE staged cache misses go out as one batch_annotate_images call (see
+    google_vision_batch_ocr) while the rest are still being staged. With at most ocr_concurrency
+    calls in flight and a bounded queue between the two stages, only the images close to a Vision
+    call are held in memory. Failures are per image, as in process_images_concurrently.
+    """
+    loop = asyncio.get_running_loop()
+    staging = asyncio.Semaphore(config['ocr_concurrency'])
+    calls = asyncio.Semaphore(config['ocr_concurrency'])
+    staged_images = asyncio.Queue(maxsize=VISION_BATCH_SIZE)
+    results = [None] * len(images)
+    done = 0
+    
+    async def progress(n):
+        nonlocal done
+        done += n
+        if on_progress:
+            await on_progress(done)
+    
+    async def stage_one(index, image_bytes, filename, content_type, image_url=None):
+        async with staging:
+            try:
+                staged = await loop.run_in_executor(
+                    ocr_executor, stage_image,
+                    image_bytes, filename, content_type, user_id, config, image_url
+                )
+                if checkpoint and staged['status'] == "succeeded":
+                    await loop.run_in_executor(ocr_executor, checkpoint, index, staged)
+            except Exception as e:
+                staged = image_failure(filename, e)
+            if staged['status'] == "staged":
+                # Waiting for room while holding the slot keeps staging from running ahead of Vision
+                staged.update(index=index, filename=filename)
+                await staged_images.put(staged)
+                return
+        results[index] = staged
+        await progress(1)
+    
+    async def stage_all():
+        try:
+            await gather_or_cancel([stage_one(i, *image) for i, image in enumerate(images)])
+        finally:
+            await staged_images.put(None)
+    
+    async def ocr_chunk(chunk):
+        try:
+            try:
+                ocr_results = await google_vision_batch_ocr([staged['ocr_bytes'] for staged in chunk], 1)
+            except BaseException:
+                for staged in chunk:
+                    discard_upload(staged['upload_future'])
+                raise
+            
+            for staged, (ocr_result, ocr_ms) in zip(chunk, ocr_results):
+                index = staged['index']
+                try:
+                    if isinstance(ocr_result, Exception):
+                        discard_upload(staged['upload_future'])
+                        raise ocr_result
+                    results[index] = await loop.run_in_executor(
+                        ocr_executor, finish_image, staged, ocr_result, ocr_ms, user_id, config
+                    )
+                    if checkpoint:
+                        await loop.run_in_executor(ocr_executor, checkpoint, index, results[index])
+                except Exception as e:
+                    results[index] = image_failure(staged['filename'], e)
+        finally:
+            calls.release()
+        await progress(len(chunk))
+    
+    stager = asyncio.ensure_future(stage_all())
+    ocr_tasks = []
+    chunk = []
+    try:
+        while (staged := await staged_images.get()) is not None:
+            chunk.append(staged)
+            if len(chunk) == VISION_BATCH_SIZE:
+                await calls.acquire()
+                ocr_tasks.append(asyncio.ensure_future(ocr_chunk(chunk)))
+                chunk = []
+        if chunk:
+            await calls.acquire()
+            ocr_tasks.append(asyncio.ensure_future(ocr_chunk(chunk)))
+            chunk = []
+        await asyncio.gather(stager, *ocr_tasks)
+    except BaseException:
+        for task in [stager, *ocr_tasks]:
+            task.cancel()
+        for staged in chunk:
+            discard_upload(staged['upload_future'])
+        while not staged_images.empty():
+            staged = staged_images.get_nowait()
+            if staged is not None:
+                discard_upload(staged['upload_future'])
+        raise
+    return results
+
+def record_batch_usage(user_id: int, tier: str, images_processed: int, industry: str,
+                       cache_hits: int = 0, thumbnail_failures: int = 0, ocr_stats: dict = None,
+                       batch_id: str = None, reservation: Optional[QuotaReservation] = None,
+                       image_hashes: Optional[List[Optional[str]]] = None) -> tuple:
+    """
+    Charge successfully processed images to the monthly quota and log the batch.
+    With a batch_id, image_hashes has the checkpoint of each processed image and only images
+    whose checkpoint this call bills are charged (BatchCheckpoints.bill). Images the batch
+    reserved but didn't charge are handed back in the same transaction; the usage row is written
+    by usage_log after it commits. ocr_stats (OCR calls, bytes and stage times, see finish_batch)
+    goes into the usage row as is. Returns (the user's new monthly count, images charged).
+    """
+    reservation = reservation or QuotaReservation(user_id)
+    images_charged = images_processed
+    with db_pool.connection() as conn:
+        cursor = conn.cursor()
+        try:
+            if batch_id:
+                image_hashes = image_hashes or [None] * images_processed
+                images_charged = BatchCheckpoints.bill(cursor, user_id, batch_id, image_hashes)
+            user = reservation.settle(cursor, images_charged)
+            conn.commit()
+        finally:
+            cursor.close()
+    
+    reservation.settled(user)
+    log_usage(user_id, "batch_processed", {
+        "images_processed": images_charged,
+        "industry": industry,
+        "tier": tier,
+        "cost": 0.0,
+        "ocr_cache_hits": cache_hits,
+        "thumbnail_failures": thumbnail_failures,
+        **(ocr_stats or {})
+    })
+    return user['images_processed_this_month'], images_charged
+
+def restored_result(row: dict, image_bytes: bytes) -> dict:
+    """
+    process_image result for a checkpointed image (blocking). The client resent the bytes,
+    so the thumbnail is rendered again instead of fetched from S3.
+    """
+    return {
+        "status": "succeeded", "image_url": row['image_url'], "ocr_result": row['ocr_result'],
+        "cache_hit": False, "restored": True, "image_hash": row['image_hash'],
+        "thumbnail": image_service.render_thumbnails(image_bytes)["excel"],
+        "ocr_stats": {"original_bytes": len(image_bytes)}
+    }
+
+async def restore_checkpoints(user_id: int, batch_id: str, images: List[tuple]):
+    """
+    Results for the images of a batch that were already checkpointed, keyed by their index in
+    images, plus a checkpoint callback for process_images_concurrently over the remaining ones
+    """
+    loop = asyncio.get_running_loop()
+    hashes = [BatchCheckpoints.image_hash(image[0]) for image in images]
+    saved = await loop.run_in_executor(ocr_executor, batch_checkpoints.load, user_id, batch_id)
+    
+    indexes = [i for i, image_hash in enumerate(hashes) if image_hash in saved]
+    restored = dict(zip(indexes, await asyncio.gather(*[
+        loop.run_in_executor(ocr_executor, restored_result, saved[hashes[i]], images[i][0])
+        for i in indexes
+    ])))
+    
+    pending = [i for i in range(len(images)) if i not in restored]
+    
+    def checkpoint(index: int, result: dict):
+        if result.get('upload_error'):
+            return  # batch_checkpoints needs the image_url; a resubmission processes it again
+        i = pending[index]
+        batch_checkpoints.save(user_id, batch_id, hashes[i], images[i][1], result['image_url'], result['ocr_result'])
+        result['image_hash'] = hashes[i]
+    
+    return restored, pending, checkpoint
+
+async def run_batch(user_id: int, images: List[tuple], on_progress=None, batch_id: str = None,
+                    unreadable: Optional[dict] = None) -> dict:
+    """
+    OCR, normalize, export and bill one batch of (bytes, filename, content_type) images.
+    Shared by the synchronous /process/batch route and the /jobs workers.
+    unreadable maps batch positions that couldn't even be read (process_keys) to their
+    image_failure; images then holds the other positions, in order.
+    The whole batch is reserved against the monthly quota before any work starts (403 if it
+    doesn't fit); images that fail are listed in failed_images and left out of the export and
+    the bill, and the batch only fails as a whole if none of them succeeded.
+    With a batch_id every image is checkpointed as it finishes, and images checkpointed by an
+    earlier submission of the same batch are restored instead of processed again.
+    """
+    loop = asyncio.get_running_loop()
+    reservation = QuotaReservation(user_id)
+    await loop.run_in_executor(ocr_executor, reservation.reserve, len(images))
+    tier, config = reservation.tier, reservation.config
+    timer = StageTimer(config['ocr_engine'], tier)
+    
+    try:
+        restored, pending, checkpoint = {}, list(range(len(images))), None
+        if batch_id:
+            with timer.stage("restore"):
+                restored, pending, checkpoint = await restore_checkpoints(user_id, batch_id, images)
+        
+        progress = None
+        if on_progress:
+            progress = lambda done: on_progress(done + len(restored))
+        with timer.stage("images"):
+            processed = await process_images_concurrently(
+                [images[i] for i in pending], user_id, config, progress, checkpoint
+            )
+        results = [restored.get(i) for i in range(len(images))]
+        for i, result in zip(pending, processed):
+            results[i] = result
+        if unreadable:
+            readable = iter(results)
+            results = [unreadable[i] if i in unreadable else next(readable)
+                       for i in range(len(images) + len(unreadable))]
+        return await finish_batch(user_id, tier, results, batch_id, timer, reservation)
+    except BaseException:
+        await loop.run_in_executor(ocr_executor, reservation.release)
+        raise
+
+async def finish_batch(user_id: int, tier: str, results: List[dict], batch_id: str = None,
+                       timer: Optional[StageTimer] = None,
+                       reservation: Optional[QuotaReservation] = None) -> dict:
+    """
+    Normalize, export and bill a batch from its per-image results (upload order).
+    Shared by run_batch and the streaming route. timer carries the stages the caller already
+    timed; the per-stage totals end up in the batch's usage_logs details. Billing settles the
+    caller's quota reservation; releasing it if this raises is up to the caller.
+    """
+    loop = asyncio.get_running_loop()
+    engine = TIER_CONFIGS[tier]['ocr_engine']
+    timer = timer or StageTimer(engine, tier)
+    images_total = len(results)
+    restored_count = sum(1 for result in results if result.get('restored'))
+    
+    failed_images = [
+        {"index": i, "filename": result['filename'], "error": result['error']}
+        for i, result in enumerate(results) if result['status'] == "failed"
+    ]
+    results = [result for result in results if result['status'] == "succeeded"]
+    
+    for result in results:
+        outcome = "restored" if result.get('restored') else "cache_hit" if result['cache_hit'] else "ocr"
+        IMAGES.labels(engine, tier, outcome).inc()
+        timer.observe_image(result['ocr_stats'])
+    IMAGES.labels(engine, tier, "failed").inc(len(failed_images))
+    
+    if not results:
+        BATCHES.labels(engine, tier, "failed").inc()
+        raise HTTPException(
+            status_code=502,
+            detail=f"All {images_total} images failed. First error: {failed_images[0]['error']}"
+        )
+    
+    # Normalize image by image (results are in upload order), then one wide frame for Excel
+    with timer.stage("normalize"):
+        normalizer = DataNormalizer()
+        extracted_data = []
+        industries = []
+        for result in results:
+            normalized, industry = normalizer.normalize_data(result['ocr_result']['structured_data'])
+            extracted_data.append(normalized)
+            industries.append(industry)
+        frame = pd.DataFrame(extracted_data)
+    image_urls = [result['image_url'] for result in results]
+    
+    for normalized, result, industry in zip(extracted_data, results, industries):
+        normalized['_metadata'] = {
+            "image_url": result['image_url'],
+            "industry": industry,
+            "ocr_engine": result['ocr_result']['engine'],
+            "ocr_cached": result['cache_hit'],
+            "restored": result.get('restored', False),
+            "ocr_stats": result['ocr_stats']
+        }
+    
+    # Detect main industry
+    main_industry = max(set(industries), key=industries.count) if industries else "general"
+    
+    # Generate the Excel file, streaming it to S3 as it is written
+    thumbnails = [result['thumbnail'] for result in results]
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    excel_filename = f"batch_{tier}_{main_industry}_{timestamp}.xlsx"
+    with timer.stage("excel"):
+        excel_url, thumbnail_failures = await loop.run_in_executor(
+            ocr_executor, export_excel, frame, image_urls, main_industry, user_id, excel_filename, thumbnails, timer
+        )
+    
+    # Update user stats and log usage. Checkpointed images are charged only by the submission
+    # of the batch that bills their checkpoint.
+    cache_hits = sum(1 for result in results if result['cache_hit'])
+    ocr_calls = [r for r in results if not r['cache_hit'] and not r.get('restored')]
+    upload_failures = sum(1 for result in results if result.get('upload_error'))
+    ocr_stats = {
+        "ocr_cache_misses": len(ocr_calls),
+        "ocr_bytes_original": sum(r['ocr_stats']['original_bytes'] for r in ocr_calls),
+        "ocr_bytes_sent": sum(r['ocr_stats']['request_bytes'] for r in ocr_calls),
+        "ocr_seconds": round(sum(r['ocr_stats']['ocr_ms'] for r in ocr_calls) / 1000, 2),
+        "upload_seconds": round(sum(r['ocr_stats'].get('upload_ms', 0) for r in ocr_calls) / 1000, 2),
+        "upload_wait_seconds": round(sum(r['ocr_stats'].get('upload_wait_ms', 0) for r in ocr_calls) / 1000, 2),
+        "prepare_seconds": round(sum(r['ocr_stats'].get('prepare_ms', 0) for r in ocr_calls) / 1000, 2),
+        "images_failed": len(failed_images),
+        "images_restored": restored_count,
+        "upload_failures": upload_failures,
+        # Wall time of every stage so far; the usage write itself only shows up in /metrics
+        "stage_seconds": timer.as_dict()
+    }
+    with timer.stage("db"):
+        images_this_month, images_charged = await loop.run_in_executor(
+            ocr_executor, record_batch_usage,
+            user_id, tier, len(results), main_industry, cache_hits, thumbnail_failures, ocr_stats, batch_id,
+            reservation, [result.get('image_hash') for result in results]
+        )
+    
+    batch_status = "partial" if failed_images else "success"
+    BATCHES.labels(engine, tier, batch_status).inc()
+    return {
+        "status": batch_status,
+        "batch_id": batch_id,
+        "images_processed": len(results),
+        "images_restored": restored_count,
+        "images_charged": images_charged,
+        "images_failed": len(failed_images),
+        "failed_images": failed_images,
+        "industry_detected": main_industry,
+        "excel_url": excel_url,
+        "thumbnail_failures": thumbnail_failures,
+        "upload_failures": upload_failures,
+        "remaining_images": TIER_CONFIGS[tier]['max_images'] - images_this_month,
+        "normalized_data": extracted_data
+    }
+
+# ===========================================
+# STREAMING INGESTION
+# ===========================================
+
+class MultipartSpooler:
+    """
+    Incremental multipart/form-data parser (python-multipart). File parts are written to a
+    SpooledTemporaryFile as their bytes arrive, so a part never sits whole in the request
+    buffer. write() returns the parts finished by each chunk as (file, filename, content_type);
+    plain form fields are ignored.
+    """
+    
+    def __init__(self, content_type: str):
+        ctype, options = parse_options_header(content_type)
+        if ctype != b"multipart/form-data" or b"boundary" not in options:
+            raise HTTPException(status_code=400, detail="Expected a multipart/form-data body")
+        
+        self._finished = []
+        self._headers = {}
+        self._field = b""
+        self._value = b""
+        self._file = None
+        self._filename = None
+        self._content_type = None
+        self.parser = MultipartParser(options[b"boundary"], {
+            "on_part_begin": self._on_part_begin,
+            "on_header_field": self._on_header_field,
+            "on_header_value": self._on_header_value,
+            "on_header_end": self._on_header_end,
+            "on_headers_finished": self._on_headers_finished,
+            "on_part_data": self._on_part_data,
+            "on_part_end": self._on_part_end
+        })
+    
+    def _on_part_begin(self):
+        self._headers = {}
+        self._file = None
+    
+    def _on_header_field(self, data, start, end):
+        self._field += data[start:end]
+    
+    def _on_header_value(self, data, start, end):
+        self._value += data[start:end]
+    
+    def _on_header_end(self):
+        self._headers[self._field.lower()] = self._value
+        self._field = self._value = b""
+    
+    def _on_headers_finished(self):
+        _, disposition = parse_options_header(self._headers.get(b"content-disposition", b""))
+        if b"filename" not in disposition:
+            return
+        self._filename = disposition[b"filename"].decode("utf-8", "replace")
+        self._content_type = self._headers.get(b"content-type", b"image/jpeg").decode("latin-1")
+        self._file = tempfile.SpooledTemporaryFile(max_size=STREAM_SPOOL_MEMORY)
+    
+    def _on_part_data(self, data, start, end):
+        if self._file is not None:
+            self._file.write(data[start:end])
+    
+    def _on_part_end(self):
+        if self._file is not None:
+            self._file.seek(0)
+            self._finished.append((self._file, self._filename, self._content_type))
+            self._file = None
+    
+    def _parse(self, step, *args):
+        try:
+            step(*args)
+        except FormParserError as e:
+            self.abort()
+            raise HTTPException(status_code=400, detail=f"Malformed multipart body: {e}")
+    
+    def write(self, chunk: bytes) -> list:
+        self._parse(self.parser.write, chunk)
+        finished, self._finished = self._finished, []
+        return finished
+    
+    def close(self) -> list:
+        self._parse(self.parser.finalize)
+        finished, self._finished = self._finished, []
+        self.abort()
+        return finished
+    
+    def abort(self):
+        """Close the part being written and any finished part not handed to the caller yet"""
+        for spooled, _, _ in self._finished:
+            spooled.close()
+        self._finished = []
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+async def stream_batch(request: Request, user_id: int, config: dict, reservation: QuotaReservation,
+                       batch_id: str = None) -> List[dict]:
+    """
+    Per-image results (upload order) for a multipart body that is parsed while it streams in.
+    Parts flow through bounded queues: spooled part -> stage (cache / resize / S3) -> OCR, with
+    config['ocr_concurrency'] workers per stage. When the queues are full the body stops being
+    read, so a slow pipeline slows the client down instead of the server buffering the batch:
+    peak memory follows the concurrency and STREAM_QUEUE_SIZE, not the number of images.
+    The batch size isn't known up front, so each part is reserved against the quota as it
+    arrives. Images checkpointed under batch_id are restored as in run_batch.
+    """
+    loop = asyncio.get_running_loop()
+    saved = {}
+    if batch_id:
+        saved = await loop.run_in_executor(ocr_executor, batch_checkpoints.load, user_id, batch_id)
+    
+    spooler = MultipartSpooler(request.headers.get("content-type", ""))
+    parts = asyncio.Queue(maxsize=STREAM_QUEUE_SIZE)
+    staged_images = asyncio.Queue(maxsize=STREAM_QUEUE_SIZE)
+    results = []
+    workers = config['ocr_concurrency']
+    batched = config['ocr_engine'] == 'google_vision' and VISION_BATCH_SIZE > 1
+    
+    async def succeeded(index, filename, image_hash, result):
+        results[index] = result
+        if batch_id and not result.get('upload_error'):
+            await loop.run_in_executor(
+                ocr_executor, batch_checkpoints.save, user_id, batch_id, image_hash,
+                filename, result['image_url'], result['ocr_result']
+            )
+            result['image_hash'] = image_hash
+    
+    async def finish(staged, ocr_result, ocr_ms):
+        try:
+            if isinstance(ocr_result, Exception):
+                discard_upload(staged['upload_future'])
+                raise ocr_result
+            result = await loop.run_in_executor(
+                ocr_executor, finish_image, staged, ocr_result, ocr_ms, user_id, config
+            )
+            await succeeded(staged['index'], staged['filename'], staged['image_hash'], result)
+        except Exception as e:
+            results[staged['index']] = image_failure(staged['filename'], e)
+    
+    async def stage_worker():
+        while (part := await parts.get()) is not None:
+            index, spooled, filename, content_type = part
+            try:
+                image_bytes = await loop.run_in_executor(ocr_executor, spooled.read)
+            finally:
+                spooled.close()
+            try:
+                image_hash = BatchCheckpoints.image_hash(image_bytes) if batch_id else None
+                if image_hash in saved:
+                    results[index] = await loop.run_in_executor(
+                        ocr_executor, restored_result, saved[image_hash], image_bytes
+                    )
+                    continue
+                staged = await loop.run_in_executor(
+                    ocr_executor, stage_image,
+                    image_bytes, filename, content_type, user_id, config
+                )
+                del image_bytes
+                if staged['status'] == "succeeded":
+                    await succeeded(index, filename, image_hash, staged)
+                else:
+                    staged.update(index=index, filename=filename, image_hash=image_hash)
+                    await staged_images.put(staged)
+            except Exception as e:
+                results[index] = image_failure(filename, e)
+    
+    async def ocr_worker():
+        while (staged := await staged_images.get()) is not None:
+            chunk = [staged]
+            # Vision takes whatever else is already waiting, up to one API call's worth
+            while batched and len(chunk) < VISION_BATCH_SIZE and not staged_images.empty():
+                staged = staged_images.get_nowait()
+                if staged is None:
+                    await staged_images.put(None)
+                    break
+                chunk.append(staged)
+            
+            try:
+                if batched:
+                    ocr_results = await google_vision_batch_ocr([s['ocr_bytes'] for s in chunk], 1)
+                else:
+                    outcome = await loop.run_in_executor(ocr_executor, ocr_or_error, ocr_staged, staged, config)
+                    ocr_results = [(outcome, 0.0) if isinstance(outcome, Exception) else outcome]
+            except BaseException:
+                for staged in chunk:
+                    discard_upload(staged['upload_future'])
+                raise
+            for staged, (ocr_result, ocr_ms) in zip(chunk, ocr_results):
+                await finish(staged, ocr_result, ocr_ms)
+    
+    stage_tasks = [asyncio.create_task(stage_worker()) for _ in range(workers)]
+    ocr_tasks = [asyncio.create_task(ocr_worker()) for _ in range(workers)]
+    try:
+        async def enqueue(finished):
+            # A part leaves `finished` once it's in the queue; the rest are closed if the batch is rejected
+            try:
+                while finished:
+                    spooled, filename, content_type = finished[0]
+                    if len(results) >= config['max_images_per_batch']:
+                        raise HTTPException(
+                            status_code=400,
+                            detail=f"Batch too large. Max {config['max_images_per_batch']} images per batch"
+                        )
+                    await loop.run_in_executor(ocr_executor, reservation.reserve, 1)
+                    results.append(None)
+                    await parts.put((len(results) - 1, spooled, filename, content_type))
+                    finished.pop(0)
+            finally:
+                for spooled, _, _ in finished:
+                    spooled.close()
+        
+        async for chunk in request.stream():
+            await enqueue(spooler.write(chunk))
+        await enqueue(spooler.close())
+        if not results:
+            raise HTTPException(status_code=400, detail="No files in the request")
+        
+        for _ in stage_tasks:
+            await parts.put(None)
+        await asyncio.gather(*stage_tasks)
+        for _ in ocr_tasks:
+            await staged_images.put(None)
+        await asyncio.gather(*ocr_tasks)
+        return results
+    finally:
+        spooler.abort()
+        for task in stage_tasks + ocr_tasks:
+            task.cancel()
+        while not parts.empty():
+            part = parts.get_nowait()
+            if part is not None:
+                part[1].close()
+        while not staged_images.empty():
+            staged = staged_images.get_nowait()
+            if staged is not None:
+                discard_upload(staged['upload_future'])
+
+# ===========================================
+# BATCH JOBS
+# ===========================================
+
+JOB_FIELDS = ("status", "images_total", "images_done", "industry_detected", "excel_url", "normalized_data",
+              "failed_images", "error")
+JOB_ACTIVE = ("queued", "processing")
+JOB_INTERRUPTED = ("The server stopped before this job finished. Submit the batch again; with the same "
+                   "batch_id, images that were already processed are not processed or charged again")
+
+class LocalJobStore:
+    """In-process job store (JOB_BACKEND=local). Only this process can see its jobs"""
+    
+    def __init__(self):
+        self._jobs = {}
+        self._lock = threading.Lock()
+    
+    def create(self, user_id: int, images_total: int) -> str:
+        job_id = str(uuid.uuid4())
+        now = datetime.utcnow()
+        with self._lock:
+            self._jobs[job_id] = {
+                "id": job_id, "user_id": user_id, "status": "queued",
+                "images_total": images_total, "images_done": 0,
+                "industry_detected": None, "excel_url": None, "normalized_data": None,
+                "failed_images": None, "error": None,
+                "created_at": now, "updated_at": now
+            }
+        return job_id
+    
+    def update(self, job_id: str, **fields):
+        with self._lock:
+            job = self._jobs[job_id]
+            if job["status"] in JOB_ACTIVE:
+                job.update({k: v for k, v in fields.items() if k in JOB_FIELDS})
+                job["updated_at"] = datetime.utcnow()
+    
+    def get(self, job_id: str, user_id: int) -> Optional[dict]:
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return dict(job) if job and job["user_id"] == user_id else None
+    
+    def touch(self, job_ids: List[str]):
+        now = datetime.utcnow()
+        with self._lock:
+            for job_id in job_ids:
+                if self._jobs[job_id]["status"] in JOB_ACTIVE:
+                    self._jobs[job_id]["updated_at"] = now
+    
+    def fail(self, job_ids: List[str], error: str):
+        now = datetime.utcnow()
+        with self._lock:
+            for job_id in job_ids:
+                if self._jobs[job_id]["status"] in JOB_ACTIVE:
+                    self._jobs[job_id].update(status="failed", error=error, updated_at=now)
+    
+    def fail_stale(self, max_age: float, error: str) -> int:
+        # Jobs live and die with this process, so none can be left behind by another one
+        return 0
+
+class PostgresJobStore:
+    """Job store backed by the batch_jobs table, so any API replica can serve status calls"""
+    
+    def create(self, user_id: int, images_total: int) -> str:
+        job_id = str(uuid.uuid4())
+        with db_pool.connection() as conn:
+            cursor = conn.cursor()
+            try:
+                cursor.execute(
+                    "INSERT INTO batch_jobs (id, user_id, status, images_total) VALUES (%s, %s, 'queued', %s)",
+                    (job_id, user_id, images_total)
+                )
+                conn.commit()
+            finally:
+                cursor.close()
+        return job_id
+    
+    def update(self, job_id: str, **fields):
+        """Update a queued/processing job; a job already failed (e.g. as stale by another replica) stays failed"""
+        fields = {k: v for k, v in fields.items() if k in JOB_FIELDS}
+        for key in ("normalized_data", "failed_images"):
+            if key in fields:
+                fields[key] = json.dumps(fields[key], default=str)
+        assignments = ", ".join(f"{k} = %s" for k in fields)
+        with db_pool.connection() as conn:
+            cursor = conn.cursor()
+            try:
+                cursor.execute(
+                    f"UPDATE batch_jobs SET {assignments} WHERE id = %s AND status IN %s",
+                    (*fields.values(), job_id, JOB_ACTIVE)
+                )
+                conn.commit()
+            finally:
+                cursor.close()
+    
+    def get(self, job_id: str, user_id: int) -> Optional[dict]:
+        with db_pool.connection() as conn:
+            cursor = conn.cursor()
+            try:
+                cursor.execute(
+                    """SELECT id, user_id, status, images_total, images_done, industry_detected,
+                              excel_url, normalized_data, failed_images, error, created_at, updated_at
+                       FROM batch_jobs WHERE id = %s AND user_id = %s""",
+                    (job_id, user_id)
+                )
+                return cursor.fetchone()
+            finally:
+                cursor.close()
+    
+    def _fail_where(self, error: str, condition: str, value) -> int:
+        with db_pool.connection() as conn:
+            cursor = conn.cursor()
+            try:
+                cursor.execute(
+                    f"UPDATE batch_jobs SET status = 'failed', error = %s WHERE status IN %s AND {condition}",
+                    (error, JOB_ACTIVE, value)
+                )
+                conn.commit()
+                return cursor.rowcount
+            finally:
+                cursor.close()
+    
+    def touch(self, job_ids: List[str]):
+        """Heartbeat: bump updated_at on jobs that are still queued or running"""
+        with db_pool.connection() as conn:
+            cursor = conn.cursor()
+            try:
+                cursor.execute(
+                    "UPDATE batch_jobs SET updated_at = CURRENT_TIMESTAMP WHERE id = ANY(%s::uuid[]) AND status IN %s",
+                    (job_ids, JOB_ACTIVE)
+                )
+                conn.commit()
+            finally:
+                cursor.close()
+    
+    def fail(self, job_ids: List[str], error: str):
+        self._fail_where(error, "id = ANY(%s::uuid[])", job_ids)
+    
+    def fail_stale(self, max_age: float, error: str) -> int:
+        """Fail queued/processing jobs whose replica stopped heartbeating max_age seconds ago"""
+        return self._fail_where(error, "updated_at < CURRENT_TIMESTAMP - %s * INTERVAL '1 second'", max_age)
+
+class JobRunner:
+    """
+    Runs submitted batches as background tasks, at most JOB_WORKERS at a time. Images only live in
+    this process, so a job can't outlive it: shutdown() fails the unfinished ones, and a watcher
+    heartbeats them while they run and fails jobs whose replica died without a clean shutdown.
+    The quota is reserved when a job starts, not when it is accepted, so a job can still fail
+    with "Monthly limit exceeded" if other batches used up the quota in between.
+    """
+    
+    def __init__(self, store, workers: int, heartbeat: float, stale_after: float):
+        self.store = store
+        self.workers = workers
+        self.heartbeat = heartbeat
+        self.stale_after = stale_after
+        self._semaphore = None
+        self._watcher = None
+        self._jobs = {}  # task -> job_id
+    
+    def submit(self, job_id: str, user_id: int, images: List[tuple], batch_id: str = None):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.workers)
+        task = asyncio.create_task(self._run(job_id, user_id, images, batch_id))
+        # Keep a reference so the task isn't garbage collected mid-run
+        self._jobs[task] = job_id
+        task.add_done_callback(lambda task: self._jobs.pop(task, None))
+    
+    def start(self):
+        """Start the heartbeat / stale job watcher (call from the running event loop)"""
+        if self._watcher is None:
+            self._watcher = asyncio.create_task(self._watch())
+    
+    async def _watch(self):
+        # Job store calls go to the request threadpool: on ocr_executor a heartbeat would queue
+        # behind the OCR work of the very jobs it reports on
+        while True:
+            try:
+                if self._jobs:
+                    await run_in_threadpool(self.store.touch, list(self._jobs.values()))
+                failed = await run_in_threadpool(self.store.fail_stale, self.stale_after, JOB_INTERRUPTED)
+                if failed:
+                    print(f"Marked {failed} abandoned jobs as failed")
+            except Exception as e:
+                print(f"Job heartbeat failed: {e}")
+            await asyncio.sleep(self.heartbeat)
+    
+    def shutdown(self):
+        """Fail the jobs still queued or running here so clients stop polling them (blocking)"""
+        if self._watcher is not None:
+            self._watcher.cancel()
+        if not self._jobs:
+            return
+        try:
+            self.store.fail(list(self._jobs.values()), JOB_INTERRUPTED)
+        except Exception as e:
+            print(f"Could not fail {len(self._jobs)} unfinished jobs: {e}")
+        for task in list(self._jobs):
+            task.cancel()
+    
+    async def _run(self, job_id: str, user_id: int, images: List[tuple], batch_id: str = None):
+        async def update(**fields):
+            await run_in_threadpool(self.store.update, job_id, **fields)
+        
+        async with self._semaphore:
+            try:
+                await update(status="processing")
+                result = await run_batch(
+                    user_id, images,
+                    on_progress=lambda done: update(images_done=done),
+                    batch_id=batch_id
+                )
+                await update(
+                    status="partial" if result['failed_images'] else "completed",
+                    industry_detected=result['industry_detected'],
+                    excel_url=result['excel_url'],
+                    normalized_data=result['normalized_data'],
+                    failed_images=result['failed_images']
+                )
+            except Exception as e:
+                detail = e.detail if isinstance(e, HTTPException) else str(e)
+                await update(status="failed", error=detail)
+
+job_store = LocalJobStore() if JOB_BACKEND == "local" else PostgresJobStore()
+job_runner = JobRunner(job_store, JOB_WORKERS, JOB_HEARTBEAT_SECONDS, JOB_STALE_SECONDS)
+
+@app.on_event("startup")
+async def start_job_runner():
+    job_runner.start()
 
 # ===========================================
 # ROUTES
@@ -479,267 +3125,478 @@ def read_root():
     }
 
 @app.get("/health")
-def health_check():
+def health_check(conn = Depends(get_db)):
     """Check if the API and database are working"""
     try:
-        conn = get_db_connection()
         cursor = conn.cursor()
         cursor.execute("SELECT 1")
         cursor.close()
-        conn.close()
-        return {"status": "healthy", "database": "connected", "ocr": "ready"}
+        return {"status": "healthy", "database": "connected", "ocr": "ready", "db_pool": db_pool.stats(),
+                "gemini": gemini_client.stats(), "usage_log": usage_log.stats()}
     except Exception as e:
         raise HTTPException(status_code=503, detail=f"Service unavailable: {str(e)}")
 
+@app.get("/metrics", dependencies=[Depends(require_metrics_token)])
+def metrics():
+    """
+    Prometheus metrics for this process (stage latencies, image/batch counters, DB pool, Gemini client).
+    Internal: needs Authorization: Bearer METRICS_TOKEN.
+    """
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+def email_registered(email: str) -> bool:
+    with db_pool.connection() as conn:
+        cursor = conn.cursor()
+        try:
+            cursor.execute("SELECT id FROM users WHERE email = %s", (email,))
+            return cursor.fetchone() is not None
+        finally:
+            cursor.close()
+
+def create_user(user: UserCreate, hashed_password: str) -> int:
+    """Insert the user and log the registration (blocking). Returns the new user id"""
+    with db_pool.connection() as conn:
+        cursor = conn.cursor()
+        try:
+            cursor.execute(
+                "INSERT INTO users (email, password_hash, name, tier) VALUES (%s, %s, %s, %s) RETURNING id",
+                (user.email, hashed_password, user.name, user.tier)
+            )
+            user_id = cursor.fetchone()['id']
+            conn.commit()
+        except psycopg2.errors.UniqueViolation:
+            # Registered by a concurrent request while the password was being hashed
+            raise HTTPException(status_code=400, detail="Email already registered")
+        finally:
+            cursor.close()
+    
+    log_usage(user_id, "user_registered", {"tier": user.tier})
+    return user_id
+
+def find_login_user(email: str) -> Optional[dict]:
+    with db_pool.connection() as conn:
+        cursor = conn.cursor()
+        try:
+            cursor.execute(
+                "SELECT id, email, name, password_hash, tier FROM users WHERE email = %s",
+                (email,)
+            )
+            return cursor.fetchone()
+        finally:
+            cursor.close()
+
+def record_login(user_id: int, new_hash: Optional[str] = None):
+    """Log the login and store the upgraded password hash, if any (blocking only when there is one)"""
+    if new_hash:
+        with db_pool.connection() as conn:
+            cursor = conn.cursor()
+            try:
+                cursor.execute("UPDATE users SET password_hash = %s WHERE id = %s", (new_hash, user_id))
+                conn.commit()
+            finally:
+                cursor.close()
+    log_usage(user_id, "user_login", {"password_rehashed": True} if new_hash else None)
+
 @app.post("/auth/register")
-def register(user: UserCreate):
-    """Register a new user"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
+async def register(user: UserCreate):
+    """
+    Register a new user (the password is hashed on password_hasher's process pool). The short DB
+    calls run on the request threadpool, never behind OCR work on ocr_executor.
+    """
+    if user.tier not in TIER_CONFIGS:
+        raise HTTPException(status_code=400, detail="Invalid tier")
     
-    try:
-        # Validate tier
-        if user.tier not in TIER_CONFIGS:
-            raise HTTPException(status_code=400, detail="Invalid tier")
-        
-        # Check if user exists
-        cursor.execute("SELECT id FROM users WHERE email = %s", (user.email,))
-        if cursor.fetchone():
-            raise HTTPException(status_code=400, detail="Email already registered")
-        
-        # Create user
-        hashed_password = hash_password(user.password)
-        cursor.execute(
-            "INSERT INTO users (email, password_hash, name, tier) VALUES (%s, %s, %s, %s) RETURNING id",
-            (user.email, hashed_password, user.name, user.tier)
-        )
-        user_id = cursor.fetchone()['id']
-        conn.commit()
-        
-        # Create token
-        token = create_access_token({"sub": str(user_id)})
-        
-        log_usage(user_id, "user_registered", {"tier": user.tier})
-        
-        return {
-            "access_token": token,
-            "token_type": "bearer",
-            "user": {
-                "id": user_id,
-                "email": user.email,
-                "name": user.name,
-                "tier": user.tier
-            }
+    if await run_in_threadpool(email_registered, user.email):
+        raise HTTPException(status_code=400, detail="Email already registered")
+    
+    hashed_password = await password_hasher.hash(user.password)
+    user_id = await run_in_threadpool(create_user, user, hashed_password)
+    
+    # Create token
+    token = create_access_token({"sub": str(user_id)})
+    
+    return {
+        "access_token": token,
+        "token_type": "bearer",
+        "user": {
+            "id": user_id,
+            "email": user.email,
+            "name": user.name,
+            "tier": user.tier
         }
-    finally:
-        cursor.close()
-        conn.close()
+    }
 
 @app.post("/auth/login")
-def login(credentials: UserLogin):
-    """Login user"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
+async def login(credentials: UserLogin):
+    """Login user (DB calls as in register). Hashes made with an older BCRYPT_ROUNDS are upgraded on the way"""
+    user = await run_in_threadpool(find_login_user, credentials.email)
+    if not user:
+        raise HTTPException(status_code=401, detail="Invalid credentials")
     
-    try:
-        cursor.execute(
-            "SELECT id, email, name, password_hash, tier FROM users WHERE email = %s",
-            (credentials.email,)
-        )
-        user = cursor.fetchone()
-        
-        if not user or not verify_password(credentials.password, user['password_hash']):
-            raise HTTPException(status_code=401, detail="Invalid credentials")
-        
-        token = create_access_token({"sub": str(user['id'])})
-        
-        log_usage(user['id'], "user_login")
-        
-        return {
-            "access_token": token,
-            "token_type": "bearer",
-            "user": {
-                "id": user['id'],
-                "email": user['email'],
-                "name": user['name'],
-                "tier": user['tier']
-            }
+    matches, new_hash = await password_hasher.check(credentials.password, user['password_hash'])
+    if not matches:
+        raise HTTPException(status_code=401, detail="Invalid credentials")
+    
+    token = create_access_token({"sub": str(user['id'])})
+    if new_hash:
+        await run_in_threadpool(record_login, user['id'], new_hash)
+    else:
+        record_login(user['id'])  # only buffers the usage event, no DB work
+    
+    return {
+        "access_token": token,
+        "token_type": "bearer",
+        "user": {
+            "id": user['id'],
+            "email": user['email'],
+            "name": user['name'],
+            "tier": user['tier']
         }
-    finally:
-        cursor.close()
-        conn.close()
+    }
+
+def validate_batch_id(batch_id: Optional[str]) -> Optional[str]:
+    if batch_id is not None and not 0 < len(batch_id) <= 100:
+        raise HTTPException(status_code=400, detail="batch_id must be 1-100 characters")
+    return batch_id
 
 @app.post("/process/batch")
 async def process_batch(
     files: List[UploadFile] = File(...),
+    batch_id: Optional[str] = Form(None),
     user_id: int = Depends(get_current_user)
 ):
-    """Process multiple images with OCR and normalization"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
+    """
+    Process multiple images with OCR and normalization.
+    Send a batch_id to make the batch resumable: resubmitting it only processes missing images.
+    """
+    validate_batch_id(batch_id)
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(ocr_executor, check_batch_limits, user_id, len(files))
     
+    # Read images, then upload + OCR them concurrently off the event loop
+    images = [
+        (await file.read(), file.filename, file.content_type or 'image/jpeg')
+        for file in files
+    ]
+    return await run_batch(user_id, images, batch_id=batch_id)
+
+@app.post("/process/batch/stream")
+async def process_batch_stream(
+    request: Request,
+    batch_id: Optional[str] = None,
+    user_id: int = Depends(get_current_user)
+):
+    """
+    Same as /process/batch, but the multipart body is processed while it uploads instead of
+    being buffered first, so memory stays flat however many images the batch has.
+    batch_id goes in the query string because the body is consumed as a stream.
+    """
+    validate_batch_id(batch_id)
+    loop = asyncio.get_running_loop()
+    context = await loop.run_in_executor(ocr_executor, check_batch_limits, user_id, 1)
+    tier, config = context['tier'], context['config']
+    
+    reservation = QuotaReservation(user_id)
+    timer = StageTimer(config['ocr_engine'], tier)
     try:
-        # Get user tier
-        cursor.execute("SELECT tier, images_processed_this_month FROM users WHERE id = %s", (user_id,))
-        user = cursor.fetchone()
-        
-        if not user:
-            raise HTTPException(status_code=404, detail="User not found")
-        
-        tier = user['tier']
-        config = TIER_CONFIGS[tier]
-        images_this_month = user['images_processed_this_month'] or 0
-        
-        # Check limits
-        if len(files) > config['max_images_per_batch']:
-            raise HTTPException(
-                status_code=400, 
-                detail=f"Batch too large. Max {config['max_images_per_batch']} images per batch for {tier} tier"
-            )
-        
-        if images_this_month + len(files) > config['max_images']:
-            raise HTTPException(
-                status_code=403,
-                detail=f"Monthly limit exceeded. {images_this_month}/{config['max_images']} images used"
-            )
-        
-        # Process images
-        normalizer = DataNormalizer()
-        extracted_data = []
-        image_urls = []
-        industries = []
-        
-        for file in files:
-            # Read image
-            image_bytes = await file.read()
-            
-            # Upload to S3
-            image_url = upload_to_s3(
-                image_bytes,
-                file.filename,
-                user_id,
-                file.content_type or 'image/jpeg'
-            )
-            image_urls.append(image_url)
-            
-            # OCR
-            if config['ocr_engine'] == 'google_vision':
-                ocr_result = google_vision_ocr(image_bytes)
-            else:
-                ocr_result = gemini_ocr(image_bytes, file.content_type or 'image/jpeg')
-            
-            # Normalize
-            raw_data = ocr_result['structured_data']
-            normalized, industry = normalizer.normalize_data(raw_data)
-            industries.append(industry)
-            
-            normalized['_metadata'] = {
-                "image_url": image_url,
-                "industry": industry,
-                "ocr_engine": ocr_result['engine']
-            }
-            extracted_data.append(normalized)
-        
-        # Detect main industry
-        main_industry = max(set(industries), key=industries.count) if industries else "general"
-        
-        # Generate Excel
-        excel_bytes = generate_excel(extracted_data, image_urls, main_industry, user_id)
-        
-        # Upload Excel to S3
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        excel_filename = f"batch_{tier}_{main_industry}_{timestamp}.xlsx"
-        excel_url = upload_to_s3(excel_bytes, excel_filename, user_id, 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
-        
-        # Update user stats
-        cursor.execute(
-            "UPDATE users SET images_processed_this_month = images_processed_this_month + %s WHERE id = %s",
-            (len(files), user_id)
-        )
-        conn.commit()
-        
-        # Log usage
-        log_usage(user_id, "batch_processed", {
-            "images_processed": len(files),
-            "industry": main_industry,
-            "tier": tier,
-            "cost": 0.0
-        })
-        
-        return {
-            "status": "success",
-            "images_processed": len(files),
-            "industry_detected": main_industry,
-            "excel_url": excel_url,
-            "normalized_data": extracted_data,
-            "remaining_images": config['max_images'] - (images_this_month + len(files))
-        }
-        
-    finally:
-        cursor.close()
-        conn.close()
+        with timer.stage("images"):
+            results = await stream_batch(request, user_id, config, reservation, batch_id)
+        return await finish_batch(user_id, tier, results, batch_id, timer, reservation)
+    except BaseException:
+        await loop.run_in_executor(ocr_executor, reservation.release)
+        raise
+
+@app.post("/uploads/presign")
+async def presign_uploads(request: PresignRequest, user_id: int = Depends(get_current_user)):
+    """
+    Presigned POST policies for uploading a batch straight to S3, so image bytes never pass through the API.
+    POST each file to its url as multipart/form-data (the returned fields, then the file), then send
+    the keys to /process/keys.
+    """
+    if not request.files:
+        raise HTTPException(status_code=400, detail="No files to upload")
+    not_images = [f.filename for f in request.files if not f.content_type.startswith("image/")]
+    if not_images:
+        raise HTTPException(status_code=400, detail=f"Not an image content type: {', '.join(not_images)}")
+    
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(ocr_executor, check_batch_limits, user_id, len(request.files))
+    
+    return {
+        "uploads": [presign_upload(user_id, f.filename, f.content_type) for f in request.files],
+        "expires_in": PRESIGN_EXPIRES,
+        "max_bytes": UPLOAD_MAX_BYTES
+    }
+
+@app.post("/process/keys")
+async def process_keys(request: ProcessKeysRequest, user_id: int = Depends(get_current_user)):
+    """
+    Same as /process/batch for images uploaded with /uploads/presign: the objects are read from S3
+    in parallel and kept as the images' S3 copies. Keys must be the user's presigned uploads
+    (user_{id}/uploads/ prefix); a key that can't be read fails on its own, like any other image.
+    """
+    validate_batch_id(request.batch_id)
+    if not request.keys:
+        raise HTTPException(status_code=400, detail="No keys to process")
+    prefix = f"user_{user_id}/uploads/"
+    foreign = [key for key in request.keys if not key.startswith(prefix)]
+    if foreign:
+        raise HTTPException(status_code=403, detail=f"Keys outside {prefix}: {', '.join(foreign)}")
+    
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(ocr_executor, check_batch_limits, user_id, len(request.keys))
+    
+    async def fetch(key):
+        try:
+            return await loop.run_in_executor(s3_fetch_executor, fetch_upload, key)
+        except Exception as e:
+            return image_failure(key, e)
+    
+    fetched = await asyncio.gather(*[fetch(key) for key in request.keys])
+    images = [image for image in fetched if isinstance(image, tuple)]
+    unreadable = {i: image for i, image in enumerate(fetched) if isinstance(image, dict)}
+    return await run_batch(user_id, images, batch_id=request.batch_id, unreadable=unreadable)
+
+@app.post("/jobs", status_code=status.HTTP_202_ACCEPTED)
+async def submit_job(
+    files: List[UploadFile] = File(...),
+    batch_id: Optional[str] = Form(None),
+    user_id: int = Depends(get_current_user)
+):
+    """
+    Queue a batch for background processing and return its job id right away (batch_id as in
+    /process/batch). The quota is only checked here; it is reserved when the job starts (see JobRunner).
+    """
+    validate_batch_id(batch_id)
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(ocr_executor, check_batch_limits, user_id, len(files))
+    
+    images = [
+        (await file.read(), file.filename, file.content_type or 'image/jpeg')
+        for file in files
+    ]
+    
+    job_id = await run_in_threadpool(job_store.create, user_id, len(images))
+    job_runner.submit(job_id, user_id, images, batch_id)
+    
+    return {"job_id": job_id, "status": "queued", "images_total": len(images)}
+
+@app.get("/jobs/{job_id}")
+def get_job(job_id: str, user_id: int = Depends(get_current_user)):
+    """Get progress and, once completed, the results of a batch job"""
+    try:
+        uuid.UUID(job_id)
+    except ValueError:
+        raise HTTPException(status_code=404, detail="Job not found")
+    
+    job = job_store.get(job_id, user_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    
+    return {
+        "job_id": str(job['id']),
+        "status": job['status'],
+        "images_done": job['images_done'],
+        "images_total": job['images_total'],
+        "industry_detected": job['industry_detected'],
+        "excel_url": job['excel_url'],
+        "normalized_data": job['normalized_data'],
+        "failed_images": job['failed_images'],
+        "error": job['error'],
+        "created_at": job['created_at'],
+        "updated_at": job['updated_at']
+    }
+
+def usage_range(start: Optional[date], end: Optional[date]):
+    if start and end and start > end:
+        raise HTTPException(status_code=400, detail="start must be on or before end")
+    return start, end
 
 @app.get("/usage/stats")
-def get_usage_stats(user_id: int = Depends(get_current_user)):
-    """Get usage statistics for the current user"""
-    conn = get_db_connection()
+def get_usage_stats(
+    start: Optional[date] = None,
+    end: Optional[date] = None,
+    user_id: int = Depends(get_current_user),
+    conn = Depends(get_db)
+):
+    """
+    Get usage statistics for the current user. Totals are all-time, or for start..end (inclusive
+    days) when given; they come from the usage_daily / usage_monthly rollups, never usage_logs.
+    """
+    usage_range(start, end)
+    user = user_contexts.get(user_id, conn)
+    config = user['config']
     cursor = conn.cursor()
     
     try:
-        cursor.execute(
-            """SELECT tier, images_processed_this_month, created_at 
-               FROM users WHERE id = %s""",
-            (user_id,)
-        )
-        user = cursor.fetchone()
-        
-        if not user:
-            raise HTTPException(status_code=404, detail="User not found")
-        
-        config = TIER_CONFIGS[user['tier']]
-        
-        cursor.execute(
-            """SELECT COUNT(*) as total_batches, SUM(images_processed) as total_images
-               FROM usage_logs WHERE user_id = %s AND action = 'batch_processed'""",
-            (user_id,)
-        )
-        stats = cursor.fetchone()
+        if start or end:
+            cursor.execute(
+                """SELECT action, SUM(events) AS events, SUM(images_processed) AS images_processed
+                   FROM usage_daily
+                   WHERE user_id = %s AND day >= COALESCE(%s, '-infinity'::date) AND day <= COALESCE(%s, 'infinity'::date)
+                   GROUP BY action""",
+                (user_id, start, end)
+            )
+        else:
+            cursor.execute(
+                """SELECT action, SUM(events) AS events, SUM(images_processed) AS images_processed
+                   FROM usage_monthly WHERE user_id = %s GROUP BY action""",
+                (user_id,)
+            )
+        actions = {
+            row['action']: {"events": row['events'], "images_processed": row['images_processed']}
+            for row in cursor.fetchall()
+        }
+        batches = actions.get('batch_processed', {"events": 0, "images_processed": 0})
         
         return {
             "tier": user['tier'],
-            "images_this_month": user['images_processed_this_month'],
+            "images_this_month": user['images_this_month'],
             "max_images_per_month": config['max_images'],
             "max_images_per_batch": config['max_images_per_batch'],
-            "remaining_images": config['max_images'] - (user['images_processed_this_month'] or 0),
-            "total_batches_processed": stats['total_batches'] or 0,
-            "total_images_processed": stats['total_images'] or 0,
+            "remaining_images": config['max_images'] - user['images_this_month'],
+            "period": {"start": start, "end": end},
+            "total_batches_processed": batches['events'],
+            "total_images_processed": batches['images_processed'],
+            "actions": actions,
             "member_since": user['created_at']
         }
     finally:
         cursor.close()
-        conn.close()
 
-@app.get("/usage/logs")
-def get_usage_logs(user_id: int = Depends(get_current_user), limit: int = 50):
-    """Get usage logs for the current user"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
+@app.get("/usage/stats/history")
+def get_usage_history(
+    period: str = "day",
+    start: Optional[date] = None,
+    end: Optional[date] = None,
+    action: str = "batch_processed",
+    user_id: int = Depends(get_current_user),
+    conn = Depends(get_db)
+):
+    """
+    Usage of one action per day or month, from the rollups. Defaults to the last 30 days
+    (period=day) or 12 months (period=month) up to today; a day series covers at most 366 days.
+    """
+    if period not in ("day", "month"):
+        raise HTTPException(status_code=400, detail="period must be 'day' or 'month'")
+    usage_range(start, end)
+    end = end or date.today()
+    if period == "day":
+        start = start or end - timedelta(days=29)
+        if (end - start).days >= 366:
+            raise HTTPException(status_code=400, detail="A daily series covers at most 366 days")
+        sql = """SELECT day AS date, events, images_processed FROM usage_daily
+                 WHERE user_id = %s AND action = %s AND day BETWEEN %s AND %s ORDER BY day"""
+    else:
+        if start is None:
+            months = end.year * 12 + end.month - 12  # 11 months back, 0-based month index
+            start = date(months // 12, months % 12 + 1, 1)
+        start = start.replace(day=1)
+        sql = """SELECT month AS date, events, images_processed FROM usage_monthly
+                 WHERE user_id = %s AND action = %s AND month BETWEEN %s AND %s ORDER BY month"""
     
+    cursor = conn.cursor()
     try:
-        cursor.execute(
-            """SELECT id, action, details, images_processed, cost, created_at 
-               FROM usage_logs 
-               WHERE user_id = %s 
-               ORDER BY created_at DESC 
-               LIMIT %s""",
-            (user_id, limit)
-        )
-        logs = cursor.fetchall()
-        
-        return {"logs": logs}
+        cursor.execute(sql, (user_id, action, start, end))
+        return {"period": period, "action": action, "start": start, "end": end, "series": cursor.fetchall()}
     finally:
         cursor.close()
-        conn.close()
+
+def encode_log_cursor(row: dict) -> str:
+    """Opaque page cursor: the (created_at, id) of the last log on the page"""
+    position = json.dumps([row['created_at'].isoformat(), row['id']])
+    return base64.urlsafe_b64encode(position.encode()).decode().rstrip("=")
+
+def decode_log_cursor(cursor: str) -> tuple:
+    try:
+        created_at, log_id = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        return datetime.fromisoformat(created_at), int(log_id)
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+def fetch_usage_logs(user_id: int, action: Optional[str], start: Optional[date], end: Optional[date],
+                     after: Optional[tuple], limit: int) -> List[dict]:
+    """
+    One page of a user's logs, newest first (blocking). after is the (created_at, id) the previous
+    page ended on: the keyset condition lets the (user_id[, action], created_at, id) indexes seek
+    straight to it, so page 1000 costs the same as page 1.
+    """
+    conditions, params = ["user_id = %s"], [user_id]
+    if action:
+        conditions.append("action = %s")
+        params.append(action)
+    if start:
+        conditions.append("created_at >= %s")
+        params.append(start)
+    if end:
+        conditions.append("created_at < %s")
+        params.append(end + timedelta(days=1))
+    if after:
+        conditions.append("(created_at, id) < (%s, %s)")
+        params.extend(after)
+    
+    with db_pool.connection() as conn:
+        cursor = conn.cursor()
+        try:
+            cursor.execute(
+                f"""SELECT id, action, details, images_processed, cost, created_at
+                    FROM usage_logs
+                    WHERE {' AND '.join(conditions)}
+                    ORDER BY created_at DESC, id DESC
+                    LIMIT %s""",
+                (*params, limit)
+            )
+            return cursor.fetchall()
+        finally:
+            cursor.close()
+
+def export_usage_logs(user_id: int, action: Optional[str], start: Optional[date], end: Optional[date],
+                      after: Optional[tuple]):
+    """
+    NDJSON lines of every matching log, fetched USAGE_LOGS_MAX_PAGE rows per query by keyset.
+    Memory stays at one page however long the export, and no connection is held between pages.
+    """
+    while True:
+        page = fetch_usage_logs(user_id, action, start, end, after, USAGE_LOGS_MAX_PAGE)
+        if page:
+            yield "".join(json.dumps(jsonable_encoder(row)) + "\n" for row in page)
+        if len(page) < USAGE_LOGS_MAX_PAGE:
+            return
+        after = (page[-1]['created_at'], page[-1]['id'])
+
+@app.get("/usage/logs")
+def get_usage_logs(
+    limit: int = 50,
+    cursor: Optional[str] = None,
+    action: Optional[str] = None,
+    start: Optional[date] = None,
+    end: Optional[date] = None,
+    output: str = Query("json", alias="format"),
+    user_id: int = Depends(get_current_user)
+):
+    """
+    Get usage logs for the current user, newest first. Pages hold at most USAGE_LOGS_MAX_PAGE logs;
+    pass next_cursor back as cursor for the next one. Filters: action and start..end (inclusive days).
+    format=ndjson streams every matching log (from cursor on, ignoring limit) for bulk export.
+    """
+    if limit < 1:
+        raise HTTPException(status_code=400, detail="limit must be at least 1")
+    if output not in ("json", "ndjson"):
+        raise HTTPException(status_code=400, detail="format must be 'json' or 'ndjson'")
+    usage_range(start, end)
+    after = decode_log_cursor(cursor) if cursor else None
+    
+    if output == "ndjson":
+        return StreamingResponse(
+            export_usage_logs(user_id, action, start, end, after), media_type="application/x-ndjson"
+        )
+    
+    limit = min(limit, USAGE_LOGS_MAX_PAGE)
+    logs = fetch_usage_logs(user_id, action, start, end, after, limit + 1)
+    return {
+        "logs": logs[:limit],
+        "next_cursor": encode_log_cursor(logs[limit - 1]) if len(logs) > limit else None
+    }
 
 @app.get("/tiers")
 def get_tiers():
@@ -761,34 +3618,24 @@ def get_tiers():
 
 def create_thumbnail(image_bytes: bytes, max_size: tuple = (300, 300)) -> bytes:
     """Create thumbnail from image bytes"""
-    try:
-        img = Image.open(io.BytesIO(image_bytes))
-        img.thumbnail(max_size, Image.Resampling.LANCZOS)
-        
-        output = io.BytesIO()
-        img.save(output, format='JPEG', quality=85)
-        output.seek(0)
-        return output.read()
-    except Exception as e:
-        print(f"Error creating thumbnail: {e}")
-        return None
+    if max_size == THUMBNAIL_TARGETS["supplier"][0]:
+        return image_service.render_thumbnails(image_bytes, ("supplier",))["supplier"]
+    return render_thumbnails(image_bytes, {"thumbnail": (max_size, "JPEG")})["thumbnail"]
 
 @app.post("/suppliers")
-async def create_supplier(
+def create_supplier(
     name: str = Form(...),
     description: str = Form(None),
-    current_user: int = Depends(get_current_user)
+    current_user: int = Depends(get_current_user),
+    conn = Depends(get_db)
 ):
     """Create a new supplier/provider"""
     user_id = current_user
     
-    conn = psycopg2.connect(DATABASE_URL)
-    cursor = conn.cursor()
+    cursor = conn.cursor(cursor_factory=psycopg2.extensions.cursor)
     
     try:
-        # Get user tier
-        cursor.execute("SELECT tier FROM users WHERE id = %s", (user_id,))
-        tier = cursor.fetchone()[0]
+        tier = user_contexts.get(user_id, conn)['tier']
         tier_config = TIER_CONFIGS.get(tier, TIER_CONFIGS['free'])
         max_suppliers = tier_config.get('max_suppliers', 1)
         
@@ -838,15 +3685,13 @@ async def create_supplier(
         raise HTTPException(status_code=500, detail=str(e))
     finally:
         cursor.close()
-        conn.close()
 
 @app.get("/suppliers")
-async def list_suppliers(current_user: int = Depends(get_current_user)):
+def list_suppliers(current_user: int = Depends(get_current_user), conn = Depends(get_db)):
     """List all active suppliers for current user"""
     user_id = current_user
     
-    conn = psycopg2.connect(DATABASE_URL)
-    cursor = conn.cursor()
+    cursor = conn.cursor(cursor_factory=psycopg2.extensions.cursor)
     
     try:
         cursor.execute(
@@ -878,15 +3723,13 @@ async def list_suppliers(current_user: int = Depends(get_current_user)):
         raise HTTPException(status_code=500, detail=str(e))
     finally:
         cursor.close()
-        conn.close()
 
 @app.get("/suppliers/{supplier_id}/stats")
-async def get_supplier_stats(supplier_id: int, current_user: int = Depends(get_current_user)):
+def get_supplier_stats(supplier_id: int, current_user: int = Depends(get_current_user), conn = Depends(get_db)):
     """Get statistics for a supplier"""
     user_id = current_user
     
-    conn = psycopg2.connect(DATABASE_URL)
-    cursor = conn.cursor()
+    cursor = conn.cursor(cursor_factory=psycopg2.extensions.cursor)
     
     try:
         cursor.execute(
@@ -916,7 +3759,6 @@ async def get_supplier_stats(supplier_id: int, current_user: int = Depends(get_c
         raise HTTPException(status_code=500, detail=str(e))
     finally:
         cursor.close()
-        conn.close()
 
 if __name__ == "__main__":
     import uvicorn
@@ -0,0 +1,24 @@
+"""
+OCRimageflow - Contraseñas
+Hash y verificación bcrypt; los hashes con un coste menor al configurado se rehacen al iniciar sesión
+"""
+
+import bcrypt
+
+def hash_password(password: str, rounds: int) -> str:
+    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt(rounds)).decode('utf-8')
+
+def hash_rounds(hashed: str) -> int:
+    """Work factor of a bcrypt hash ($2b$12$... -> 12)"""
+    return int(hashed.split("$")[2])
+
+def check_password(password: str, hashed: str, rounds: int):
+    """
+    Verify password against hashed. Returns (matches, new_hash): new_hash is a fresh hash at
+    rounds when the password matches but hashed was made with a lower work factor, else None.
+    """
+    if not bcrypt.checkpw(password.encode('utf-8'), hashed.encode('utf-8')):
+        return False, None
+    if hash_rounds(hashed) < rounds:
+        return True, hash_password(password, rounds)
+    return True, None
@@ -6,10 +6,13 @@ Prueba todos los endpoints principales
 import requests
 import json
 import os
+import time
 
 # Change this to your API URL
 BASE_URL = "http://localhost:8000"
 # BASE_URL = "https://your-app.up.railway.app"  # Para producción
+# Same METRICS_TOKEN as the server, to scrape /metrics
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")
 
 def test_health():
     """Test health endpoint"""
@@ -27,6 +30,19 @@ def test_get_tiers():
     print(f"Response: {json.dumps(response.json(), indent=2)}")
     return response.status_code == 200
 
+def test_metrics():
+    """Test Prometheus metrics endpoint"""
+    print("\n📈 Testing /metrics...")
+    anonymous = requests.get(f"{BASE_URL}/metrics")
+    print(f"Without token: {anonymous.status_code}")
+    response = requests.get(f"{BASE_URL}/metrics", headers={"Authorization": f"Bearer {METRICS_TOKEN}"})
+    print(f"Status: {response.status_code}")
+    stage_lines = [line for line in response.text.splitlines() if line.startswith("ocrimageflow_stage_seconds_count")]
+    print(f"Stage histograms: {len(stage_lines)}")
+    for line in stage_lines[:5]:
+        print(f"  {line}")
+    return anonymous.status_code in (401, 404) and response.status_code == 200
+
 def test_register():
     """Test user registration"""
     print("\n📝 Testing user registration...")
@@ -77,6 +93,23 @@ def test_get_stats(token):
     print(f"Response: {json.dumps(response.json(), indent=2)}")
     return response.status_code == 200
 
+def test_usage_history(token):
+    """Test usage rollups: stats for a date range and the daily series"""
+    print("\n📆 Testing /usage/stats/history...")
+    headers = {"Authorization": f"Bearer {token}"}
+    response = requests.get(f"{BASE_URL}/usage/stats/history?period=day&action=user_login", headers=headers)
+    print(f"Status: {response.status_code}")
+    if response.status_code != 200:
+        print(f"Response: {json.dumps(response.json(), indent=2)}")
+        return False
+    result = response.json()
+    print(f"Days with logins since {result['start']}: {len(result['series'])}")
+    
+    response = requests.get(f"{BASE_URL}/usage/stats?start={result['start']}&end={result['end']}", headers=headers)
+    print(f"Range stats status: {response.status_code}")
+    print(f"Actions: {json.dumps(response.json().get('actions'), indent=2)}")
+    return response.status_code == 200
+
 def test_process_batch(token, image_paths):
     """Test batch image processing"""
     print("\n🖼️  Testing /process/batch...")
@@ -113,6 +146,8 @@ def test_process_batch(token, image_paths):
         result = response.json()
         print("✅ Batch processed successfully!")
         print(f"   Images processed: {result['images_processed']}")
+        for failed in result.get('failed_images', []):
+            print(f"   ⚠️  {failed['filename']} failed: {failed['error']}")
         print(f"   Industry detected: {result['industry_detected']}")
         print(f"   Excel URL: {result.get('excel_url', 'N/A')}")
         print(f"   Remaining images: {result.get('remaining_images', 'N/A')}")
@@ -121,6 +156,84 @@ def test_process_batch(token, image_paths):
         print(f"❌ Error: {json.dumps(response.json(), indent=2)}")
         return False
 
+def test_submit_job(token, image_paths):
+    """Test async batch processing (submit + poll)"""
+    print("\n⏳ Testing /jobs...")
+    
+    if not image_paths:
+        print("⚠️  No image files provided. Skipping this test.")
+        return False
+    
+    headers = {"Authorization": f"Bearer {token}"}
+    files = [('files', (os.path.basename(p), open(p, 'rb'), 'image/jpeg')) for p in image_paths if os.path.exists(p)]
+    
+    response = requests.post(f"{BASE_URL}/jobs", headers=headers, files=files)
+    for _, file_tuple in files:
+        file_tuple[1].close()
+    
+    print(f"Status: {response.status_code}")
+    if response.status_code != 202:
+        print(f"❌ Error: {json.dumps(response.json(), indent=2)}")
+        return False
+    
+    job_id = response.json()['job_id']
+    print(f"📨 Job queued: {job_id}")
+    
+    for _ in range(120):
+        job = requests.get(f"{BASE_URL}/jobs/{job_id}", headers=headers).json()
+        print(f"   {job['status']}: {job['images_done']}/{job['images_total']}")
+        if job['status'] in ('completed', 'partial', 'failed'):
+            break
+        time.sleep(2)
+    
+    if job['status'] in ('completed', 'partial'):
+        print(f"✅ Job {job['status']}! Excel URL: {job['excel_url']}")
+        for failed in job.get('failed_images') or []:
+            print(f"   ⚠️  {failed['filename']} failed: {failed['error']}")
+        return True
+    print(f"❌ Job {job['status']}: {job.get('error')}")
+    return False
+
+def test_presigned_upload(token, image_paths):
+    """Test direct-to-S3 uploads: presign, POST each file to S3, process by key"""
+    print("\n📤 Testing /uploads/presign + /process/keys...")
+    
+    image_paths = [p for p in image_paths if os.path.exists(p)]
+    if not image_paths:
+        print("⚠️  No image files provided. Skipping this test.")
+        return False
+    
+    headers = {"Authorization": f"Bearer {token}"}
+    response = requests.post(
+        f"{BASE_URL}/uploads/presign", headers=headers,
+        json={"files": [{"filename": os.path.basename(p), "content_type": "image/jpeg"} for p in image_paths]}
+    )
+    print(f"Status: {response.status_code}")
+    if response.status_code != 200:
+        print(f"❌ Error: {json.dumps(response.json(), indent=2)}")
+        return False
+    
+    uploads = response.json()['uploads']
+    for upload, img_path in zip(uploads, image_paths):
+        with open(img_path, 'rb') as f:
+            s3_response = requests.post(upload['url'], data=upload['fields'], files={'file': f})
+        if s3_response.status_code not in (200, 204):
+            print(f"❌ S3 rejected {img_path}: {s3_response.status_code} {s3_response.text[:200]}")
+            return False
+    print(f"📤 Uploaded {len(uploads)} images straight to S3")
+    
+    response = requests.post(
+        f"{BASE_URL}/process/keys", headers=headers, json={"keys": [u['key'] for u in uploads]}
+    )
+    print(f"Status: {response.status_code}")
+    if response.status_code == 200:
+        result = response.json()
+        print(f"✅ Batch {result['status']}! Images processed: {result['images_processed']}")
+        print(f"   Excel URL: {result.get('excel_url', 'N/A')}")
+        return True
+    print(f"❌ Error: {json.dumps(response.json(), indent=2)}")
+    return False
+
 def test_get_logs(token):
     """Test getting usage logs"""
     print("\n📋 Testing /usage/logs...")
@@ -133,6 +246,11 @@ def test_get_logs(token):
         print(f"Logs found: {len(result['logs'])}")
         for log in result['logs'][:3]:
             print(f"  - {log['action']} ({log['created_at']})")
+        if result['next_cursor']:
+            response = requests.get(
+                f"{BASE_URL}/usage/logs", params={"limit": 10, "cursor": result['next_cursor']}, headers=headers
+            )
+            print(f"Next page: {response.status_code}, {len(response.json()['logs'])} logs")
         return True
     else:
         print(f"Response: {json.dumps(response.json(), indent=2)}")
@@ -152,6 +270,7 @@ def main():
     
     # Test 2: Get tiers
     test_get_tiers()
+    test_metrics()
     
     # Test 3: Register (or login if already exists)
     token = test_register()
@@ -167,6 +286,7 @@ def main():
     
     # Test 4: Get stats
     test_get_stats(token)
+    test_usage_history(token)
     
     # Test 5: Process batch (OPTIONAL - requires images)
     # Descomenta y agrega rutas de imágenes de prueba:
@@ -175,6 +295,10 @@ def main():
     #     "C:/path/to/image2.jpg"
     # ])
     
+    # test_submit_job(token, ["C:/path/to/image1.jpg"])
+    
+    # test_presigned_upload(token, ["C:/path/to/image1.jpg"])
+    
     print("\n⚠️  Image processing test skipped (no images provided)")
     print("   To test image processing, uncomment the lines above and add image paths")
     
@@ -0,0 +1,432 @@
+"""
+Pipeline tests for OCRimageflow: no server, database or cloud account needed
+(fakes from benchmarks.py for Vision and usage_logs, moto for S3)
+Uso: python -m pytest test_pipeline.py
+"""
+
+import asyncio
+import base64
+import json
+import random
+import threading
+import time
+from io import BytesIO
+
+import pytest
+import requests
+from openpyxl import load_workbook
+from PIL import Image
+
+import main as app
+from benchmarks import (
+    FakeImageAnnotatorClient, FakeUsageDB, UnlimitedReservation, legacy_normalize_value, start_gemini_stub,
+    start_moto_server, stub_client, synthetic_field_values, use_moto_s3,
+)
+
+def photo(seed: int, tag: bytes = b"") -> bytes:
+    """Small JPEG that differs per seed; tag is appended after the image data"""
+    output = BytesIO()
+    Image.new("RGB", (64, 48), (seed % 256, seed * 7 % 256, seed * 13 % 256)).save(output, format="JPEG")
+    return output.getvalue() + tag
+
+@pytest.fixture
+def moto_s3(monkeypatch):
+    """The app's S3 client pointed at a local moto server for the duration of one test"""
+    pytest.importorskip("moto.server")
+    for name in ("s3_client", "s3_transfer", "AWS_BUCKET_NAME"):
+        monkeypatch.setattr(app, name, getattr(app, name))
+    server, url = start_moto_server(5140)
+    try:
+        use_moto_s3(url)
+        yield url
+    finally:
+        server.terminate()
+        server.wait()
+
+@pytest.fixture
+def gemini_stub(monkeypatch):
+    """start(**stub options) -> (stub server, GeminiClient for it, installed as the app's client)"""
+    monkeypatch.setattr(app, "gemini_client", app.gemini_client)
+    servers = []
+    
+    def start(max_retries=4, breaker_threshold=5, **options):
+        server, url = start_gemini_stub(latency=0, handshake=0, **options)
+        servers.append(server)
+        client = app.gemini_client = stub_client(url, max_retries=max_retries, breaker_threshold=breaker_threshold)
+        client.BACKOFF_BASE = 0.01
+        return server, client
+    
+    yield start
+    for server in servers:
+        server.shutdown()
+
+def presigned_post(filename: str, image_bytes: bytes) -> dict:
+    """Browser-style POST of image_bytes to a fresh presigned policy for user 1"""
+    upload = app.presign_upload(1, filename, "image/jpeg")
+    response = requests.post(upload["url"], data=upload["fields"], files={"file": ("upload.jpg", image_bytes)})
+    assert response.status_code == 204, response.text
+    return upload
+
+def test_normalize_value_matches_legacy():
+    """The precompiled engine gives the same output as the per-call regex version, qty_por_caja included"""
+    normalizer = app.DataNormalizer()
+    pairs = synthetic_field_values(2000) + [("qty_por_caja", "12 pcs"), ("peso", "  "), ("talla", 0)]
+    for field_name, value in pairs:
+        assert normalizer.normalize_value(field_name, value) == legacy_normalize_value(field_name, value), value
+    assert normalizer.normalize_value("qty_por_caja", "12 pcs") == "12 pcs"
+
+def test_vision_batching(monkeypatch):
+    """Chunking, ordering and per-image error isolation against the fake client"""
+    images = [f"img-{i}".encode() for i in range(40)]
+    images[5] = b"img-5-FAIL"
+    images[21] = b"img-21-BOOM"
+    
+    chunks = app.vision_chunks(images)
+    assert [i for chunk in chunks for i in chunk] == list(range(len(images))), "chunks must keep input order"
+    assert all(len(chunk) <= app.VISION_BATCH_SIZE for chunk in chunks)
+    big = [b"x" * (app.VISION_BATCH_MAX_BYTES // 3)] * 4
+    assert [len(chunk) for chunk in app.vision_chunks(big)] == [3, 1], "byte budget must split chunks"
+    
+    fake = FakeImageAnnotatorClient(latency=0.01, per_image=0)
+    monkeypatch.setattr(app, "vision_client", fake)
+    results = asyncio.run(app.google_vision_batch_ocr(images, concurrency=4))
+    for i, (result, _) in enumerate(results):
+        if i in (5, 21):
+            assert isinstance(result, Exception), f"image {i} should fail on its own"
+        else:
+            assert result['structured_data']['codigo'] == fake.expected_code(images[i]), f"image {i} out of order"
+    # The chunk with BOOM is retried one call per image
+    assert sorted(fake.calls).count(1) == len(chunks[1]), fake.calls
+
+def test_batched_pipeline_overlaps_staging_and_ocr(monkeypatch):
+    """Vision calls start while images are still being staged; results stay in input order"""
+    fake = FakeImageAnnotatorClient(latency=0.05, per_image=0)
+    monkeypatch.setattr(app, "vision_client", fake)
+    monkeypatch.setattr(app, "OCR_PREPROCESS", False)
+    monkeypatch.setattr(app.ocr_cache, "get", lambda *args: None)
+    monkeypatch.setattr(app.ocr_cache, "put", lambda *args: None)
+    
+    staged_at, called_at = [], []
+    stage_image, annotate = app.stage_image, fake.batch_annotate_images
+    
+    def timed_stage_image(*args):
+        staged = stage_image(*args)
+        staged_at.append(time.perf_counter())
+        return staged
+    
+    def timed_annotate(requests):
+        called_at.append(time.perf_counter())
+        return annotate(requests)
+    
+    monkeypatch.setattr(app, "stage_image", timed_stage_image)
+    monkeypatch.setattr(fake, "batch_annotate_images", timed_annotate)
+    
+    count = 4 * app.VISION_BATCH_SIZE
+    images = [(photo(i, b"FAIL" if i == 3 else b""), f"{i}.jpg", "image/jpeg", f"https://bucket/{i}.jpg")
+              for i in range(count)]
+    config = dict(app.TIER_CONFIGS["pro"], ocr_engine="google_vision", ocr_concurrency=2)
+    progress = []
+    
+    async def on_progress(done):
+        progress.append(done)
+    
+    results = asyncio.run(app.process_images_batched(images, 1, config, on_progress))
+    
+    assert [result['status'] for result in results] == ["failed" if i == 3 else "succeeded" for i in range(count)]
+    for (image_bytes, _, _, image_url), result in zip(images, results):
+        if result['status'] == "succeeded":
+            assert result['image_url'] == image_url
+            assert result['ocr_result']['structured_data']['codigo'] == fake.expected_code(image_bytes)
+    assert fake.calls == [app.VISION_BATCH_SIZE] * 4
+    assert called_at[0] < staged_at[-1], "the first Vision call must not wait for the whole batch to be staged"
+    assert progress[-1] == count
+
+def test_gemini_breaker(gemini_stub):
+    """A dead endpoint opens the circuit after breaker_threshold failures; later calls fail fast with 503"""
+    server, client = gemini_stub(max_retries=1, breaker_threshold=3, error_rate=1.0)
+    statuses = []
+    for _ in range(6):
+        with pytest.raises(app.HTTPException) as error:
+            app.gemini_ocr(b"x", "image/jpeg")
+        statuses.append(error.value.status_code)
+    assert statuses[-1] == 503 and server.requests == 3, (statuses, server.requests)
+    assert client.stats()["breaker"] == "open"
+
+def test_gemini_waits_for_retry_after(gemini_stub):
+    """A 429 halves the concurrency limit and the retry waits for Retry-After, not just the backoff"""
+    server, client = gemini_stub(script=(429,), retry_after=0.3)
+    start = time.perf_counter()
+    result = app.gemini_ocr(b"x", "image/jpeg")
+    assert time.perf_counter() - start >= 0.3
+    assert result["structured_data"] == {"precio": "$10.50", "talla": "M"}
+    stats = client.stats()
+    assert (server.requests, stats["throttled"], stats["retries"]) == (2, 1, 1), stats
+    assert stats["limit"] < client.max_concurrency / 2 + 1, stats
+
+def test_gemini_retries_unavailable(gemini_stub):
+    """503s are retried until one succeeds; once max_retries is spent the error reaches the caller"""
+    server, client = gemini_stub(script=(503, 503))
+    assert app.gemini_ocr(b"x", "image/jpeg")["structured_data"]["talla"] == "M"
+    stats = client.stats()
+    assert (server.requests, stats["failures"], stats["retries"], stats["breaker"]) == (3, 2, 2, "closed"), stats
+    
+    server, client = gemini_stub(max_retries=2, script=(503, 503, 503, 200))
+    with pytest.raises(app.HTTPException) as error:
+        app.gemini_ocr(b"x", "image/jpeg")
+    assert "503" in error.value.detail and server.requests == 3
+
+def test_presigned_uploads(moto_s3):
+    """Presigned POST -> S3 -> fetch by key; the size/type policy is signed and keys outside uploads/ are refused"""
+    image_bytes = photo(1)
+    upload = presigned_post("C:\\fotos\\camisa.jpg", image_bytes)
+    assert upload["key"].startswith("user_1/uploads/") and upload["key"].endswith("_camisa.jpg")
+    
+    content, filename, content_type, image_url = app.fetch_upload(upload["key"])
+    assert (content, filename, content_type) == (image_bytes, "camisa.jpg", "image/jpeg")
+    assert image_url.endswith(upload["key"])
+    
+    # moto doesn't enforce POST policy conditions (S3 does), so check the signed policy instead
+    conditions = json.loads(base64.b64decode(upload["fields"]["policy"]))["conditions"]
+    assert {"Content-Type": "image/jpeg"} in conditions
+    assert ["content-length-range", 1, app.UPLOAD_MAX_BYTES] in conditions
+    
+    for foreign in ("user_2/uploads/x_a.jpg", "user_1/x_batch_pro_general.xlsx"):
+        with pytest.raises(app.HTTPException) as error:
+            asyncio.run(app.process_keys(app.ProcessKeysRequest(keys=[upload["key"], foreign]), user_id=1))
+        assert error.value.status_code == 403, error.value.detail
+
+def test_unreadable_keys_fail_alone(moto_s3, monkeypatch):
+    """A missing key becomes a failed image in its place instead of failing the whole /process/keys batch"""
+    uploads = [presigned_post(f"{i}.jpg", photo(i)) for i in range(2)]
+    keys = [uploads[0]["key"], "user_1/uploads/missing_a.jpg", uploads[1]["key"]]
+    
+    async def succeed(images, *args):
+        return [{"status": "succeeded", "image_url": image[3]} for image in images]
+    
+    async def results_of(user_id, tier, results, *args):
+        return results
+    
+    monkeypatch.setattr(app, "check_batch_limits", lambda user_id, batch_size: None)
+    monkeypatch.setattr(app, "QuotaReservation", UnlimitedReservation)
+    monkeypatch.setattr(app, "process_images_concurrently", succeed)
+    monkeypatch.setattr(app, "finish_batch", results_of)
+    
+    results = asyncio.run(app.process_keys(app.ProcessKeysRequest(keys=keys), user_id=1))
+    assert [result["status"] for result in results] == ["succeeded", "failed", "succeeded"]
+    assert results[0]["image_url"].endswith(keys[0]) and results[2]["image_url"].endswith(keys[2])
+    assert "Upload not found" in results[1]["error"]
+
+class FakeStreamRequest:
+    """Just enough of a Starlette Request for stream_batch: a multipart body sent in small chunks"""
+    
+    def __init__(self, body: bytes, chunk_size: int = 64, boundary: str = "XX"):
+        self.headers = {"content-type": f"multipart/form-data; boundary={boundary}"}
+        self.body = body
+        self.chunk_size = chunk_size
+    
+    async def stream(self):
+        for start in range(0, len(self.body), self.chunk_size):
+            yield self.body[start:start + self.chunk_size]
+
+def s3_object(key: str) -> bytes:
+    return app.s3_client.get_object(Bucket=app.AWS_BUCKET_NAME, Key=key)["Body"].read()
+
+def test_s3_multipart_writer(moto_s3, monkeypatch):
+    """Parts reassemble in order, small output is one put_object, errors abort the upload"""
+    chunk = 5 * 1024 * 1024
+    monkeypatch.setattr(app, "S3_MULTIPART_CHUNKSIZE", chunk)
+    payload = random.Random(1).randbytes(3 * chunk + chunk // 2)
+    with app.S3MultipartWriter("check/multipart.bin", "application/octet-stream") as writer:
+        for start in range(0, len(payload), 100_000):
+            writer.write(payload[start:start + 100_000])
+    assert len(writer._parts) == 4 and s3_object("check/multipart.bin") == payload
+    
+    with app.S3MultipartWriter("check/small.bin", "application/octet-stream") as writer:
+        writer.write(b"small")
+    assert writer._upload_id is None and s3_object("check/small.bin") == b"small"
+    
+    with pytest.raises(RuntimeError):
+        with app.S3MultipartWriter("check/aborted.bin", "application/octet-stream") as writer:
+            writer.write(payload)
+            raise RuntimeError("export failed")
+    assert "Uploads" not in app.s3_client.list_multipart_uploads(Bucket=app.AWS_BUCKET_NAME)
+
+def test_export_excel(moto_s3):
+    """export_excel streams the workbook into S3: one row per image, thumbnails anchored in column A"""
+    thumbnail = BytesIO()
+    Image.new("RGB", (150, 150), (200, 30, 30)).save(thumbnail, format="PNG")
+    frame = app.pd.DataFrame([{"precio": "$10.50", "talla": "M"}, {"precio": "$3.00"}])
+    
+    url, thumbnail_failures = app.export_excel(
+        frame, ["https://bucket/0.jpg", "https://bucket/1.jpg"], "general", 1, "export.xlsx",
+        [thumbnail.getvalue(), None]
+    )
+    [key] = [obj["Key"] for obj in app.s3_client.list_objects_v2(Bucket=app.AWS_BUCKET_NAME)["Contents"]]
+    assert key.endswith("_export.xlsx") and url.endswith(key) and thumbnail_failures == 1
+    
+    ws = load_workbook(BytesIO(s3_object(key)))["Datos"]
+    assert [list(row) for row in ws.iter_rows(values_only=True)] == [
+        ["Imagen", "precio", "talla"], [None, "$10.50", "M"], [None, "$3.00", None]
+    ]
+    assert [image.anchor._from.row for image in ws._images] == [1]
+
+def multipart_body(files: list, boundary: str = "XX") -> bytes:
+    body = b""
+    for name, content in files:
+        body += (f'--{boundary}\r\nContent-Disposition: form-data; name="files"; filename="{name}"\r\n'
+                 f'Content-Type: image/jpeg\r\n\r\n').encode() + content + b"\r\n"
+    return body + f"--{boundary}--\r\n".encode()
+
+def test_stream_batch_rejects_bad_bodies(monkeypatch):
+    """Malformed multipart is a 400, and a rejected batch closes every part it had spooled"""
+    spools = []
+    spooled_file = app.tempfile.SpooledTemporaryFile
+    
+    def tracked(*args, **kwargs):
+        spools.append(spooled_file(*args, **kwargs))
+        return spools[-1]
+    
+    monkeypatch.setattr(app.tempfile, "SpooledTemporaryFile", tracked)
+    config = dict(app.TIER_CONFIGS["pro"], max_images_per_batch=1, ocr_concurrency=1)
+    
+    def status(body, chunk_size=64):
+        try:
+            asyncio.run(app.stream_batch(FakeStreamRequest(body, chunk_size), 1, config, UnlimitedReservation(1)))
+            return 200
+        except app.HTTPException as e:
+            return e.status_code
+    
+    assert status(b"not a multipart body") == 400
+    # Too large: part 2 is rejected while part 3 is already spooled from the same chunk
+    body = multipart_body([(f"{i}.jpg", b"x" * 10) for i in range(3)])
+    assert status(body, chunk_size=len(body)) == 400
+    assert len(spools) == 3 and all(spooled.closed for spooled in spools)
+
+def test_job_heartbeat_not_blocked_by_ocr(monkeypatch):
+    """Heartbeats still go out while every ocr_executor thread is busy"""
+    store = app.LocalJobStore()
+    job_id = store.create(1, 1)
+    touched = threading.Event()
+    monkeypatch.setattr(store, "touch", lambda job_ids: touched.set())
+    runner = app.JobRunner(store, workers=1, heartbeat=60, stale_after=300)
+    release = threading.Event()
+    busy = [app.ocr_executor.submit(release.wait) for _ in range(app.OCR_MAX_WORKERS)]
+    
+    async def heartbeat():
+        runner._jobs[object()] = job_id
+        runner.start()
+        for _ in range(200):
+            if touched.is_set():
+                break
+            await asyncio.sleep(0.01)
+        runner._watcher.cancel()
+    
+    try:
+        asyncio.run(heartbeat())
+    finally:
+        release.set()
+    assert touched.is_set()
+    assert all(future.result() for future in busy)
+
+def test_failed_job_stays_failed(monkeypatch):
+    """A job failed as stale by another replica isn't overwritten when its batch completes here"""
+    store = app.LocalJobStore()
+    job_id = store.create(1, 1)
+    runner = app.JobRunner(store, workers=1, heartbeat=60, stale_after=300)
+    
+    async def run_batch(user_id, images, on_progress, batch_id):
+        store.fail([job_id], app.JOB_INTERRUPTED)
+        return {"failed_images": [], "industry_detected": "general", "excel_url": "https://bucket/x.xlsx",
+                "normalized_data": []}
+    
+    async def run_job():
+        runner.submit(job_id, 1, [], None)
+        await asyncio.gather(*runner._jobs)
+    
+    monkeypatch.setattr(app, "run_batch", run_batch)
+    asyncio.run(run_job())
+    job = store.get(job_id, 1)
+    assert (job["status"], job["excel_url"], job["error"]) == ("failed", None, app.JOB_INTERRUPTED)
+
+def test_usage_log_writer(monkeypatch):
+    """Flush on size and on close, oldest dropped past the cap, retry while the DB is down"""
+    db = FakeUsageDB()
+    monkeypatch.setattr(app, "db_pool", db)
+    writer = app.UsageLogWriter(batch_size=3, flush_interval=60, max_buffered=5)
+    for _ in range(3):
+        writer.log(1, "user_login")
+    deadline = time.time() + 5
+    while len(db.rows) < 3 and time.time() < deadline:
+        time.sleep(0.01)
+    assert len(db.rows) == 3 and db.rows[0][:2] == [1, "user_login"], db.rows
+    writer.log(1, "user_login")
+    writer.close()
+    assert len(db.rows) == 4 and writer.stats()["buffered"] == 0, writer.stats()
+    writer.log(1, "user_login")
+    assert writer.stats()["dropped"] == 1 and len(db.rows) == 4
+    
+    db = FakeUsageDB(down=True)
+    monkeypatch.setattr(app, "db_pool", db)
+    writer = app.UsageLogWriter(batch_size=100, flush_interval=60, max_buffered=5)
+    for i in range(7):
+        writer.log(i, "user_login")
+    assert not writer.flush()
+    assert writer.stats() == {"buffered": 5, "written": 0, "dropped": 2, "flush_failures": 1}, writer.stats()
+    db.down = False
+    writer.close()
+    assert [row[0] for row in db.rows] == [2, 3, 4, 5, 6], db.rows
+
+def test_usage_log_skips_rejected_rows(monkeypatch):
+    """Rows failing a constraint or the column types are dropped alone; the rest of the page is written"""
+    db = FakeUsageDB(bad_users={2}, bad_actions={"broken"})
+    monkeypatch.setattr(app, "db_pool", db)
+    writer = app.UsageLogWriter(batch_size=100, flush_interval=60, max_buffered=100)
+    for user_id, action in ((1, "user_login"), (2, "user_login"), (3, "broken"), (4, "batch_processed")):
+        writer.log(user_id, action)
+    assert writer.flush()
+    assert [row[0] for row in db.rows] == [1, 4], db.rows
+    assert writer.stats() == {"buffered": 0, "written": 2, "dropped": 2, "flush_failures": 0}, writer.stats()
+    writer.close()
+
+class FakeCheckpointCursor:
+    """batch_checkpoints rows of one batch as {image_hash: billed}, for BatchCheckpoints.bill"""
+    
+    def __init__(self, rows: dict):
+        self.rows = rows
+        self.result = []
+    
+    def execute(self, sql, params):
+        hashes = params[2]
+        if sql.startswith("UPDATE"):
+            self.result = [{"image_hash": h} for h in hashes if h in self.rows and not self.rows[h]]
+            for row in self.result:
+                self.rows[row["image_hash"]] = True
+        else:
+            self.result = [{"image_hash": h} for h in hashes if h in self.rows]
+    
+    def fetchall(self):
+        return self.result
+
+def test_checkpoints_billed_once():
+    """Only images whose checkpoint a submission flips to billed (or that have none) are charged"""
+    cursor = FakeCheckpointCursor({"a": False, "b": True, "c": False})
+    # a: billed now, b: billed by an earlier submission, c twice in the batch, d never checkpointed
+    assert app.BatchCheckpoints.bill(cursor, 1, "batch", ["a", "b", "c", "c", "d", None]) == 5
+    assert cursor.rows == {"a": True, "b": True, "c": True}
+    # A second submission racing the first sees every row billed: only the uncheckpointed images count
+    assert app.BatchCheckpoints.bill(cursor, 1, "batch", ["a", "b", "c", "c", "d", None]) == 2
+
+def test_metrics_token(monkeypatch):
+    """/metrics needs the configured bearer token, and doesn't exist without one"""
+    def status(token):
+        credentials = token and app.HTTPAuthorizationCredentials(scheme="Bearer", credentials=token)
+        try:
+            app.require_metrics_token(credentials)
+            return 200
+        except app.HTTPException as e:
+            return e.status_code
+    
+    monkeypatch.setattr(app, "METRICS_TOKEN", None)
+    assert status("anything") == 404
+    monkeypatch.setattr(app, "METRICS_TOKEN", "s3cret")
+    assert [status(None), status("wrong"), status("s3cret")] == [401, 401, 200]